@@ -0,0 +1,85 @@
+# common utils
+import os
+import hashlib
+import tempfile
+import zipfile
+
+# numpy
+import numpy as np
+
+
+CACHE_VERSION = 1 # bump to invalidate all cached entries
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """ content hash of a file """
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def hash_arrays(*arrays, extra=None):
+    """ content hash of a list of arrays (dtype, shape and values), plus any repr-able extras """
+    hasher = hashlib.sha1()
+    hasher.update(str(CACHE_VERSION).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hasher.update("{}{}".format(array.dtype.str, array.shape).encode())
+        hasher.update(array.tobytes())
+
+    if extra is not None:
+        hasher.update(repr(extra).encode())
+
+    return hasher.hexdigest()
+
+
+def load_npz(cache_dir, key):
+    """ returns the cached arrays as a dict, or None on a miss """
+    if cache_dir is None:
+        return None
+
+    path = os.path.join(cache_dir, "{}.npz".format(key))
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        print("=> invalid cache entry {}, ignored: {}".format(path, e))
+        return None
+
+
+def save_npz(cache_dir, key, **arrays):
+    """ write the arrays atomically, concurrent runs never see a partial entry """
+    if cache_dir is None:
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, "{}.npz".format(key))
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def pack_index_lists(index_lists):
+    """ list of 1D int arrays -> (concatenated values, offsets) """
+    lengths = [len(indices) for indices in index_lists]
+    offsets = np.zeros(len(index_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    values = np.concatenate([np.asarray(indices, dtype=np.int64) for indices in index_lists]) if index_lists else np.zeros(0, dtype=np.int64)
+
+    return values, offsets
+
+
+def unpack_index_lists(values, offsets):
+    return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
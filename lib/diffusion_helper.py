@@ -17,12 +17,12 @@ from diffusers import (
 import sys
 sys.path.append(".")
 
-from models.ControlNet.gradio_depth2image import init_model, process
+from models.ControlNet.gradio_depth2image import init_model, init_sampler, process, process_batch
 
 
-def get_controlnet_depth():
+def get_controlnet_depth(compile_mode="eager", vram_budget=None):
     print("=> initializing ControlNet Depth...")
-    model, ddim_sampler = init_model()
+    model, ddim_sampler = init_model(compile_mode, vram_budget)
 
     return model, ddim_sampler
 
@@ -52,7 +52,7 @@ def apply_controlnet_depth(model, ddim_sampler,
     init_image, prompt, strength, ddim_steps,
     generate_mask_image, keep_mask_image, depth_map_np, 
     a_prompt, n_prompt, guidance_scale, seed, eta, num_samples,
-    device, blend=0, save_memory=False):
+    device, blend=0, save_memory=False, crop_to_mask=False, latent_cache=None, latent_key=None, incremental_latents=True):
     """
         Use Stable Diffusion 2 to generate image
 
@@ -75,9 +75,15 @@ def apply_controlnet_depth(model, ddim_sampler,
         model, ddim_sampler,
         np.array(init_image), prompt, a_prompt, n_prompt, num_samples,
         ddim_steps, guidance_scale, seed, eta, 
-        strength=strength, detected_map=depth_map_np, unknown_mask=np.array(generate_mask_image), save_memory=save_memory
+        strength=strength, detected_map=depth_map_np, unknown_mask=np.array(generate_mask_image), save_memory=save_memory,
+        crop_to_mask=crop_to_mask, latent_cache=latent_cache, latent_key=latent_key, incremental_latents=incremental_latents
     )[0]
 
+    return blend_generated_image(init_image, diffused_image_np, generate_mask_image, keep_mask_image, blend)
+
+
+def blend_generated_image(init_image, diffused_image_np, generate_mask_image, keep_mask_image, blend=0):
+    """ blend the generated region with the kept region at their boundary """
     init_image = init_image.convert("RGB")
     diffused_image = Image.fromarray(diffused_image_np).convert("RGB")
 
@@ -113,6 +119,34 @@ def apply_controlnet_depth(model, ddim_sampler,
     return diffused_image, init_image_masked, diffused_image_masked
 
 
+@torch.no_grad()
+def apply_controlnet_depth_batch(model, ddim_sampler, 
+    init_images, prompts, strength, ddim_steps,
+    generate_mask_images, keep_mask_images, depth_maps_np, 
+    a_prompt, n_prompt, guidance_scale, seed, eta,
+    device, blend=0, save_memory=False):
+    """
+        Same as `apply_controlnet_depth`, but several views are denoised in one batch.
+        All the inputs are lists with one entry per view, returns one output tuple per view.
+    """
+
+    print("=> generating ControlNet Depth RePaint images for {} views...".format(len(init_images)))
+
+    diffused_images_np = process_batch(
+        model, ddim_sampler,
+        [np.array(init_image) for init_image in init_images], prompts, a_prompt, n_prompt,
+        ddim_steps, guidance_scale, seed, eta, 
+        strength=strength, detected_maps=depth_maps_np, 
+        unknown_masks=[np.array(generate_mask_image) for generate_mask_image in generate_mask_images], save_memory=save_memory
+    )
+
+    return [
+        blend_generated_image(init_image, diffused_image_np, generate_mask_image, keep_mask_image, blend)
+        for init_image, diffused_image_np, generate_mask_image, keep_mask_image 
+        in zip(init_images, diffused_images_np, generate_mask_images, keep_mask_images)
+    ]
+
+
 @torch.no_grad()
 def apply_inpainting(model, 
     init_image, mask_image_tensor, prompt, height, width, device):
@@ -5,16 +5,21 @@ import xatlas
 
 import numpy as np
 
+from collections import namedtuple
+
 from sklearn.decomposition import PCA
 
 from torchvision import transforms
 
 from tqdm import tqdm
 
-from pytorch3d.io import (
-    load_obj,
-    load_objs_as_meshes
-)
+from pytorch3d.structures import Meshes
+
+# customized
+import sys
+sys.path.append(".")
+
+from lib.cache_helper import hash_file, hash_arrays, load_npz, save_npz
 
 
 def compute_principle_directions(model_path, num_points=20000):
@@ -28,8 +33,20 @@ def compute_principle_directions(model_path, num_points=20000):
     return principle_directions
 
 
-def init_mesh(input_path, cache_path, device):
-    print("=> parameterizing target mesh...")
+Faces = namedtuple("Faces", ["verts_idx", "normals_idx", "textures_idx", "materials_idx"])
+Aux = namedtuple("Aux", ["normals", "verts_uvs", "material_colors", "texture_images", "texture_atlas"])
+
+
+def parameterize_mesh(input_path, cache_dir=None):
+    """
+        xatlas UV parameterization of the input mesh, cached by the content hash of the file.
+        Returns the re-indexed vertices, vmapping, face indices and UVs.
+    """
+    cache_key = hash_arrays(extra=("xatlas", getattr(xatlas, "__version__", None), hash_file(input_path))) if cache_dir is not None else None
+    cached = load_npz(cache_dir, cache_key)
+    if cached is not None:
+        print("=> loading UV parameterization from cache...")
+        return cached["vertices"], cached["vmapping"], cached["indices"], cached["uvs"]
 
     mesh = trimesh.load_mesh(input_path, force='mesh')
     try:
@@ -39,15 +56,40 @@ def init_mesh(input_path, cache_path, device):
         exit()
 
     vmapping, indices, uvs = xatlas.parametrize(vertices, faces)
-    xatlas.export(str(cache_path), vertices[vmapping], indices, uvs)
+    vertices = np.asarray(vertices)[vmapping]
+    save_npz(cache_dir, cache_key, vertices=vertices, vmapping=vmapping, indices=indices, uvs=uvs)
+
+    return vertices, vmapping, indices, uvs
+
+
+def init_mesh(input_path, cache_path, device, cache_dir=None):
+    print("=> parameterizing target mesh...")
+
+    vertices, _, indices, uvs = parameterize_mesh(input_path, cache_dir)
+    xatlas.export(str(cache_path), vertices, indices, uvs)
 
     print("=> loading target mesh...")
 
     # principle_directions = compute_principle_directions(cache_path)
     principle_directions = None
     
-    _, faces, aux = load_obj(cache_path, device=device)
-    mesh = load_objs_as_meshes([cache_path], device=device) # Meshes
+    # NOTE same outputs as `load_obj` on the exported OBJ, without parsing it back
+    verts = torch.from_numpy(np.asarray(vertices, dtype=np.float32)).to(device)
+    indices = torch.from_numpy(np.asarray(indices, dtype=np.int64)).to(device)
+    faces = Faces(
+        verts_idx=indices,
+        normals_idx=torch.full_like(indices, -1),
+        textures_idx=indices,
+        materials_idx=torch.full((indices.shape[0],), -1, dtype=torch.int64, device=device)
+    )
+    aux = Aux(
+        normals=None,
+        verts_uvs=torch.from_numpy(np.asarray(uvs, dtype=np.float32)).to(device),
+        material_colors=None,
+        texture_images=None,
+        texture_atlas=None
+    )
+    mesh = Meshes(verts=[verts], faces=[indices]) # Meshes
 
     num_verts = mesh.verts_packed().shape[0]
 
@@ -0,0 +1,822 @@
+# common utils
+import os
+import time
+import numpy as np
+
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+# pytorch3d
+from pytorch3d.renderer import TexturesUV
+import torch
+from torchvision import transforms
+from PIL import Image
+
+# customized
+import sys
+sys.path.append(".")
+
+from lib.ray_helper import (
+    XRayMesh
+)
+
+from lib.mesh_helper import (
+    init_mesh,
+    adjust_uv_map
+)
+from lib.render_helper import render
+from lib.io_helper import (
+    save_backproject_obj,
+    save_viewpoints
+)
+from lib.vis_helper import (
+    visualize_principle_viewpoints,
+    visualize_refinement_viewpoints
+)
+from lib.diffusion_helper import (
+    get_controlnet_depth,
+    get_inpainting,
+    init_sampler,
+    apply_controlnet_depth,
+    apply_controlnet_depth_batch,
+    apply_inpainting_postprocess
+)
+from models.ControlNet.gradio_depth2image import LatentCache, CONDITIONING_CACHE
+from lib.projection_helper import (
+    backproject_from_image,
+    render_one_view_and_build_masks,
+    select_viewpoint,
+    build_similarity_texture_cache_for_all_views,
+    ViewScoringEngine,
+    CorrespondenceCache,
+    compute_new_ratio
+)
+from lib.camera_helper import init_viewpoints
+
+
+# ---------------- CONFIGS ----------------------
+
+
+class RenderConfig(NamedTuple):
+    """ resolution profile, see `--device` in scripts/generate_texture.py """
+    image_size: int = 768
+    uv_size: int = 1000
+    render_simple_factor: int = 4
+    fragment_k: int = 1
+
+
+class MeshConfig(NamedTuple):
+    input_path: str
+    init_texture_path: str = "./samples/textures/dummy.png"
+    use_multiple_objects: bool = False
+    use_unnormalized: bool = False
+    # viewpoints
+    viewpoint_mode: str = "predefined"
+    num_viewpoints: int = 8
+    dist: float = 1
+    elev: float = 0
+    use_shapenet: bool = False
+    use_objaverse: bool = False
+    # xray
+    hits: int = 2
+    xray_size: int = 1536 # resolution of the X-ray ray grid, lower is faster but may miss small faces
+    xray_workers: int = 1 # number of cameras cast in parallel
+    cache_dir: Optional[str] = None # on-disk cache of geometry results shared across runs, disabled if None
+    correspondences: str = "off" # pixel -> texel maps of the back-projected views: "off", "device" (last views, up to 1 GB of VRAM) or "memmap" (all views)
+
+
+class DiffusionConfig(NamedTuple):
+    prompt: str
+    a_prompt: str = "best quality, high quality, extremely detailed, good geometry"
+    n_prompt: str = "deformed, extra digit, fewer digits, cropped, worst quality, low quality, smoke"
+    new_strength: float = 1
+    update_strength: float = 0.5
+    ddim_steps: int = 20
+    guidance_scale: float = 10
+    eta: float = 0.0
+    seed: int = 42
+    blend: float = 0.5
+    view_threshold: float = 0.1
+    add_view_to_prompt: bool = False
+    smooth_mask: bool = False
+    no_repaint: bool = False
+    no_update: bool = False
+    batch_views: int = 1 # max number of principle views denoised together, 1 -> sequential
+    skip_threshold: float = 0.0 # skip generating views with fewer new pixels (fraction of the object), 0 -> only empty ones
+    crop_to_mask: bool = False # only diffuse a tile around the masked region (single-view calls)
+    sampler: str = "ddim" # "ddim" or "dpmpp_2m", the latter needs fewer steps
+    control_sharing: str = "full" # "full", "shared" or "cond_only": ControlNet runs once per CFG pair unless "full"
+    latent_cache: str = "off" # "off", "exact" (reuse unchanged renderings) or "incremental" (also re-encode changed tiles only)
+
+
+class RefineConfig(NamedTuple):
+    update_steps: int = 8
+    update_mode: str = "heuristic"
+
+
+# ---------------- STATE ----------------------
+
+
+class TextureState:
+    """ everything that changes while texturing one mesh """
+
+    def __init__(self, output_dir, mesh_config, render_config,
+        mesh, faces, aux, verts_uvs, mesh_center, mesh_scale,
+        init_texture, exist_texture, texture_maps, viewpoints
+    ):
+        self.output_dir = output_dir
+        self.mesh_config = mesh_config
+        self.render_config = render_config
+
+        self.mesh = mesh
+        self.faces = faces
+        self.aux = aux
+        self.verts_uvs = verts_uvs
+        self.mesh_center = mesh_center
+        self.mesh_scale = mesh_scale
+
+        self.init_texture = init_texture
+        self.exist_texture = exist_texture
+        self.texture_maps = texture_maps
+
+        (
+            self.dist_list,
+            self.elev_list,
+            self.azim_list,
+            self.sector_list,
+            self.view_punishments
+        ) = viewpoints
+
+        self.last_view_idx = None
+
+        # skipped diffusion calls and the time spent per diffusion call, by kind (generate/update)
+        self.skipped_views = []
+        self.diffusion_times = {"generate": [], "update": []}
+
+    @property
+    def num_principle(self):
+        return 10 if self.mesh_config.use_shapenet or self.mesh_config.use_objaverse else 6
+
+    def output_verts(self):
+        if self.mesh_config.use_unnormalized:
+            return self.mesh_scale * self.mesh.verts_packed() + self.mesh_center
+
+        return self.mesh.verts_packed()
+
+    def skip_summary(self):
+        """ number of skipped diffusion calls and the estimated time saved """
+        all_times = self.diffusion_times["generate"] + self.diffusion_times["update"]
+        saved_time = 0
+        for _, kind, *_ in self.skipped_views:
+            times = self.diffusion_times[kind] or all_times
+            saved_time += sum(times) / len(times) if len(times) > 0 else 0
+
+        return len(self.skipped_views), saved_time
+
+
+def init_stage_dirs(output_dir, stage):
+    stage_dir = os.path.join(output_dir, stage)
+    dirs = {"stage": stage_dir}
+    for name in ["rendering", "normal", "mask", "depth", "similarity", "inpainted", "mesh", "intermediate"]:
+        dirs[name] = os.path.join(stage_dir, name)
+        os.makedirs(dirs[name], exist_ok=True)
+
+    return dirs
+
+
+def get_cache_dir(mesh_config, name):
+    """ sub-directory of the shared cache for one kind of result, None if caching is disabled """
+    if mesh_config.cache_dir is None:
+        return None
+
+    return os.path.join(mesh_config.cache_dir, name)
+
+
+def group_disjoint_views(face_indices_list, max_views):
+    """
+        Greedily split the view sequence into groups of consecutive views with disjoint visible faces.
+        Such views don't touch each other's texels, so they can be diffused from the same texture
+        state and back-projected in order afterwards. Returns lists of positions in the sequence.
+    """
+    if max_views <= 1:
+        return [[i] for i in range(len(face_indices_list))]
+
+    num_faces = max([int(face_indices.max()) + 1 for face_indices in face_indices_list if len(face_indices) > 0] + [1])
+    claimed = torch.zeros(num_faces, dtype=torch.bool)
+
+    groups = []
+    for i, face_indices in enumerate(face_indices_list):
+        face_indices = torch.as_tensor(face_indices).cpu()
+        if len(groups) == 0 or len(groups[-1]) >= max_views or claimed[face_indices].any():
+            groups.append([])
+            claimed.zero_()
+
+        groups[-1].append(i)
+        claimed[face_indices] = True
+
+    return groups
+
+
+def build_prompt(config, sector):
+    return " the {} view of {}".format(sector, config.prompt) if config.add_view_to_prompt else config.prompt
+
+
+def update_mesh_textures(mesh, faces, verts_uvs, init_texture, device):
+    texture_maps = transforms.ToTensor()(init_texture)[None, ...].permute(0, 2, 3, 1).to(device)
+    mesh.textures = TexturesUV(
+        maps=texture_maps,
+        faces_uvs=faces.textures_idx[None, ...],
+        verts_uvs=verts_uvs[None, ...]
+    )
+
+    return texture_maps
+
+
+# ---------------- PIPELINE ----------------------
+
+
+class TextureSynthesisPipeline:
+    """
+        Depth-conditioned texture synthesis on a mesh, split into stages:
+
+            pipeline = TextureSynthesisPipeline(device)
+            pipeline.load_models()
+            state = pipeline.prepare_mesh(mesh_config, render_config, output_dir)
+            pipeline.generate(state, diffusion_config)
+            pipeline.refine(state, diffusion_config, refine_config)
+            pipeline.post_process(state)
+
+        Models are loaded once and reused across meshes, the mesh is prepared from scratch
+        for every state (the xatlas parameterization is cached on disk by file content, see
+        `MeshConfig.cache_dir`). Wall-clock time of every stage is accumulated in `timings`.
+    """
+
+    def __init__(self, device, compile_mode="eager", vram_budget=None):
+        self.device = device
+        self.compile_mode = compile_mode # "eager", "compile" or "cuda_graph" for the denoising step
+        self.vram_budget = vram_budget # GB for the ControlNet weights, None -> everything resident
+
+        self.controlnet = None
+        self.ddim_sampler = None
+        self.samplers = {}
+        self.inpainting = None
+        self.latent_cache = LatentCache() # VAE encodings of the views, cleared for every mesh
+
+        self.timings = {}
+
+    @contextmanager
+    def _timed(self, stage):
+        start_time = time.time()
+        yield
+        elapsed = time.time() - start_time
+        self.timings[stage] = self.timings.get(stage, 0) + elapsed
+        print("=> {} time: {} s".format(stage, elapsed))
+
+    @contextmanager
+    def _timed_diffusion(self, state, kind, num_views=1):
+        start_time = time.time()
+        yield
+        elapsed = (time.time() - start_time) / num_views
+        state.diffusion_times[kind] += [elapsed] * num_views
+
+    def _skip_generate(self, state, config, quad_mask_tensor, stage, view_idx, hit):
+        """ cheap pre-check on the quad mask, skip the diffusion if (almost) nothing is new """
+        new_ratio = compute_new_ratio(quad_mask_tensor)
+        if new_ratio > 0 and new_ratio >= config.skip_threshold:
+            return False
+
+        print("=> skip generating for view {} hit {}: {:.2%} new pixels".format(view_idx, hit, new_ratio))
+        state.skipped_views.append((stage, "generate", view_idx, hit, new_ratio))
+
+        return True
+
+    def _latent_kwargs(self, config, key):
+        """ the generate and the update pass of a view share the key, so the second one reuses the VAE encoding """
+        if config.latent_cache == "off":
+            return {}
+
+        return {"latent_cache": self.latent_cache, "latent_key": key, "incremental_latents": config.latent_cache == "incremental"}
+
+    def print_skip_summary(self, state):
+        num_skipped, saved_time = state.skip_summary()
+        num_diffused = len(state.diffusion_times["generate"]) + len(state.diffusion_times["update"])
+        print("=> skipped {} of {} diffusion calls, saved ~{:.2f} s".format(num_skipped, num_skipped + num_diffused, saved_time))
+        for stage, kind, view_idx, hit, coverage in state.skipped_views:
+            print("=> {}: skipped {} for view {} hit {} ({:.2%} of the object)".format(stage, kind, view_idx, hit, coverage))
+
+    def print_latent_cache_summary(self):
+        latent_stats = self.latent_cache.stats()
+        print("=> latent cache: {} hits, {} partial hits, {} misses, {:.2%} hit rate".format(
+            latent_stats["hits"], latent_stats["partial_hits"], latent_stats["misses"], latent_stats["hit_rate"]))
+
+    def load_models(self):
+        """ the inpainting model is only loaded by `post_process`, a parked ControlNet is moved back to the GPU """
+        with self._timed("load_models"):
+            if self.controlnet is None:
+                CONDITIONING_CACHE.clear()
+                self.controlnet, self.ddim_sampler = get_controlnet_depth(self.compile_mode, self.vram_budget)
+            else:
+                self.controlnet.move_weights(self.device)
+
+    def get_sampler(self, name):
+        """ samplers are cheap wrappers around the loaded ControlNet, one per name """
+        if name == "ddim":
+            return self.ddim_sampler
+
+        if name not in self.samplers:
+            self.samplers[name] = init_sampler(self.controlnet, name)
+
+        return self.samplers[name]
+
+    def unload_controlnet(self):
+        self.controlnet = None
+        self.ddim_sampler = None
+        self.samplers = {}
+        CONDITIONING_CACHE.clear() # NOTE the cached conditioning would keep GPU tensors alive
+        torch.cuda.empty_cache()
+
+    def park_controlnet(self):
+        """ ControlNet to CPU memory, the next `load_models` moves it back instead of reloading the checkpoint """
+        self.controlnet.move_weights("cpu")
+        CONDITIONING_CACHE.clear()
+        torch.cuda.empty_cache()
+
+    def park_inpainting(self):
+        self.inpainting.to("cpu")
+        torch.cuda.empty_cache()
+
+    def prepare_mesh(self, mesh_config, render_config, output_dir):
+        with self._timed("prepare_mesh"):
+            os.makedirs(output_dir, exist_ok=True)
+            self.latent_cache.clear() # NOTE the keys are views of the previous mesh
+
+            mesh, _, faces, aux, principle_directions, mesh_center, mesh_scale = init_mesh(
+                mesh_config.input_path,
+                os.path.join(output_dir, os.path.basename(mesh_config.input_path)),
+                self.device,
+                cache_dir=get_cache_dir(mesh_config, "xatlas")
+            )
+
+            # gradient texture
+            init_texture = Image.open(mesh_config.init_texture_path).convert("RGB").resize((render_config.uv_size, render_config.uv_size))
+
+            # HACK adjust UVs for multiple materials
+            if mesh_config.use_multiple_objects:
+                verts_uvs, init_texture = adjust_uv_map(faces, aux, init_texture, render_config.uv_size)
+            else:
+                verts_uvs = aux.verts_uvs
+
+            # initialize viewpoints
+            # including: principle viewpoints for generation + refinement viewpoints for updating
+            viewpoints = init_viewpoints(mesh_config.viewpoint_mode, mesh_config.num_viewpoints, mesh_config.dist, mesh_config.elev, principle_directions,
+                use_principle=True,
+                use_shapenet=mesh_config.use_shapenet,
+                use_objaverse=mesh_config.use_objaverse,
+                hits=mesh_config.hits
+            )
+
+            # update the mesh
+            texture_maps = update_mesh_textures(mesh, faces, verts_uvs, init_texture, self.device)
+
+            # back-projected faces
+            exist_texture = torch.from_numpy(np.zeros([render_config.uv_size, render_config.uv_size]).astype(np.float32)).to(self.device)
+
+            state = TextureState(output_dir, mesh_config, render_config,
+                mesh, faces, aux, verts_uvs, mesh_center, mesh_scale,
+                init_texture, exist_texture, texture_maps,
+                [list(v) for v in viewpoints]
+            )
+
+        return state
+
+    def generate(self, state, config):
+        """ generate texture with RePaint from the principle viewpoints, NOTE no refinement """
+
+        self.controlnet.set_control_sharing(config.control_sharing)
+        with self._timed("generate"), self._correspondences(state) as correspondences:
+            self._generate(state, config, correspondences)
+
+    def _generate(self, state, config, correspondences):
+        render_config = state.render_config
+        hits = state.mesh_config.hits
+        dirs = init_stage_dirs(state.output_dir, "generate")
+
+        # prepare viewpoints and cache
+        num_principle = state.num_principle
+        pre_dist_list = state.dist_list[:num_principle]
+        pre_elev_list = state.elev_list[:num_principle]
+        pre_azim_list = state.azim_list[:num_principle]
+        pre_sector_list = state.sector_list[:num_principle]
+
+        camera_poses = [pre_elev_list, pre_azim_list, pre_dist_list]
+        xray_mesh = XRayMesh(state.mesh, camera_poses, device=self.device, max_hits=hits, texture_size=render_config.uv_size, new_verts_uvs=state.verts_uvs, faces=state.faces, texture_init_maps=state.texture_maps, raster_size=state.mesh_config.xray_size,
+            workers=state.mesh_config.xray_workers,
+            cache_dir=get_cache_dir(state.mesh_config, "xray"))
+        xray_meshes = xray_mesh.occ_mesh
+
+        pre_similarity_texture_cache = build_similarity_texture_cache_for_all_views(xray_meshes, state.faces, state.verts_uvs,
+            pre_dist_list, pre_elev_list, pre_azim_list,
+            render_config.image_size, render_config.image_size * render_config.render_simple_factor, render_config.uv_size, render_config.fragment_k,
+            self.device, hits=hits, xray_mesh=xray_mesh
+        )
+
+        # start generation
+        print("=> start generating texture...")
+        sequence = [(view_idx, hit) for hit in range(hits) for view_idx in range(num_principle)]
+        groups = group_disjoint_views([xray_mesh.mesh_face_indices_list[view_idx * hits + hit] for view_idx, hit in sequence], config.batch_views)
+        if config.batch_views > 1:
+            print("=> diffusing {} views in {} batches...".format(len(sequence), len(groups)))
+
+        for group in groups:
+            # 1.1. render and build masks
+            # NOTE all views of a group see the same texture state
+            views = []
+            for view_idx, hit in [sequence[i] for i in group]:
+                print("=> processing view {} hit {}...".format(view_idx, hit))
+
+                # sequentially pop the viewpoints
+                dist, elev, azim, sector = pre_dist_list[view_idx], pre_elev_list[view_idx], pre_azim_list[view_idx], pre_sector_list[view_idx]
+                prompt = build_prompt(config, sector)
+                print("=> generating image for prompt: {}...".format(prompt))
+
+                xray_mesh_selected = xray_meshes[view_idx * hits + hit]
+                faces = xray_mesh_selected.faces_packed()
+                textures_idx = xray_mesh.visible_texture_map_list[view_idx * hits + hit]
+
+                (
+                    view_score,
+                    renderer, cameras, fragments,
+                    init_image, normal_map, depth_map,
+                    init_images_tensor, normal_maps_tensor, depth_maps_tensor, similarity_tensor,
+                    keep_mask_image, update_mask_image, generate_mask_image,
+                    keep_mask_tensor, update_mask_tensor, generate_mask_tensor, all_mask_tensor, quad_mask_tensor,
+                ) = render_one_view_and_build_masks(dist, elev, azim,
+                    view_idx*hits+(hit), view_idx, state.view_punishments, # => actual view idx and the sequence idx
+                    pre_similarity_texture_cache, state.exist_texture,
+                    xray_mesh_selected, faces, state.verts_uvs,
+                    render_config.image_size, render_config.fragment_k,
+                    dirs["rendering"], dirs["mask"], dirs["normal"], dirs["depth"], dirs["similarity"],
+                    self.device, save_intermediate=True, smooth_mask=config.smooth_mask, view_threshold=config.view_threshold,
+                    textures_idx=textures_idx,
+                    hit=hit
+                )
+
+                # NOTE first view still gets the mask for consistent ablations
+                if config.no_repaint and (view_idx != 0 and hit != 0):
+                    actual_generate_mask_image = Image.fromarray((np.ones_like(np.array(generate_mask_image)) * 255.).astype(np.uint8))
+                else:
+                    actual_generate_mask_image = generate_mask_image
+
+                # skip the diffusion if (almost) nothing is new, the repaint ablation always generates
+                skip = actual_generate_mask_image is generate_mask_image and self._skip_generate(state, config, quad_mask_tensor, "generate", view_idx, hit)
+
+                views.append(dict(
+                    skip=skip, view_idx=view_idx, hit=hit, dist=dist, elev=elev, azim=azim, prompt=prompt,
+                    xray_mesh_selected=xray_mesh_selected, faces=faces, textures_idx=textures_idx,
+                    renderer=renderer, cameras=cameras, init_image=init_image, depth_map_np=depth_maps_tensor.permute(1, 2, 0).repeat(1, 1, 3).cpu().numpy(),
+                    keep_mask_image=keep_mask_image, update_mask_image=update_mask_image,
+                    actual_generate_mask_image=actual_generate_mask_image,
+                    generate_mask_tensor=generate_mask_tensor, update_mask_tensor=update_mask_tensor, all_mask_tensor=all_mask_tensor
+                ))
+
+            # 1.2. generate missing region
+            diffuse_views = [view for view in views if not view["skip"]]
+            if len(diffuse_views) == 0:
+                generate_results = []
+            elif len(diffuse_views) == 1:
+                view = diffuse_views[0]
+                print("=> generate for view {}".format(view["view_idx"]))
+                with self._timed_diffusion(state, "generate"):
+                    generate_results = [apply_controlnet_depth(self.controlnet, self.get_sampler(config.sampler),
+                        view["init_image"].convert("RGBA"), view["prompt"], config.new_strength, config.ddim_steps,
+                        view["actual_generate_mask_image"], view["keep_mask_image"], view["depth_map_np"],
+                        config.a_prompt, config.n_prompt, config.guidance_scale, config.seed, config.eta, 1, self.device, config.blend,
+                        crop_to_mask=config.crop_to_mask, **self._latent_kwargs(config, ("generate", view["view_idx"], view["hit"])))]
+            else:
+                print("=> generate for views {}".format([view["view_idx"] for view in diffuse_views]))
+                with self._timed_diffusion(state, "generate", len(diffuse_views)):
+                    generate_results = apply_controlnet_depth_batch(self.controlnet, self.get_sampler(config.sampler),
+                        [view["init_image"].convert("RGBA") for view in diffuse_views], [view["prompt"] for view in diffuse_views], config.new_strength, config.ddim_steps,
+                        [view["actual_generate_mask_image"] for view in diffuse_views], [view["keep_mask_image"] for view in diffuse_views], [view["depth_map_np"] for view in diffuse_views],
+                        config.a_prompt, config.n_prompt, config.guidance_scale, config.seed, config.eta, self.device, config.blend)
+
+            # back-project, update and save in the sequential order
+            generate_results = iter(generate_results)
+            for view in views:
+                if view["skip"]:
+                    # NOTE the rendering is kept as is, nothing gets back-projected
+                    generate_image = view["init_image"].convert("RGB")
+                    generate_image_before, generate_image_after = generate_image, generate_image
+                else:
+                    generate_image, generate_image_before, generate_image_after = next(generate_results)
+
+                self._finish_principle_view(state, config, dirs, xray_mesh, pre_similarity_texture_cache, correspondences, num_principle, view,
+                    generate_image, generate_image_before, generate_image_after)
+
+        # visualize viewpoints
+        visualize_principle_viewpoints(state.output_dir, pre_dist_list, pre_elev_list, pre_azim_list)
+
+    @contextmanager
+    def _correspondences(self, state):
+        """ correspondence cache of one stage, None if off, closed (memory-mapped files removed) even if the stage fails """
+        if state.mesh_config.correspondences == "off":
+            yield None
+            return
+
+        correspondences = CorrespondenceCache(self.device, state.mesh_config.correspondences)
+        try:
+            yield correspondences
+        finally:
+            correspondences.close()
+
+    def _get_correspondence(self, state, correspondences, key, mesh, textures_idx, cameras):
+        """ pixel -> texel map for `backproject_from_image`, None -> rasterize """
+        if correspondences is None:
+            return None
+
+        render_config = state.render_config
+        return correspondences.get(key, mesh, textures_idx, state.verts_uvs, cameras,
+            render_config.image_size * render_config.render_simple_factor, render_config.uv_size, render_config.fragment_k)
+
+    def _finish_principle_view(self, state, config, dirs, xray_mesh, pre_similarity_texture_cache, correspondences, num_principle, view,
+        generate_image, generate_image_before, generate_image_after):
+        render_config = state.render_config
+        hits = state.mesh_config.hits
+        view_idx, hit = view["view_idx"], view["hit"]
+        xray_mesh_selected, faces, textures_idx, cameras = view["xray_mesh_selected"], view["faces"], view["textures_idx"], view["cameras"]
+        update_mask_image, update_mask_tensor = view["update_mask_image"], view["update_mask_tensor"]
+        generate_mask_tensor = view["generate_mask_tensor"]
+
+        generate_image.save(os.path.join(dirs["inpainted"], "{}_{}.png".format(view_idx, hit)))
+        generate_image_before.save(os.path.join(dirs["inpainted"], "{}_{}_before.png".format(view_idx, hit)))
+        generate_image_after.save(os.path.join(dirs["inpainted"], "{}_{}_after.png".format(view_idx, hit)))
+
+        # 1.2.2 back-project and create texture
+        # NOTE projection mask = generate mask
+        state.init_texture, project_mask_image, state.exist_texture = backproject_from_image(
+            xray_mesh_selected, faces, state.verts_uvs, cameras,
+            generate_image, generate_mask_tensor, generate_mask_tensor, state.init_texture, state.exist_texture,
+            render_config.image_size * render_config.render_simple_factor, render_config.uv_size, render_config.fragment_k,
+            self.device, textures_idx,
+            correspondence=self._get_correspondence(state, correspondences, (view_idx, hit), xray_mesh_selected, textures_idx, cameras)
+        )
+
+        project_mask_image.save(os.path.join(dirs["mask"], "{}_project.png".format(view_idx)))
+
+        # update the mesh
+        state.texture_maps = self._update_textures(state, xray_mesh, num_principle)
+
+        # 1.2.3. re: render
+        # NOTE only the rendered image is needed - masks should be re-used
+        (
+            view_score,
+            renderer, cameras, fragments,
+            init_image, *_,
+        ) = render_one_view_and_build_masks(view["dist"], view["elev"], view["azim"],
+            view_idx*hits+hit, view_idx, state.view_punishments, # => actual view idx and the sequence idx
+            pre_similarity_texture_cache, state.exist_texture,
+            xray_mesh_selected, faces, state.verts_uvs,
+            render_config.image_size, render_config.fragment_k,
+            dirs["rendering"], dirs["mask"], dirs["normal"], dirs["depth"], dirs["similarity"],
+            self.device, save_intermediate=False, smooth_mask=config.smooth_mask, view_threshold=config.view_threshold,
+            textures_idx=textures_idx,
+            hit=hit
+        )
+
+        # 1.3. update blurry region
+        # only when: 1) use update flag; 2) there are contents to update; 3) there are enough contexts.
+        if not config.no_update and update_mask_tensor.sum() > 0 and update_mask_tensor.sum() / (view["all_mask_tensor"].sum()) > 0.05:
+            print("=> update {} pixels for view {}".format(update_mask_tensor.sum().int(), view_idx))
+            with self._timed_diffusion(state, "update"):
+                diffused_image, diffused_image_before, diffused_image_after = apply_controlnet_depth(self.controlnet, self.get_sampler(config.sampler),
+                    init_image.convert("RGBA"), view["prompt"], config.update_strength, config.ddim_steps,
+                    update_mask_image, view["keep_mask_image"], view["depth_map_np"],
+                    config.a_prompt, config.n_prompt, config.guidance_scale, config.seed, config.eta, 1, self.device, config.blend,
+                    crop_to_mask=config.crop_to_mask, **self._latent_kwargs(config, ("generate", view_idx, hit)))
+
+            diffused_image.save(os.path.join(dirs["inpainted"], "{}_{}_update.png".format(view_idx, hit)))
+            diffused_image_before.save(os.path.join(dirs["inpainted"], "{}_{}_update_before.png".format(view_idx, hit)))
+            diffused_image_after.save(os.path.join(dirs["inpainted"], "{}_{}_update_after.png".format(view_idx, hit)))
+
+            # 1.3.2. back-project and create texture
+            # NOTE projection mask = generate mask
+            state.init_texture, project_mask_image, state.exist_texture = backproject_from_image(
+                xray_mesh_selected, faces, state.verts_uvs, cameras,
+                diffused_image, update_mask_tensor, update_mask_tensor, state.init_texture, state.exist_texture,
+                render_config.image_size * render_config.render_simple_factor, render_config.uv_size, render_config.fragment_k,
+                self.device, textures_idx,
+                correspondence=self._get_correspondence(state, correspondences, (view_idx, hit), xray_mesh_selected, textures_idx, cameras)
+            )
+
+            # update the mesh
+            state.texture_maps = self._update_textures(state, xray_mesh, num_principle)
+        elif not config.no_update:
+            state.skipped_views.append(("generate", "update", view_idx, hit, (update_mask_tensor.sum() / view["all_mask_tensor"].sum().clamp(min=1)).item()))
+
+        # 1.4. save generated assets
+        self._save_step(state, dirs, xray_mesh_selected, renderer, view_idx, hit)
+
+    def refine(self, state, config, refine_config):
+        """ update texture with RePaint from the heuristically selected viewpoints """
+
+        if refine_config.update_steps <= 0:
+            return
+
+        self.controlnet.set_control_sharing(config.control_sharing)
+        with self._timed("refine"), self._correspondences(state) as correspondences:
+            self._refine(state, config, refine_config, correspondences)
+
+    def _refine(self, state, config, refine_config, correspondences):
+        render_config = state.render_config
+        hits = state.mesh_config.hits
+        dirs = init_stage_dirs(state.output_dir, "update")
+
+        num_principle = state.num_principle
+        dist_list = state.dist_list[num_principle:]
+        elev_list = state.elev_list[num_principle:]
+        azim_list = state.azim_list[num_principle:]
+        sector_list = state.sector_list[num_principle:]
+        view_punishments = state.view_punishments[num_principle:]
+
+        state.texture_maps = update_mesh_textures(state.mesh, state.faces, state.verts_uvs, state.init_texture, self.device)
+
+        camera_poses = [elev_list, azim_list, dist_list]
+        xray_mesh = XRayMesh(state.mesh, camera_poses, device=self.device, max_hits=hits, texture_size=render_config.uv_size, new_verts_uvs=state.verts_uvs, faces=state.faces, texture_init_maps=state.texture_maps, raster_size=state.mesh_config.xray_size,
+            workers=state.mesh_config.xray_workers,
+            cache_dir=get_cache_dir(state.mesh_config, "xray"))
+        xray_meshes = xray_mesh.occ_mesh
+
+        similarity_texture_cache = build_similarity_texture_cache_for_all_views(xray_meshes, state.faces, state.verts_uvs,
+            dist_list, elev_list, azim_list,
+            render_config.image_size, render_config.image_size * render_config.render_simple_factor, render_config.uv_size, render_config.fragment_k,
+            self.device, hits=hits, xray_mesh=xray_mesh
+        )
+        selected_view_ids = []
+
+        # NOTE candidates are scored on the whole mesh, like `select_viewpoint` renders them
+        scoring_engine = None
+        if refine_config.update_mode == "heuristic":
+            scoring_engine = ViewScoringEngine(state.mesh, state.faces, state.verts_uvs,
+                dist_list, elev_list, azim_list,
+                render_config.image_size, render_config.uv_size, render_config.fragment_k,
+                self.device
+            )
+
+        print("=> start updating...")
+        for view_idx in range(refine_config.update_steps):
+            print("=> processing view {}...".format(view_idx))
+            # 2.1. render and build masks
+
+            # heuristically select the viewpoints
+            dist, elev, azim, sector, selected_view_ids, view_punishments, selected_hit = select_viewpoint(
+                selected_view_ids, view_punishments,
+                refine_config.update_mode, dist_list, elev_list, azim_list, sector_list, view_idx,
+                similarity_texture_cache, state.exist_texture,
+                state.mesh, state.faces, state.verts_uvs,
+                render_config.image_size, render_config.fragment_k,
+                dirs["rendering"], dirs["mask"], dirs["normal"], dirs["depth"], dirs["similarity"],
+                self.device, False, scoring_engine=scoring_engine
+            )
+
+            selected_idx = selected_view_ids[-1] * hits + selected_hit
+            xray_mesh_selected = xray_meshes[selected_idx]
+            textures_idx = xray_mesh.visible_texture_map_list[selected_idx]
+            (
+                view_score,
+                renderer, cameras, fragments,
+                init_image, normal_map, depth_map,
+                init_images_tensor, normal_maps_tensor, depth_maps_tensor, similarity_tensor,
+                old_mask_image, update_mask_image, generate_mask_image,
+                old_mask_tensor, update_mask_tensor, generate_mask_tensor, all_mask_tensor, quad_mask_tensor,
+            ) = render_one_view_and_build_masks(dist, elev, azim,
+                selected_idx, view_idx, view_punishments, # => actual view idx and the sequence idx
+                similarity_texture_cache, state.exist_texture,
+                xray_mesh_selected, state.faces, state.verts_uvs,
+                render_config.image_size, render_config.fragment_k,
+                dirs["rendering"], dirs["mask"], dirs["normal"], dirs["depth"], dirs["similarity"],
+                self.device, save_intermediate=True, smooth_mask=config.smooth_mask, view_threshold=config.view_threshold,
+                textures_idx=textures_idx, hit=selected_hit
+            )
+
+            # 2.2. update existing region
+            prompt = build_prompt(config, sector)
+            print("=> updating image for prompt: {}...".format(prompt))
+
+            if not config.no_update and update_mask_tensor.sum() > 0 and update_mask_tensor.sum() / (all_mask_tensor.sum()) > 0.05:
+                print("=> update {} pixels for view {}".format(update_mask_tensor.sum().int(), view_idx))
+                with self._timed_diffusion(state, "update"):
+                    update_image, update_image_before, update_image_after = apply_controlnet_depth(self.controlnet, self.get_sampler(config.sampler),
+                        init_image.convert("RGBA"), prompt, config.update_strength, config.ddim_steps,
+                        update_mask_image, old_mask_image, depth_maps_tensor.permute(1, 2, 0).repeat(1, 1, 3).cpu().numpy(),
+                        config.a_prompt, config.n_prompt, config.guidance_scale, config.seed, config.eta, 1, self.device, config.blend,
+                        crop_to_mask=config.crop_to_mask, **self._latent_kwargs(config, ("update", selected_idx)))
+
+                update_image.save(os.path.join(dirs["inpainted"], "{}.png".format(view_idx)))
+                update_image_before.save(os.path.join(dirs["inpainted"], "{}_before.png".format(view_idx)))
+                update_image_after.save(os.path.join(dirs["inpainted"], "{}_after.png".format(view_idx)))
+            else:
+                print("=> nothing to update for view {}".format(view_idx))
+                update_image = init_image
+                if not config.no_update:
+                    state.skipped_views.append(("update", "update", view_idx, selected_hit, (update_mask_tensor.sum() / all_mask_tensor.sum().clamp(min=1)).item()))
+
+                old_mask_tensor += update_mask_tensor
+                update_mask_tensor[update_mask_tensor == 1] = 0 # HACK nothing to update
+
+            # 2.3. back-project and create texture
+            # NOTE projection mask = update mask
+            state.init_texture, project_mask_image, state.exist_texture, texels = backproject_from_image(
+                xray_mesh_selected, state.faces, state.verts_uvs, cameras,
+                update_image, update_mask_tensor, update_mask_tensor, state.init_texture, state.exist_texture,
+                render_config.image_size * render_config.render_simple_factor, render_config.uv_size, render_config.fragment_k,
+                self.device, textures_idx, return_texels=True,
+                correspondence=self._get_correspondence(state, correspondences, selected_idx, xray_mesh_selected, textures_idx, cameras)
+            )
+            if scoring_engine is not None:
+                scoring_engine.update_texels(texels, state.exist_texture)
+
+            project_mask_image.save(os.path.join(dirs["mask"], "{}_{}_project.png".format(view_idx, selected_hit)))
+
+            # update the mesh
+            state.texture_maps = self._update_textures(state, xray_mesh, len(dist_list))
+
+            # 2.4. save generated assets
+            self._save_step(state, dirs, state.mesh, renderer, view_idx, selected_hit)
+
+            state.last_view_idx = view_idx
+
+        # save viewpoints
+        save_viewpoints(None, state.output_dir, dist_list, elev_list, azim_list, selected_view_ids)
+
+        # visualize viewpoints
+        visualize_refinement_viewpoints(state.output_dir, selected_view_ids, dist_list, elev_list, azim_list)
+
+    def post_process(self, state, keep_models=False):
+        """
+            inpaint the texels that have never been back-projected
+
+            By default ControlNet and the inpainting model are swapped, only one of them is on
+            the GPU at a time and the other one is parked in CPU memory (~5.7 GB for ControlNet,
+            ~2.6 GB for the fp16 SD 2 inpainting weights), the next `load_models` moves ControlNet
+            back. `keep_models` keeps both in VRAM, which skips the copies but can run out of memory
+            on a 2080.
+        """
+
+        with self._timed("post_process"):
+            if not keep_models and self.controlnet is not None:
+                # free the VRAM of ControlNet before moving in the inpainting model
+                self.park_controlnet()
+
+            if self.inpainting is None:
+                self.inpainting = get_inpainting(self.device)
+            else:
+                self.inpainting.to(self.device)
+
+            uv_size = state.render_config.uv_size
+            post_texture = apply_inpainting_postprocess(self.inpainting,
+                state.init_texture, 1-state.exist_texture[None, :, :, None], "", uv_size, uv_size, self.device)
+
+            mesh_dir = os.path.join(state.output_dir, "update", "mesh")
+            os.makedirs(mesh_dir, exist_ok=True)
+            save_backproject_obj(
+                mesh_dir, "{}_post.obj".format(state.last_view_idx),
+                state.output_verts(),
+                state.faces.verts_idx, state.verts_uvs, state.faces.textures_idx, post_texture,
+                self.device
+            )
+
+            if not keep_models:
+                self.park_inpainting()
+
+        return post_texture
+
+    def _update_textures(self, state, xray_mesh, num_views):
+        texture_maps = update_mesh_textures(state.mesh, state.faces, state.verts_uvs, state.init_texture, self.device)
+        xray_mesh.textures = TexturesUV(
+            maps=texture_maps.repeat(num_views * state.mesh_config.hits, 1, 1, 1),
+            faces_uvs=xray_mesh.visible_texture_map_list,
+            verts_uvs=[state.verts_uvs] * num_views * state.mesh_config.hits
+        )
+
+        return texture_maps
+
+    def _save_step(self, state, dirs, mesh, renderer, view_idx, hit):
+        # save backprojected OBJ file
+        save_backproject_obj(
+            dirs["mesh"], "{}_{}.obj".format(view_idx, hit),
+            state.output_verts(),
+            state.faces.verts_idx, state.verts_uvs, state.faces.textures_idx, state.init_texture,
+            self.device
+        )
+
+        # save the intermediate view
+        inter_images_tensor, *_ = render(mesh, renderer)
+        inter_image = inter_images_tensor[0].cpu()
+        inter_image = inter_image.permute(2, 0, 1)
+        inter_image = transforms.ToPILImage()(inter_image).convert("RGB")
+        inter_image.save(os.path.join(dirs["intermediate"], "{}_{}.png".format(view_idx, hit)))
+
+        # save texture mask
+        exist_texture_image = state.exist_texture * 255.
+        exist_texture_image = Image.fromarray(exist_texture_image.cpu().numpy().astype(np.uint8)).convert("L")
+        exist_texture_image.save(os.path.join(dirs["mesh"], "{}_{}_texture_mask.png".format(view_idx, hit)))
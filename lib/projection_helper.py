@@ -1,5 +1,6 @@
 import os
 import torch
+import tempfile
 
 import cv2
 import random
@@ -8,12 +9,17 @@ import numpy as np
 
 from torchvision import transforms
 
-from pytorch3d.renderer import TexturesUV
+from pytorch3d.structures import Meshes
+from pytorch3d.renderer import (
+    RasterizationSettings,
+    MeshRasterizer
+)
 from pytorch3d.ops import interpolate_face_attributes
 
 from PIL import Image
 
 from tqdm import tqdm
+from collections import OrderedDict
 
 # customized
 import sys
@@ -24,7 +30,6 @@ from lib.render_helper import init_renderer, render
 from lib.shading_helper import (
     BlendParams,
     init_soft_phong_shader, 
-    init_flat_texel_shader,
 )
 from lib.vis_helper import visualize_outputs, visualize_quad_mask
 from lib.constants import *
@@ -39,7 +44,32 @@ def get_all_4_locations(values_y, values_x):
     return torch.cat([y_0, y_0, y_1, y_1], 0).long(), torch.cat([x_0, x_1, x_0, x_1], 0).long()
 
 
+def mask_image_to_tensor(mask, device):
+    """ (1, H, W) float mask on `device`, from a PIL mask or a mask tensor """
+    if isinstance(mask, torch.Tensor):
+        return mask.to(device).float().reshape(1, *mask.shape[-2:])
+
+    return transforms.ToTensor()(mask).to(device)
+
+
+def mask_tensor_to_image(mask_tensor):
+    """ PIL "L" mask (0 / 255) of a (1, H, W) or (H, W) mask tensor, only for saving and diffusion """
+    mask_tensor = mask_tensor.reshape(mask_tensor.shape[-2:])
+
+    return Image.fromarray(((mask_tensor > 0).byte() * 255).cpu().numpy())
+
+
 def compose_quad_mask(new_mask_image, update_mask_image, old_mask_image, device):
+    """ `compose_quad_mask_tensors` of PIL masks """
+
+    return compose_quad_mask_tensors(
+        mask_image_to_tensor(new_mask_image, device),
+        mask_image_to_tensor(update_mask_image, device),
+        mask_image_to_tensor(old_mask_image, device)
+    )
+
+
+def compose_quad_mask_tensors(new_mask_tensor, update_mask_tensor, old_mask_tensor):
     """
         compose quad mask:
             -> 0: background
@@ -48,10 +78,6 @@ def compose_quad_mask(new_mask_image, update_mask_image, old_mask_image, device)
             -> 3: new
     """
 
-    new_mask_tensor = transforms.ToTensor()(new_mask_image).to(device)
-    update_mask_tensor = transforms.ToTensor()(update_mask_image).to(device)
-    old_mask_tensor = transforms.ToTensor()(old_mask_image).to(device)
-
     all_mask_tensor = new_mask_tensor + update_mask_tensor + old_mask_tensor
 
     quad_mask_tensor = torch.zeros_like(all_mask_tensor)
@@ -71,6 +97,15 @@ def compute_view_heat(similarity_tensor, quad_mask_tensor):
     return heat
 
 
+def compute_new_ratio(quad_mask_tensor):
+    """ fraction of the object pixels that are new, i.e. to be generated """
+    num_object_pixels = (quad_mask_tensor > 0).sum().item()
+    if num_object_pixels == 0:
+        return 0.
+
+    return (quad_mask_tensor == 3).sum().item() / num_object_pixels
+
+
 def select_viewpoint(selected_view_ids, view_punishments,
     mode, dist_list, elev_list, azim_list, sector_list, view_idx,
     similarity_texture_cache, exist_texture,
@@ -79,8 +114,10 @@ def select_viewpoint(selected_view_ids, view_punishments,
     init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
     device, use_principle=False,
     hits=1,
-    xray_mesh=None
+    xray_mesh=None,
+    scoring_engine=None
 ):
+    """ `scoring_engine` (a `ViewScoringEngine`) scores all heuristic candidates at once instead of rendering each of them """
     if mode == "sequential":
         
         num_views = len(dist_list)
@@ -106,23 +143,32 @@ def select_viewpoint(selected_view_ids, view_punishments,
 
             print("=> selecting next view...")
             view_heat_list = []
-            for hit in range(hits):
-                for sample_idx in tqdm(range(len(dist_list))):
-                    mesh = xray_mesh[hits * sample_idx + hit] if xray_mesh is not None else mesh
-                    view_heat, *_ = render_one_view_and_build_masks(dist_list[sample_idx], elev_list[sample_idx], azim_list[sample_idx], 
-                        sample_idx, sample_idx, view_punishments,
-                        similarity_texture_cache, exist_texture,
-                        mesh, faces, verts_uvs,
-                        image_size, faces_per_pixel,
-                        init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
-                        device)
-
-                    if view_heat > max_heat:
-                        selected_view_idx = sample_idx
-                        selected_hit = hit
-                        max_heat = view_heat
-
-                    view_heat_list.append(view_heat.item())
+            if scoring_engine is not None:
+                # NOTE same visiting order as below (hit-major), the first maximum wins
+                view_heat = scoring_engine.score(exist_texture, similarity_texture_cache, view_punishments).T.reshape(-1)
+                view_heat_list = view_heat.tolist()
+                max_idx = int(view_heat.argmax())
+                if view_heat_list[max_idx] > max_heat:
+                    selected_hit, selected_view_idx = divmod(max_idx, len(dist_list))
+                    max_heat = view_heat_list[max_idx]
+            else:
+                for hit in range(hits):
+                    for sample_idx in tqdm(range(len(dist_list))):
+                        mesh = xray_mesh[hits * sample_idx + hit] if xray_mesh is not None else mesh
+                        view_heat, *_ = render_one_view_and_build_masks(dist_list[sample_idx], elev_list[sample_idx], azim_list[sample_idx], 
+                            sample_idx, sample_idx, view_punishments,
+                            similarity_texture_cache, exist_texture,
+                            mesh, faces, verts_uvs,
+                            image_size, faces_per_pixel,
+                            init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
+                            device, build_images=False)
+
+                        if view_heat > max_heat:
+                            selected_view_idx = sample_idx
+                            selected_hit = hit
+                            max_heat = view_heat
+
+                        view_heat_list.append(view_heat.item())
 
             print(view_heat_list)
             print("select view {}, hit {} with heat {}".format(selected_view_idx, selected_hit, max_heat))
@@ -154,122 +200,136 @@ def select_viewpoint(selected_view_ids, view_punishments,
     return dist, elev, azim, sector, selected_view_ids, view_punishments, selected_hit
 
 
+# max number of pixels rasterized at once when building the similarity cache
+# NOTE ~150B per pixel with faces_per_pixel=1, tune down for small GPUs
+SIMILARITY_BATCH_PIXELS = 2 ** 24
+
+
+def erode_mask(mask_tensor, iterations=2):
+    """ 3x3 binary erosion of (N, 1, H, W), same as cv2.erode (the border does not erode) """
+    for _ in range(iterations):
+        mask_tensor = -torch.nn.functional.max_pool2d(-mask_tensor, kernel_size=3, stride=1, padding=1)
+
+    return mask_tensor
+
+
 @torch.no_grad()
-def build_backproject_mask(mesh, faces, verts_uvs, 
-    cameras, reference_image, faces_per_pixel, 
-    image_size, uv_size, device, textures_idx=None):
-    # construct pixel UVs
-    renderer_scaled = init_renderer(cameras,
-        shader=init_soft_phong_shader(
-            camera=cameras,
-            blend_params=BlendParams(),
-            device=device),
-        image_size=image_size, 
-        faces_per_pixel=faces_per_pixel
+def render_similarity_maps(meshes, cameras, image_size, faces_per_pixel, return_fragments=False):
+    """ 
+        batched version of the similarity shading + erosion in `render`, no shading of the images
+        returns the (N, 1, H, W) similarity maps (and the fragments), mesh i is seen from camera i
+    """
+    rasterizer = MeshRasterizer(
+        cameras=cameras,
+        raster_settings=RasterizationSettings(image_size=image_size, faces_per_pixel=faces_per_pixel)
     )
-    fragments_scaled = renderer_scaled.rasterizer(mesh)
+    fragments = rasterizer(meshes)
 
-    # get UV coordinates for each pixel
-    if textures_idx is None:
-        textures_idx = faces.textures_idx
-    faces_verts_uvs = verts_uvs[textures_idx]
+    faces = meshes.faces_packed()  # (F, 3)
+    faces_normals = meshes.verts_normals_packed()[faces]
+    face_positions = meshes.verts_packed()[faces]
+    camera_centers = cameras.get_camera_center()[meshes.faces_packed_to_mesh_idx()] # (F, 3)
+    view_directions = torch.nn.functional.normalize(camera_centers.unsqueeze(1) - face_positions, p=2, dim=2)
+    cosine_similarity = torch.nn.CosineSimilarity(dim=2)(faces_normals, view_directions)
+    similarity_maps = interpolate_face_attributes(
+        fragments.pix_to_face, fragments.bary_coords, cosine_similarity.unsqueeze(-1)
+    )[..., 0, 0] # N, H, W
+
+    # normalize similarity mask to 0 - 1 
+    similarity_maps = torch.abs(similarity_maps).unsqueeze(1)
+
+    # HACK erode, eliminate isolated dots
+    similarity_maps = erode_mask((similarity_maps > 0).float()) * similarity_maps
+
+    if return_fragments:
+        return similarity_maps, fragments
+
+    return similarity_maps
+
+
+@torch.no_grad()
+def build_backproject_masks(meshes, textures_idx_list, verts_uvs, 
+    cameras, reference_tensor, faces_per_pixel, 
+    image_size, uv_size, texture_tensor):
+    """
+        batched back-projection of (N, 1, H, W) per-view values to the UV space of each mesh,
+        written in-place to `texture_tensor` (N, uv_size, uv_size)
+    """
+    rasterizer = MeshRasterizer(
+        cameras=cameras,
+        raster_settings=RasterizationSettings(image_size=image_size, faces_per_pixel=faces_per_pixel)
+    )
+    fragments_scaled = rasterizer(meshes)
 
+    # get UV coordinates for each pixel, `pix_to_face` indexes the packed faces
+    faces_verts_uvs = verts_uvs[torch.cat(textures_idx_list)]
     pixel_uvs = interpolate_face_attributes(
         fragments_scaled.pix_to_face, fragments_scaled.bary_coords, faces_verts_uvs
     )  # NxHsxWsxKx2
-    pixel_uvs = pixel_uvs.permute(0, 3, 1, 2, 4).reshape(-1, 2)
+
+    # NOTE only the covered pixels are scattered, the background used to land on texel (uv_size-1, 0)
+    covered = fragments_scaled.pix_to_face >= 0 # NxHsxWsxK
+    view_ids, pixel_y, pixel_x, _ = torch.nonzero(covered, as_tuple=True)
+    pixel_uvs = pixel_uvs[covered]
+    values = reference_tensor[view_ids, 0, pixel_y, pixel_x]
 
     texture_locations_y, texture_locations_x = get_all_4_locations(
-        (1 - pixel_uvs[:, 1]).reshape(-1) * (uv_size - 1),
-        pixel_uvs[:, 0].reshape(-1) * (uv_size - 1)
+        (1 - pixel_uvs[:, 1]) * (uv_size - 1),
+        pixel_uvs[:, 0] * (uv_size - 1)
     )
+    texture_locations = (view_ids.repeat(4) * uv_size + texture_locations_y) * uv_size + texture_locations_x
+    texture_tensor.view(-1)[texture_locations] = values.repeat(4)
 
-    K = faces_per_pixel
+    return texture_tensor
 
-    texture_values = torch.from_numpy(np.array(reference_image.resize((image_size, image_size)))).float() / 255.
-    texture_values = texture_values.to(device).unsqueeze(0).expand([4, -1, -1, -1]).unsqueeze(0).expand([K, -1, -1, -1, -1])
 
-    # texture
-    texture_tensor = torch.zeros(uv_size, uv_size, 3).to(device)
-    texture_tensor[texture_locations_y, texture_locations_x, :] = texture_values.reshape(-1, 3)
+def get_pixel_texels(fragments, verts_uvs, textures_idx, uv_size):
+    """
+        flat index (y * uv_size + x) of the texel under each pixel of the first face layer, -1 on the background
+        same texel as `TexturesUV(sampling_mode="nearest")` samples: align_corners, border padding, flipped rows
+    """
+    pix_to_face = fragments.pix_to_face[..., :1]
+    pixel_uvs = interpolate_face_attributes(
+        pix_to_face, fragments.bary_coords[..., :1, :], verts_uvs[textures_idx]
+    )[..., 0, :] # N, H, W, 2
+
+    # NOTE same arithmetic as `grid_sample`, so that the rounding ties match
+    texel_coords = (((pixel_uvs * 2. - 1.) + 1) / 2 * (uv_size - 1)).clamp(0, uv_size - 1).round().long()
+    texels = (uv_size - 1 - texel_coords[..., 1]) * uv_size + texel_coords[..., 0]
+    texels[pix_to_face[..., 0] < 0] = -1
 
-    return texture_tensor[:, :, 0]
+    return texels
 
 
 @torch.no_grad()
-def build_diffusion_mask(mesh_stuff, 
-    renderer, exist_texture, similarity_texture_cache, target_value, device, image_size, 
-    smooth_mask=False, view_threshold=0.01, textures_idx=None
+def build_diffusion_mask_from_fragments(fragments, similarity_tensor, 
+    exist_texture, similarity_texture_cache, target_value, 
+    verts_uvs, textures_idx, view_threshold=0.01
     ):
+    """
+        diffusion masks of a view from the fragments of `render_one_view`:
+        one lookup of the per-pixel texels in a packed texture (bit 0: exist, bits 1-: best view id)
 
-    mesh, faces, verts_uvs = mesh_stuff
-    mask_mesh = mesh.clone() # NOTE in-place operation - DANGER!!!
-    
-    if textures_idx is None:
-        textures_idx = faces.textures_idx
-
-    # visible mask => the whole region
-    exist_texture_expand = exist_texture.unsqueeze(0).unsqueeze(-1).expand(-1, -1, -1, 3).to(device)
-    mask_mesh.textures = TexturesUV(
-        maps=torch.ones_like(exist_texture_expand),
-        faces_uvs=textures_idx[None, ...],
-        verts_uvs=verts_uvs[None, ...],
-        sampling_mode="nearest"
-    )
-    # visible_mask_tensor, *_ = render(mask_mesh, renderer)
-    visible_mask_tensor, _, similarity_map_tensor, *_ = render(mask_mesh, renderer)
-    # faces that are too rotated away from the viewpoint will be treated as invisible
-    valid_mask_tensor = (similarity_map_tensor >= view_threshold).float()
-    visible_mask_tensor *= valid_mask_tensor
-
-    # nonexist mask <=> new mask
-    exist_texture_expand = exist_texture.unsqueeze(0).unsqueeze(-1).expand(-1, -1, -1, 3).to(device)
-    mask_mesh.textures = TexturesUV(
-        maps=1 - exist_texture_expand,
-        faces_uvs=textures_idx[None, ...],
-        verts_uvs=verts_uvs[None, ...],
-        sampling_mode="nearest"
-    )
-    new_mask_tensor, *_ = render(mask_mesh, renderer)
-    new_mask_tensor *= valid_mask_tensor
-
-    # exist mask => visible mask - new mask
-    exist_mask_tensor = visible_mask_tensor - new_mask_tensor
-    exist_mask_tensor[exist_mask_tensor < 0] = 0 # NOTE dilate can lead to overflow
-
-    # all update mask
-    mask_mesh.textures = TexturesUV(
-        maps=(
-            similarity_texture_cache.argmax(0) == target_value
-            # # only consider the views that have already appeared before
-            # similarity_texture_cache[0:target_value+1].argmax(0) == target_value
-        ).float().unsqueeze(0).unsqueeze(-1).expand(-1, -1, -1, 3).to(device),
-        faces_uvs=textures_idx[None, ...],
-        verts_uvs=verts_uvs[None, ...],
-        sampling_mode="nearest"
-    )
-    all_update_mask_tensor, *_ = render(mask_mesh, renderer)
-
-    # current update mask => intersection between all update mask and exist mask
-    update_mask_tensor = exist_mask_tensor * all_update_mask_tensor
-
-    # keep mask => exist mask - update mask
-    old_mask_tensor = exist_mask_tensor - update_mask_tensor
+        returns the new, update, old and exist masks as (1, H, W) float tensors on the device,
+        see `mask_tensor_to_image` for the PIL masks
+    """
 
-    # convert
-    new_mask = new_mask_tensor[0].cpu().float().permute(2, 0, 1)
-    new_mask = transforms.ToPILImage()(new_mask).convert("L")
+    uv_size = exist_texture.shape[0]
+    pixel_texels = get_pixel_texels(fragments, verts_uvs, textures_idx, uv_size)[0] # H, W
+    covered = pixel_texels >= 0
 
-    update_mask = update_mask_tensor[0].cpu().float().permute(2, 0, 1)
-    update_mask = transforms.ToPILImage()(update_mask).convert("L")
+    lookup_texture = (similarity_texture_cache.index.int() << 1) | (exist_texture > 0).int()
+    pixel_codes = lookup_texture.view(-1)[pixel_texels.clamp(min=0)]
 
-    old_mask = old_mask_tensor[0].cpu().float().permute(2, 0, 1)
-    old_mask = transforms.ToPILImage()(old_mask).convert("L")
+    # faces that are too rotated away from the viewpoint will be treated as invisible
+    visible_mask_tensor = covered & (similarity_tensor[0, :, :, 0] >= view_threshold)
 
-    exist_mask = exist_mask_tensor[0].cpu().float().permute(2, 0, 1)
-    exist_mask = transforms.ToPILImage()(exist_mask).convert("L")
+    exist_mask_tensor = visible_mask_tensor & (pixel_codes & 1).bool()
+    new_mask_tensor = visible_mask_tensor & ~exist_mask_tensor
+    update_mask_tensor = exist_mask_tensor & ((pixel_codes >> 1) == target_value)
+    old_mask_tensor = exist_mask_tensor & ~update_mask_tensor
 
-    return new_mask, update_mask, old_mask, exist_mask
+    return [mask_tensor.float().unsqueeze(0) for mask_tensor in [new_mask_tensor, update_mask_tensor, old_mask_tensor, exist_mask_tensor]]
 
 
 @torch.no_grad()
@@ -300,6 +360,45 @@ def render_one_view(mesh,
     )
 
 
+class SimilarityTextureCache:
+    """
+        Per-texel argmax over the similarity textures of all views, i.e. which view sees each texel best.
+        Replaces the dense (num_views, uv_size, uv_size) float32 cache, that was only consumed
+        through `argmax(0) == target_value`.
+
+        The views are added in increasing order, a texel only switches view on a strictly larger
+        similarity so ties resolve to the first view like `argmax`.
+    """
+    def __init__(self, num_views, uv_size, device):
+        self.num_views = num_views
+        self.uv_size = uv_size
+        self.device = device
+
+        index_dtype = torch.uint8 if num_views <= 256 else torch.int16
+        self.index = torch.zeros(uv_size, uv_size, dtype=index_dtype, device=device)
+        # NOTE float32 while building, compacted to float16 once all views are in
+        self.value = torch.zeros(uv_size, uv_size, dtype=torch.float32, device=device)
+
+    def update(self, start_view, similarity_textures):
+        """ add the (N, uv_size, uv_size) similarity textures of views start_view ... start_view+N-1 """
+        for i, similarity_texture in enumerate(similarity_textures):
+            better = similarity_texture > self.value
+            self.index[better] = start_view + i
+            self.value[better] = similarity_texture[better].to(self.value.dtype)
+
+    def compact(self):
+        self.value = self.value.half()
+
+        return self
+
+    def view_mask(self, view_idx):
+        """ texels best seen from `view_idx`, same as `similarity_texture_cache.argmax(0) == view_idx` """
+        return self.index == view_idx
+
+    def nbytes(self):
+        return self.index.element_size() * self.index.numel() + self.value.element_size() * self.value.numel()
+
+
 @torch.no_grad()
 def build_similarity_texture_cache_for_all_views(meshes, faces, verts_uvs,
     dist_list, elev_list, azim_list,
@@ -310,33 +409,185 @@ def build_similarity_texture_cache_for_all_views(meshes, faces, verts_uvs,
     ):
 
     num_candidate_views = len(dist_list)
-    similarity_texture_cache = torch.zeros(num_candidate_views*hits, uv_size, uv_size).to(device)
+    num_meshes = num_candidate_views * hits
+    similarity_texture_cache = SimilarityTextureCache(num_meshes, uv_size, device)
     
     print(f"Number of Meshes: {len(meshes)}")
 
+    # NOTE mesh i*hits+j is hit layer j seen from view i, a single mesh is shared by all views
+    verts_list, faces_list = meshes.verts_list(), meshes.faces_list()
+    mesh_ids = list(range(num_meshes)) if len(meshes) > 1 else [0] * num_meshes
+    if xray_mesh is not None:
+        textures_idx_list = [xray_mesh.visible_texture_map_list[k] for k in range(num_meshes)]
+    else:
+        textures_idx_list = [faces.textures_idx] * num_meshes
+
     print("=> building similarity texture cache for all views...")
-    for i in tqdm(range(num_candidate_views)):
-        for j in range(hits):
-            print(f"Processing view {i} hit {j}")
-            mesh = meshes[i*hits+j]
-            textures_idx = None
-            if hits > 1 and xray_mesh is not None:
-                # faces = meshes[j].faces_packed()
-                faces = None
-                # textures_idx = mesh.textures.faces_uvs_packed()
-                textures_idx = xray_mesh.visible_texture_map_list[i * hits + j]
-            # else:
-                # mesh = meshes
-                # textures_idx = None
-            cameras, _, _, _, similarity_tensor, _, _ = render_one_view(mesh,
-                dist_list[i], elev_list[i], azim_list[i],
-                image_size, faces_per_pixel, device)
-
-            similarity_texture_cache[i*hits+j] = build_backproject_mask(mesh, faces, verts_uvs, 
-                cameras, transforms.ToPILImage()(similarity_tensor[0, :, :, 0]).convert("RGB"), faces_per_pixel,
-                image_size_scaled, uv_size, device, textures_idx=textures_idx)
-
-    return similarity_texture_cache
+    batch_size = max(1, SIMILARITY_BATCH_PIXELS // (image_size_scaled ** 2))
+    for start in tqdm(range(0, num_meshes, batch_size)):
+        batch_ids = list(range(start, min(start + batch_size, num_meshes)))
+        batch_meshes = Meshes(
+            verts=[verts_list[mesh_ids[k]] for k in batch_ids],
+            faces=[faces_list[mesh_ids[k]] for k in batch_ids]
+        )
+        cameras = init_camera(
+            [dist_list[k // hits] for k in batch_ids], 
+            [elev_list[k // hits] for k in batch_ids], 
+            [azim_list[k // hits] for k in batch_ids],
+            image_size, device
+        )
+
+        # similarity at the rendering resolution, upsampled to the back-projection resolution
+        similarity_tensor = render_similarity_maps(batch_meshes, cameras, image_size, faces_per_pixel)
+        similarity_tensor = torch.nn.functional.interpolate(similarity_tensor, size=(image_size_scaled, image_size_scaled), 
+            mode="bicubic", align_corners=False).clamp(0, 1)
+
+        similarity_textures = build_backproject_masks(batch_meshes, [textures_idx_list[k] for k in batch_ids], verts_uvs, 
+            cameras, similarity_tensor, faces_per_pixel,
+            image_size_scaled, uv_size, torch.zeros(len(batch_ids), uv_size, uv_size, device=device))
+        similarity_texture_cache.update(start, similarity_textures)
+
+    return similarity_texture_cache.compact()
+
+
+class ViewScoringEngine:
+    """
+        View heat (see `compute_view_heat`) of all candidate views of `select_viewpoint(mode="heuristic")` at once.
+
+        The geometry and the cameras are fixed during the refinement, so every candidate is rasterized once
+        and only the texels under its valid pixels (covered and facing the camera enough) are kept.
+        Scoring is one lookup of these texels in the packed exist / best view texture
+        of `build_diffusion_mask_from_fragments` and one bincount over (candidate, quad class).
+
+        Candidate k = view_idx * hits + hit, like the meshes of `build_similarity_texture_cache_for_all_views`.
+
+        The pixel entries are sorted by texel (CSR, `texel_offsets`), and the per-candidate quad class counts
+        are kept between steps: `update_texels` with the texels a back-projection touched only moves the
+        pixels of the texels whose exist bit flipped, so scoring a step costs O(changed texels).
+    """
+    def __init__(self, meshes, faces, verts_uvs,
+        dist_list, elev_list, azim_list,
+        image_size, uv_size, faces_per_pixel,
+        device,
+        view_threshold=0.01,
+        hits=1,
+        xray_mesh=None
+        ):
+        self.num_views = len(dist_list)
+        self.hits = hits
+        self.num_candidates = self.num_views * hits
+        self.num_pixels = image_size ** 2
+        self.uv_size = uv_size
+        self.device = device
+
+        verts_list, faces_list = meshes.verts_list(), meshes.faces_list()
+        mesh_ids = list(range(self.num_candidates)) if len(meshes) > 1 else [0] * self.num_candidates
+        if xray_mesh is not None:
+            textures_idx_list = [xray_mesh.visible_texture_map_list[k] for k in range(self.num_candidates)]
+        else:
+            textures_idx_list = [faces.textures_idx] * self.num_candidates
+
+        print("=> rasterizing {} candidate views for scoring...".format(self.num_candidates))
+        texels_list, candidate_ids_list = [], []
+        batch_size = max(1, SIMILARITY_BATCH_PIXELS // self.num_pixels)
+        for start in tqdm(range(0, self.num_candidates, batch_size)):
+            batch_ids = list(range(start, min(start + batch_size, self.num_candidates)))
+            batch_meshes = Meshes(
+                verts=[verts_list[mesh_ids[k]] for k in batch_ids],
+                faces=[faces_list[mesh_ids[k]] for k in batch_ids]
+            )
+            cameras = init_camera(
+                [dist_list[k // hits] for k in batch_ids], 
+                [elev_list[k // hits] for k in batch_ids], 
+                [azim_list[k // hits] for k in batch_ids],
+                image_size, device
+            )
+
+            similarity_tensor, fragments = render_similarity_maps(batch_meshes, cameras, image_size, faces_per_pixel, return_fragments=True)
+            pixel_texels = get_pixel_texels(fragments, verts_uvs, torch.cat([textures_idx_list[k] for k in batch_ids]), uv_size)
+
+            # NOTE background pixels have zero similarity, they are never valid
+            valid = similarity_tensor[:, 0] >= view_threshold
+            batch_candidate_ids, *_ = torch.nonzero(valid, as_tuple=True)
+            texels_list.append(pixel_texels[valid].int())
+            candidate_ids_list.append((batch_candidate_ids + start).int())
+
+        texels = torch.cat(texels_list).long()
+        candidate_ids = torch.cat(candidate_ids_list).long()
+
+        # texel -> pixel entries
+        order = torch.argsort(texels)
+        self.texels = texels[order]
+        self.candidate_ids = candidate_ids[order]
+        self.texel_offsets = torch.zeros(uv_size * uv_size + 1, dtype=torch.long, device=device)
+        self.texel_offsets[1:] = torch.bincount(self.texels, minlength=uv_size * uv_size).cumsum(0)
+
+        self.quad_weights = torch.tensor([QUAD_WEIGHTS[idx] for idx in range(4)], device=device)
+
+        # counters, built on the first `score`
+        self.counts = None
+        self.exist = None
+        self.similarity_texture_cache = None
+
+    def get_quad_classes(self, exist, best_view_ids, candidate_ids):
+        """ new: 3, update: 2, old: 1 """
+        update = exist & (best_view_ids == candidate_ids)
+
+        return 3 - 2 * exist.long() + update.long()
+
+    def count_quad_classes(self, exist_texture, similarity_texture_cache):
+        """ (num_candidates, 4) number of pixels of each quad class, from scratch """
+        quad_classes = self.get_quad_classes(
+            (exist_texture > 0).view(-1)[self.texels],
+            similarity_texture_cache.index.view(-1)[self.texels].long(),
+            self.candidate_ids
+        )
+        counts = torch.bincount(self.candidate_ids * 4 + quad_classes, minlength=self.num_candidates * 4)
+
+        return counts.reshape(self.num_candidates, 4)
+
+    def reset(self, exist_texture, similarity_texture_cache):
+        self.counts = self.count_quad_classes(exist_texture, similarity_texture_cache)
+        self.exist = (exist_texture > 0).view(-1).clone()
+        self.similarity_texture_cache = similarity_texture_cache
+
+    def update_texels(self, texels, exist_texture):
+        """ move the pixels of the changed `texels` (flat texel indices, e.g. from `backproject_from_image`) to their new quad class """
+        if self.counts is None:
+            return
+
+        texels = torch.unique(texels.to(self.device).long())
+        exist = (exist_texture > 0).view(-1)[texels]
+        flipped = exist != self.exist[texels]
+        texels, exist = texels[flipped], exist[flipped]
+        self.exist[texels] = exist
+
+        # gather the pixel entries of the flipped texels
+        starts = self.texel_offsets[texels]
+        lengths = self.texel_offsets[texels + 1] - starts
+        entry_starts = torch.repeat_interleave(starts - (lengths.cumsum(0) - lengths), lengths)
+        entries = entry_starts + torch.arange(entry_starts.shape[0], device=self.device)
+        exist = torch.repeat_interleave(exist, lengths)
+
+        candidate_ids = self.candidate_ids[entries]
+        best_view_ids = self.similarity_texture_cache.index.view(-1)[self.texels[entries]].long()
+        old_quad_classes = self.get_quad_classes(~exist, best_view_ids, candidate_ids)
+        new_quad_classes = self.get_quad_classes(exist, best_view_ids, candidate_ids)
+
+        counts = self.counts.view(-1)
+        counts.index_add_(0, candidate_ids * 4 + old_quad_classes, torch.full_like(candidate_ids, -1))
+        counts.index_add_(0, candidate_ids * 4 + new_quad_classes, torch.ones_like(candidate_ids))
+
+    def score(self, exist_texture, similarity_texture_cache, view_punishments):
+        """ (num_views, hits) view heat of all candidates """
+        if self.counts is None or similarity_texture_cache is not self.similarity_texture_cache:
+            self.reset(exist_texture, similarity_texture_cache)
+
+        view_heat = (self.counts.float() * self.quad_weights).sum(1) / self.num_pixels
+        view_heat = view_heat.reshape(self.num_views, self.hits)
+        view_heat *= torch.tensor(view_punishments, dtype=view_heat.dtype, device=self.device).unsqueeze(1)
+
+        return view_heat
 
 
 @torch.no_grad()
@@ -348,8 +599,13 @@ def render_one_view_and_build_masks(dist, elev, azim,
     init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
     device, save_intermediate=False, smooth_mask=False, view_threshold=0.01,
     textures_idx=None,
-    hit=1
+    hit=1,
+    build_images=True
     ):
+    """
+        `build_images=False` only computes the tensors (e.g. for the view heat),
+        the PIL images (renderings and masks) are returned as None
+    """
     
     # render the view
     (
@@ -361,32 +617,13 @@ def render_one_view_and_build_masks(dist, elev, azim,
         device
     )
     
-    init_image = init_images_tensor[0].cpu()
-    init_image = init_image.permute(2, 0, 1)
-    init_image = transforms.ToPILImage()(init_image).convert("RGB")
-
-    normal_map = normal_maps_tensor[0].cpu()
-    normal_map = normal_map.permute(2, 0, 1)
-    normal_map = transforms.ToPILImage()(normal_map).convert("RGB")
-
-    depth_map = depth_maps_tensor[0].cpu().numpy()
-    depth_map = Image.fromarray(depth_map).convert("L")
-
-    similarity_map = similarity_tensor[0, :, :, 0].cpu()
-    similarity_map = transforms.ToPILImage()(similarity_map).convert("L")
-
+    if textures_idx is None:
+        textures_idx = faces.textures_idx
 
-    flat_renderer = init_renderer(cameras,
-        shader=init_flat_texel_shader(
-            camera=cameras,
-            device=device),
-        image_size=image_size,
-        faces_per_pixel=faces_per_pixel
-    )
-    new_mask_image, update_mask_image, old_mask_image, exist_mask_image = build_diffusion_mask(
-        (mesh, faces, verts_uvs), 
-        flat_renderer, exist_texture, similarity_texture_cache, selected_view_idx, device, image_size, 
-        smooth_mask=smooth_mask, view_threshold=view_threshold, textures_idx=textures_idx
+    new_mask_tensor, update_mask_tensor, old_mask_tensor, exist_mask_tensor = build_diffusion_mask_from_fragments(
+        fragments, similarity_tensor, 
+        exist_texture, similarity_texture_cache, selected_view_idx, 
+        verts_uvs, textures_idx, view_threshold=view_threshold
     )
     # NOTE the view idx is the absolute idx in the sample space (i.e. `selected_view_idx`)
     # it should match with `similarity_texture_cache`
@@ -397,11 +634,39 @@ def render_one_view_and_build_masks(dist, elev, azim,
         new_mask_tensor, 
         all_mask_tensor, 
         quad_mask_tensor
-    ) = compose_quad_mask(new_mask_image, update_mask_image, old_mask_image, device)
+    ) = compose_quad_mask_tensors(new_mask_tensor, update_mask_tensor, old_mask_tensor)
 
     view_heat = compute_view_heat(similarity_tensor, quad_mask_tensor)
     view_heat *= view_punishments[selected_view_idx]
 
+    if not (build_images or save_intermediate):
+        return (
+            view_heat,
+            renderer, cameras, fragments,
+            None, None, None, 
+            init_images_tensor, normal_maps_tensor, depth_maps_tensor, similarity_tensor, 
+            None, None, None, 
+            old_mask_tensor, update_mask_tensor, new_mask_tensor, all_mask_tensor, quad_mask_tensor
+        )
+
+    init_image = init_images_tensor[0].cpu()
+    init_image = init_image.permute(2, 0, 1)
+    init_image = transforms.ToPILImage()(init_image).convert("RGB")
+
+    normal_map = normal_maps_tensor[0].cpu()
+    normal_map = normal_map.permute(2, 0, 1)
+    normal_map = transforms.ToPILImage()(normal_map).convert("RGB")
+
+    depth_map = depth_maps_tensor[0].cpu().numpy()
+    depth_map = Image.fromarray(depth_map).convert("L")
+
+    similarity_map = similarity_tensor[0, :, :, 0].cpu()
+    similarity_map = transforms.ToPILImage()(similarity_map).convert("L")
+
+    new_mask_image, update_mask_image, old_mask_image, exist_mask_image = [
+        mask_tensor_to_image(mask_tensor) for mask_tensor in [new_mask_tensor, update_mask_tensor, old_mask_tensor, exist_mask_tensor]
+    ]
+
     # save intermediate results
     if save_intermediate:
         init_image.save(os.path.join(init_image_dir, "{}_{}.png".format(view_idx, hit)))
@@ -427,74 +692,160 @@ def render_one_view_and_build_masks(dist, elev, azim,
 
 
 
+@torch.no_grad()
+def build_view_correspondence(mesh, textures_idx, verts_uvs, cameras, image_size, uv_size, faces_per_pixel):
+    """
+        pixel -> texel correspondence of one view for `backproject_from_image`:
+            - pixels: (P,) int32 flat index (y * image_size + x) of the covered pixels
+            - texels: (4, P) int32 flat index (y * uv_size + x) of the 4 texels around the UV of each pixel
+        NOTE only the covered pixels, the background used to land on texel (uv_size-1, 0)
+    """
+    rasterizer = MeshRasterizer(
+        cameras=cameras,
+        raster_settings=RasterizationSettings(image_size=image_size, faces_per_pixel=faces_per_pixel)
+    )
+    fragments_scaled = rasterizer(mesh)
+
+    # get UV coordinates for each pixel
+    pixel_uvs = interpolate_face_attributes(
+        fragments_scaled.pix_to_face, fragments_scaled.bary_coords, verts_uvs[textures_idx]
+    )  # NxHsxWsxKx2
+
+    covered = fragments_scaled.pix_to_face >= 0
+    _, pixel_y, pixel_x, _ = torch.nonzero(covered, as_tuple=True)
+    pixel_uvs = pixel_uvs[covered]
+
+    texture_locations_y, texture_locations_x = get_all_4_locations(
+        (1 - pixel_uvs[:, 1]) * (uv_size - 1),
+        pixel_uvs[:, 0] * (uv_size - 1)
+    )
+
+    pixels = (pixel_y * image_size + pixel_x).int()
+    texels = (texture_locations_y * uv_size + texture_locations_x).int().reshape(4, -1)
+
+    return pixels, texels
+
+
+class CorrespondenceCache:
+    """
+        `build_view_correspondence` of the back-projected views, the geometry and the cameras are fixed within a stage.
+        Keyed by the caller (e.g. view and hit), so a view is rasterized once for its generate and update back-projections
+        and for every time the heuristic selects it again.
+
+            - device: the last views stay on the device, up to `max_bytes`
+              NOTE 20 bytes per covered pixel, up to ~1.7 GB per view at 9216 x 9216 (render_simple_factor 12)
+            - memmap: every view is kept in memory-mapped .npy files in a temporary directory,
+              only the view being back-projected is moved to the device
+
+        `close` removes the temporary directory, the owner has to call it at the end of the stage.
+    """
+    def __init__(self, device, storage="device", max_bytes=2**30):
+        assert storage in ["device", "memmap"], "unknown correspondence storage {}".format(storage)
+
+        self.device = device
+        self.storage = storage
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.memmap_dir = tempfile.TemporaryDirectory(prefix="correspondences_") if storage == "memmap" else None
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key, mesh, textures_idx, verts_uvs, cameras, image_size, uv_size, faces_per_pixel):
+        if key in self.entries:
+            self.stats["hits"] += 1
+            self.entries.move_to_end(key)
+
+            return self.entries[key]
+
+        self.stats["misses"] += 1
+        correspondence = build_view_correspondence(mesh, textures_idx, verts_uvs, cameras, image_size, uv_size, faces_per_pixel)
+        if self.storage == "memmap":
+            paths = [os.path.join(self.memmap_dir.name, "{}_{}.npy".format(len(self.entries), name)) for name in ["pixels", "texels"]]
+            for path, indices in zip(paths, correspondence):
+                np.save(path, indices.cpu().numpy())
+            # NOTE "r+" only to get writable arrays for `torch.as_tensor`, they are never written
+            correspondence = tuple(np.load(path, mmap_mode="r+") for path in paths)
+
+        self.entries[key] = correspondence
+        if self.storage == "device":
+            # NOTE a view larger than the budget is used once and not kept
+            self.num_bytes += sum(indices.numel() * indices.element_size() for indices in correspondence)
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= sum(indices.numel() * indices.element_size() for indices in evicted)
+
+        return correspondence
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        if self.memmap_dir is not None:
+            self.memmap_dir.cleanup()
+            self.memmap_dir = tempfile.TemporaryDirectory(prefix="correspondences_")
+
+    def close(self):
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        if self.memmap_dir is not None:
+            self.memmap_dir.cleanup()
+            self.memmap_dir = None
+
+
 @torch.no_grad()
 def backproject_from_image(mesh, faces, verts_uvs, cameras, 
     reference_image, new_mask_image, update_mask_image, 
     init_texture, exist_texture,
     image_size, uv_size, faces_per_pixel,
     device,
-    textures_idx=None
+    textures_idx=None,
+    return_texels=False,
+    correspondence=None
     ):
+    """
+        the masks can be PIL images or mask tensors, see `mask_image_to_tensor`
+        `return_texels=True` also returns the flat indices (y * uv_size + x) of the written texels
+        `correspondence` is the `build_view_correspondence` of this view (e.g. from a `CorrespondenceCache`),
+        the view is rasterized again if None
+    """
 
-    # construct pixel UVs
-    renderer_scaled = init_renderer(cameras,
-        shader=init_soft_phong_shader(
-            camera=cameras,
-            blend_params=BlendParams(),
-            device=device),
-        image_size=image_size, 
-        faces_per_pixel=faces_per_pixel
-    )
-    fragments_scaled = renderer_scaled.rasterizer(mesh)
-    
-    if textures_idx is None:
-        textures_idx = faces.textures_idx
+    if correspondence is None:
+        if textures_idx is None:
+            textures_idx = faces.textures_idx
 
-    # get UV coordinates for each pixel
-    faces_verts_uvs = verts_uvs[textures_idx]
+        correspondence = build_view_correspondence(mesh, textures_idx, verts_uvs, cameras, image_size, uv_size, faces_per_pixel)
 
-    pixel_uvs = interpolate_face_attributes(
-        fragments_scaled.pix_to_face, fragments_scaled.bary_coords, faces_verts_uvs
-    )  # NxHsxWsxKx2
-    pixel_uvs = pixel_uvs.permute(0, 3, 1, 2, 4).reshape(pixel_uvs.shape[-2], pixel_uvs.shape[1], pixel_uvs.shape[2], 2)
+    pixels, texels = [torch.as_tensor(indices).to(device).long() for indices in correspondence]
 
     # the update mask has to be on top of the diffusion mask
-    new_mask_image_tensor = transforms.ToTensor()(new_mask_image).to(device).unsqueeze(-1)
-    update_mask_image_tensor = transforms.ToTensor()(update_mask_image).to(device).unsqueeze(-1)
-    
-    project_mask_image_tensor = torch.logical_or(update_mask_image_tensor, new_mask_image_tensor).float()
-    project_mask_image = project_mask_image_tensor * 255.
-    project_mask_image = Image.fromarray(project_mask_image[0, :, :, 0].cpu().numpy().astype(np.uint8))
+    project_mask_tensor = torch.logical_or(
+        mask_image_to_tensor(update_mask_image, device), 
+        mask_image_to_tensor(new_mask_image, device)
+    ).float()
+    project_mask_image = mask_tensor_to_image(project_mask_tensor)
     
-    project_mask_image_scaled = project_mask_image.resize(
-        (image_size, image_size),
-        Image.Resampling.NEAREST
-    )
-    project_mask_image_tensor_scaled = transforms.ToTensor()(project_mask_image_scaled).to(device)
-
-    pixel_uvs_masked = pixel_uvs[project_mask_image_tensor_scaled == 1]
+    # NOTE "nearest-exact" picks the same pixels as PIL's NEAREST resize
+    project_mask_image_tensor_scaled = torch.nn.functional.interpolate(project_mask_tensor.unsqueeze(0), 
+        size=(image_size, image_size), mode="nearest-exact")[0]
 
-    texture_locations_y, texture_locations_x = get_all_4_locations(
-        (1 - pixel_uvs_masked[:, 1]).reshape(-1) * (uv_size - 1), 
-        pixel_uvs_masked[:, 0].reshape(-1) * (uv_size - 1)
-    )
-    
-    K = pixel_uvs.shape[0]
-    project_mask_image_tensor_scaled = project_mask_image_tensor_scaled[:, None, :, :, None].repeat(1, 4, 1, 1, 3)
+    selected = project_mask_image_tensor_scaled.view(-1)[pixels] == 1
+    pixels = pixels[selected]
+    texels = texels[:, selected].reshape(-1) # all 4 neighbours of every pixel, neighbour-major
 
     texture_values = torch.from_numpy(np.array(reference_image.resize((image_size, image_size))))
-    texture_values = texture_values.to(device).unsqueeze(0).expand([4, -1, -1, -1]).unsqueeze(0).expand([K, -1, -1, -1, -1])
-    
-    texture_values_masked = texture_values.reshape(-1, 3)[project_mask_image_tensor_scaled.reshape(-1, 3) == 1].reshape(-1, 3)
+    texture_values = texture_values.to(device).reshape(-1, 3)[pixels].repeat(4, 1)
 
     # texture
     texture_tensor = torch.from_numpy(np.array(init_texture)).to(device)
-    texture_tensor[texture_locations_y, texture_locations_x, :] = texture_values_masked
+    texture_tensor.view(-1, 3)[texels] = texture_values
     
     init_texture = Image.fromarray(texture_tensor.cpu().numpy().astype(np.uint8))
 
     # update texture cache
-    exist_texture[texture_locations_y, texture_locations_x] = 1
+    exist_texture.view(-1)[texels] = 1
+
+    if return_texels:
+        return init_texture, project_mask_image, exist_texture, texels
 
     return init_texture, project_mask_image, exist_texture
 
@@ -1,5 +1,7 @@
 import numpy as np
-from collections import defaultdict
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import trimesh
@@ -21,6 +23,12 @@ from pytorch3d.renderer import (
     TexturesUV
 )
 
+# customized
+import sys
+sys.path.append(".")
+
+from lib.cache_helper import hash_arrays, load_npz, save_npz, pack_index_lists, unpack_index_lists
+
 def get_rays(directions, c2w, near = 1):
     """
     Get ray origin and normalized directions in world coordinate for all pixels in one image.
@@ -83,8 +91,59 @@ def generate_rays(image_resolution, c2w):
     return rays_screen_coords, rays_origins, ray_directions
 
 
-def ray_cast_mesh(mesh, rays_origins, ray_directions):
-    intersector = RayMeshIntersector(mesh)
+# memoized ray grids, keyed by resolution and c2w
+# NOTE a 1536x1536 grid takes ~150MB, only keep a few of them around
+RAY_GRID_CACHE = OrderedDict()
+RAY_GRID_CACHE_SIZE = 4
+# NOTE the thread-pool workers share the cache, a grid is built once while the others wait for it
+RAY_GRID_CACHE_LOCK = threading.Lock()
+
+
+def get_ray_grid(image_resolution, c2w):
+    """ same as `generate_rays`, but the (read-only) outputs are cached and shared """
+    if not isinstance(image_resolution, tuple):
+        image_resolution = (image_resolution, image_resolution)
+    c2w = np.asarray(c2w, dtype=np.float64)
+    key = (image_resolution, c2w.shape, c2w.tobytes())
+
+    with RAY_GRID_CACHE_LOCK:
+        if key not in RAY_GRID_CACHE:
+            ray_grid = generate_rays(image_resolution, c2w)
+            for array in ray_grid:
+                array.setflags(write=False)
+
+            RAY_GRID_CACHE[key] = ray_grid
+            while len(RAY_GRID_CACHE) > RAY_GRID_CACHE_SIZE:
+                RAY_GRID_CACHE.popitem(last=False)
+
+        RAY_GRID_CACHE.move_to_end(key)
+
+        return RAY_GRID_CACHE[key]
+
+
+def transform_rays(rays_origins, ray_directions, w2c):
+    """
+    Map rays defined in the camera frame to the world frame.
+
+    Inputs:
+        rays_origins: (N, 3) ray origins in camera coordinate
+        ray_directions: (N, 3) ray directions in camera coordinate
+        w2c: (4, 4) transformation matrix from world coordinate to camera coordinate
+
+    Outputs:
+        rays_origins: (N, 3) ray origins in world coordinate
+        ray_directions: (N, 3) ray directions in world coordinate
+    """
+    c2w = np.linalg.inv(w2c)
+    rays_origins = rays_origins @ c2w[:3, :3].T + c2w[:3, 3]
+    ray_directions = ray_directions @ c2w[:3, :3].T
+
+    return rays_origins, ray_directions
+
+
+def ray_cast_mesh(mesh, rays_origins, ray_directions, intersector=None):
+    if intersector is None:
+        intersector = RayMeshIntersector(mesh)
     index_triangles, index_ray, point_cloud = intersector.intersects_id(
         ray_origins=rays_origins,
         ray_directions=ray_directions,
@@ -95,34 +154,125 @@ def ray_cast_mesh(mesh, rays_origins, ray_directions):
 class RaycastingImaging:
     def __init__(self):
         self.rays_screen_coords, self.rays_origins, self.rays_directions = None, None, None
+        self.intersector = None
 
     def __del__(self):
         del self.rays_screen_coords
         del self.rays_origins
         del self.rays_directions
+        del self.intersector
+
+    def get_intersector(self, mesh):
+        # NOTE the BVH is only built once per mesh, cameras are handled by moving the rays
+        if self.intersector is None or self.intersector.mesh is not mesh:
+            self.intersector = RayMeshIntersector(mesh)
+
+        return self.intersector
 
     def prepare(self, image_height, image_width, c2w=None):
         # scanning radius is determined from the mesh extent
-        self.rays_screen_coords, self.rays_origins, self.rays_directions = generate_rays((image_height, image_width), c2w)
+        # NOTE the rays only depend on the resolution and c2w, reuse them across cameras and meshes
+        self.rays_screen_coords, self.rays_origins, self.rays_directions = get_ray_grid((image_height, image_width), c2w)
     
-    def get_image(self, mesh, max_hits = 4):  #, features):
+    def get_image(self, mesh, max_hits = 4, w2c=None):  #, features):
+        """
+            Cast the prepared rays against `mesh`.
+            If `w2c` is given, `mesh` is in world coordinate and the rays are moved
+            from the camera frame to the world frame, the returned points are still
+            in the camera frame.
+        """
+        if w2c is None:
+            rays_origins, rays_directions = self.rays_origins, self.rays_directions
+        else:
+            rays_origins, rays_directions = transform_rays(self.rays_origins, self.rays_directions, w2c)
+
         # get a point cloud with corresponding indexes
-        mesh_face_indexes, ray_indexes, points = ray_cast_mesh(mesh, self.rays_origins, self.rays_directions)
-
-        ray_face_indexes = defaultdict(list)
-        for ray_index, ray_face_index in zip(ray_indexes, mesh_face_indexes):
-            ray_face_indexes[ray_index].append(ray_face_index)
-            
-        mesh_face_indices = [[] for _ in range(max_hits)]
-        for i in range(max_hits):
-            for ray_index, ray_face_index in ray_face_indexes.items():
-                if i < len(ray_face_index):
-                    mesh_face_indices[i].append(ray_face_index[i])
-
-        mesh_face_indices = [np.unique(indexes) for indexes in mesh_face_indices]
+        mesh_face_indexes, ray_indexes, points = ray_cast_mesh(mesh, rays_origins, rays_directions, self.get_intersector(mesh))
+
+        hit_distances = np.linalg.norm(points - rays_origins[ray_indexes], axis=-1)
+        if w2c is not None:
+            points = points @ w2c[:3, :3].T + w2c[:3, 3]
+
+        mesh_face_indices = bucket_hits_by_order(ray_indexes, mesh_face_indexes, hit_distances, max_hits)
         # print([mesh_face_indices[i].shape for i in range(max_hits)])
         return ray_indexes, points, mesh_face_indices
 
+
+def bucket_hits_by_order(ray_indexes, mesh_face_indexes, hit_distances, max_hits):
+    """
+        Group the hits of all rays by their order along the ray.
+
+        Returns a list of `max_hits` arrays, the i-th one holds the unique faces hit
+        i-th (0 -> closest) by any ray.
+    """
+    ray_indexes = np.asarray(ray_indexes)
+    mesh_face_indexes = np.asarray(mesh_face_indexes)
+    if ray_indexes.shape[0] == 0:
+        return [np.zeros(0, dtype=np.int64) for _ in range(max_hits)]
+
+    # sort by ray first, then by distance along the ray
+    # NOTE same as np.lexsort((hit_distances, ray_indexes)), but ~2x faster
+    order = np.argsort(hit_distances)
+    order = order[np.argsort(ray_indexes[order], kind="stable")]
+    sorted_rays = ray_indexes[order]
+    sorted_faces = mesh_face_indexes[order]
+
+    # rank of each hit within its ray (cumcount)
+    first_hits = np.flatnonzero(np.r_[True, sorted_rays[1:] != sorted_rays[:-1]])
+    num_hits = np.diff(np.r_[first_hits, sorted_rays.shape[0]])
+    hit_ranks = np.arange(sorted_rays.shape[0]) - np.repeat(first_hits, num_hits)
+
+    # unique faces per rank, bincount is much cheaper than np.unique for bounded indices
+    num_faces = sorted_faces.max() + 1
+    return [np.flatnonzero(np.bincount(sorted_faces[hit_ranks == i], minlength=num_faces)) for i in range(max_hits)]
+
+
+def get_world_to_camera(R, T):
+    """ (4, 4) world to camera matrix from pytorch3d R (1, 3, 3) and T (1, 3) """
+    Rt = np.eye(4)  # Start with an identity matrix
+    Rt[:3, :3] = np.swapaxes(R, 1, 2)  # Top-left 3x3 is the transposed rotation
+    Rt[:3, 3] = T   # Top-right 3x1 is the inverted translation
+
+    return Rt
+
+
+def cast_one_camera(raycast, mesh, w2c, num_layers, raster_size):
+    """ faces hit by the orthographic rays of one camera, one array per hit layer """
+    c2w = np.eye(4).astype(np.float32)[:3]
+    raycast.prepare(image_height=raster_size, image_width=raster_size, c2w=c2w)
+    _, _, mesh_face_indices = raycast.get_image(mesh, num_layers, w2c=w2c)
+
+    return mesh_face_indices
+
+
+def cast_occlusion_layers(vertices, faces, w2c_list, num_layers, raster_size=1536, workers=1):
+    """
+        Cast the X-ray rays of all cameras against the mesh (in world coordinate).
+
+        Returns one list of `num_layers` face index arrays per camera, in camera order.
+        The cameras are cast by a thread pool that shares one BVH, embree releases the GIL during the queries.
+    """
+    workers = max(1, min(workers, len(w2c_list)))
+
+    mesh = Trimesh(vertices=vertices, faces=faces)
+
+    # NOTE one RaycastingImaging per thread, they all share the same intersector
+    intersector = RaycastingImaging().get_intersector(mesh)
+    def cast(w2c):
+        raycast = RaycastingImaging()
+        raycast.intersector = intersector
+        return cast_one_camera(raycast, mesh, w2c, num_layers, raster_size)
+
+    if workers == 1:
+        return [cast(w2c) for w2c in w2c_list]
+
+    # NOTE the embree scene is built lazily on the first query, build it here instead of racing in the workers
+    intersector.intersects_id(np.zeros((1, 3)), np.array([[0., 0., 1.]]))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(cast, w2c_list))
+
+
 class XRayMesh:
     def __init__(
         self, 
@@ -136,7 +286,10 @@ class XRayMesh:
         sampling_mode='nearest', 
         new_verts_uvs=None, 
         faces=None, 
-        texture_init_maps=None
+        texture_init_maps=None,
+        raster_size=1536,
+        workers=1,
+        cache_dir=None
     ):
         self.mesh = mesh
         self.target_size = (texture_size,texture_size)
@@ -145,6 +298,9 @@ class XRayMesh:
         self.max_hits = max_hits
         self.remove_backface_hits = remove_backface_hits
         self.sampling_mode = sampling_mode
+        self.raster_size = raster_size # resolution of the orthographic ray grid
+        self.workers = workers # number of cameras cast in parallel
+        self.cache_dir = cache_dir # on-disk cache of the occlusion layers, disabled if None
         
         self.set_cameras(cameras)
         self.generate_occluded_geometry(faces, texture_init_maps, new_verts_uvs)
@@ -156,33 +312,44 @@ class XRayMesh:
         R, T = look_at_view_transform(dist=dist, elev=elev, azim=azim, at=centers or ((0,0,0),))
         self.cameras = FoVOrthographicCameras(device=self.device, R=R, T=T, scale_xyz=scale or ((1,1,1),))
         
+    def cast_occlusion_layers(self, vertices, faces):
+        """ per-camera face indices of the first `max_hits` layers, cached on disk if `cache_dir` is set """
+        # NOTE the layers only depend on the geometry, the camera poses, max_hits and the ray grid resolution
+        cache_key = hash_arrays(
+            vertices.astype(np.float32), faces.astype(np.int64),
+            self.cameras.R.cpu().numpy(), self.cameras.T.cpu().numpy(), self.cameras.scale_xyz.cpu().numpy(),
+            extra=("xray", self.max_hits, self.raster_size)
+        )
+        num_cameras = len(self.cameras)
+
+        cached = load_npz(self.cache_dir, cache_key)
+        if cached is not None:
+            print("=> loading X-ray occlusion layers from cache...")
+            layers = unpack_index_lists(cached["face_indices"], cached["offsets"])
+            return [layers[k * self.max_hits:(k + 1) * self.max_hits] for k in range(num_cameras)]
+
+        # NOTE the mesh stays in world coordinate, the BVH is built only once for all cameras
+        w2c_list = [get_world_to_camera(camera.R.cpu().numpy(), camera.T.cpu().numpy()) for camera in self.cameras]
+        mesh_face_indices_per_camera = cast_occlusion_layers(vertices, faces, w2c_list, 
+            self.max_hits * 2 - 1, self.raster_size, self.workers)
+        mesh_face_indices_per_camera = [layers[:self.max_hits] for layers in mesh_face_indices_per_camera]
+
+        face_indices, offsets = pack_index_lists([indices for layers in mesh_face_indices_per_camera for indices in layers])
+        save_npz(self.cache_dir, cache_key, face_indices=face_indices, offsets=offsets)
+
+        return mesh_face_indices_per_camera
+
     def generate_occluded_geometry(self, faces, texture_init_maps, new_verts_uvs):
         vertices = self.mesh.verts_packed().cpu().numpy()  # (V, 3) shape, move to CPU and convert to numpy
         # faces = self.mesh.faces_packed().cpu().numpy()  # (F, 3) shape, move to CPU and convert to numpy
 
-        raycast = RaycastingImaging()
+        mesh_face_indices_per_camera = self.cast_occlusion_layers(vertices, self.mesh.faces_packed().cpu().numpy())
 
         self.visible_faces_list = []
         self.visible_texture_map_list = []
         self.mesh_face_indices_list = []
         
-        for k, camera in enumerate(self.cameras):
-            R = camera.R.cpu().numpy()
-            T = camera.T.cpu().numpy()
-
-            Rt = np.eye(4)  # Start with an identity matrix
-            Rt[:3, :3] = np.swapaxes(R, 1, 2)  # Top-left 3x3 is the transposed rotation
-            Rt[:3, 3] = T   # Top-right 3x1 is the inverted translation
-
-            # mesh_frame = Trimesh(vertices=vertices, faces=self.mesh.faces_packed().cpu().numpy()).apply_transform(Rt)
-            
-            # self.mesh # Meshes -> Trimesh
-            mesh_frame = Trimesh(vertices=self.mesh.verts_packed().cpu().numpy(), faces=self.mesh.faces_packed().cpu().numpy()).apply_transform(Rt)
-            
-            c2w = np.eye(4).astype(np.float32)[:3]
-            raycast.prepare(image_height=512 * 3, image_width=512 * 3, c2w=c2w)
-            ray_indexes, points, mesh_face_indices = raycast.get_image(mesh_frame, self.max_hits * 2 - 1)
-            
+        for mesh_face_indices in mesh_face_indices_per_camera:
             for i in range(self.max_hits):
                 idx = i
                 # idx = i * 2 if self.remove_backface_hits else i
@@ -17,6 +17,8 @@ from ldm.modules.diffusionmodules.openaimodel import UNetModel, TimestepEmbedSeq
 from ldm.models.diffusion.ddpm import LatentDiffusion
 from ldm.util import log_txt_as_img, exists, instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
+from cldm.compiled import CompiledDenoiser
+from cldm.offload import OffloadScheduler
 
 
 class ControlledUnetModel(UNetModel):
@@ -303,6 +305,25 @@ class ControlNet(nn.Module):
 
         return outs
 
+    def forward_cfg(self, x, hint, timesteps, context, control_sharing="shared", **kwargs):
+        """
+            Residuals for an [unconditional, conditional] CFG batch whose x, hint and timesteps are identical,
+            running the ControlNet on the conditional half only:
+                - shared: the conditional residuals are reused for the unconditional half
+                - cond_only: no residuals for the unconditional half (as in the guess mode)
+        """
+        assert control_sharing in ["shared", "cond_only"]
+        b = x.shape[0] // 2
+        outs = self.forward(x[b:], hint[b:], timesteps[b:], context[b:], **kwargs)
+
+        if control_sharing == "shared":
+            return [torch.cat([h, h]) for h in outs]
+        else:
+            return [torch.cat([torch.zeros_like(h), h]) for h in outs]
+
+
+CONTROL_SHARING_MODES = ["full", "shared", "cond_only"]
+
 
 class ControlLDM(LatentDiffusion):
 
@@ -311,6 +332,9 @@ class ControlLDM(LatentDiffusion):
         self.control_model = instantiate_from_config(control_stage_config)
         self.control_key = control_key
         self.only_mid_control = only_mid_control
+        self.compiled_denoiser = None
+        self.control_sharing = "full" # how the ControlNet runs on CFG pairs, see `ControlNet.forward_cfg`
+        self.offload_scheduler = None
 
     @torch.no_grad()
     def get_input(self, batch, k, bs=None, *args, **kwargs):
@@ -323,17 +347,113 @@ class ControlLDM(LatentDiffusion):
         control = control.to(memory_format=torch.contiguous_format).float()
         return x, dict(c_crossattn=[c], c_concat=[control])
 
-    def apply_model(self, x_noisy, t, cond, *args, **kwargs):
+    def apply_model(self, x_noisy, t, cond, *args, cfg_pair=False, **kwargs):
+        """ `cfg_pair`: the batch is [unconditional, conditional] with the same x, t and hint in both halves """
         assert isinstance(cond, dict)
         diffusion_model = self.model.diffusion_model
         cond_txt = torch.cat(cond['c_crossattn'], 1)
         cond_hint = torch.cat(cond['c_concat'], 1)
+        control_sharing = self.control_sharing if cfg_pair else "full"
 
-        control = self.control_model(x=x_noisy, hint=cond_hint, timesteps=t, context=cond_txt)
+        self.require_modules(["control_model", "model"], prefetch=["first_stage_model"])
+
+        if self.compiled_denoiser is not None:
+            return self.compiled_denoiser(x_noisy, t, cond_txt, cond_hint, control_sharing)
+
+        if control_sharing == "full":
+            control = self.control_model(x=x_noisy, hint=cond_hint, timesteps=t, context=cond_txt)
+        else:
+            control = self.control_model.forward_cfg(x=x_noisy, hint=cond_hint, timesteps=t, context=cond_txt, control_sharing=control_sharing)
         eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
 
         return eps
 
+    @torch.no_grad()
+    def get_learned_conditioning(self, c):
+        self.require_modules(["cond_stage_model"], prefetch=["control_model", "model"])
+        return super().get_learned_conditioning(c)
+
+    @torch.no_grad()
+    def encode_first_stage(self, x):
+        self.require_modules(["first_stage_model"], prefetch=["control_model", "model"])
+        return super().encode_first_stage(x)
+
+    @torch.no_grad()
+    def decode_first_stage(self, z, *args, **kwargs):
+        self.require_modules(["first_stage_model"])
+        return super().decode_first_stage(z, *args, **kwargs)
+
+    def require_modules(self, names, prefetch=()):
+        """ no-op unless offloading, see `OffloadScheduler` """
+        if self.offload_scheduler is not None:
+            self.offload_scheduler.require(names)
+            self.offload_scheduler.prefetch(prefetch)
+
+    @property
+    def device(self):
+        # NOTE the model can be built on the CPU and only partially moved to the GPU by the scheduler
+        if self.offload_scheduler is not None:
+            return self.offload_scheduler.device
+
+        return super().device
+
+    def set_offload(self, vram_budget=None, device="cuda"):
+        """
+            keep the submodules within `vram_budget` bytes, None turns offloading off (all weights on `device`)
+            The model can still be on the CPU, then only the submodules that fit the budget are moved to `device`.
+        """
+        device = torch.device(device)
+        if self.offload_scheduler is not None:
+            self.offload_scheduler.require(self.offload_scheduler.module_names)
+            self.offload_scheduler = None
+
+        if vram_budget is None:
+            self.to(device)
+            return
+
+        self.offload_scheduler = OffloadScheduler(self, device, vram_budget, on_evict=self.on_offload_evict)
+
+        # the rest (schedule buffers, ...) is small and always on the device
+        for name, module in self.named_children():
+            if name not in self.offload_scheduler.module_names:
+                module.to(device)
+        for tensor in list(self.parameters(recurse=False)) + list(self.buffers(recurse=False)):
+            tensor.data = tensor.data.to(device)
+
+        self.offload_scheduler.prefetch(self.offload_scheduler.module_names)
+        for name in self.offload_scheduler.module_names:
+            self.offload_scheduler.wait(name)
+
+    def move_weights(self, device):
+        """ park the weights on the CPU while another model needs the GPU, and move them back """
+        device = torch.device(device)
+        if self.offload_scheduler is not None:
+            # NOTE the scheduler loads the submodules back on demand
+            if device.type == "cpu":
+                self.offload_scheduler.evict_all()
+            return
+
+        # NOTE captured graphs point to the old weight buffers
+        if self.compiled_denoiser is not None:
+            self.compiled_denoiser.reset()
+        self.to(device)
+
+    def on_offload_evict(self, name):
+        # NOTE compiled steps and captured graphs point to the evicted weights
+        if name in ["control_model", "model"] and self.compiled_denoiser is not None:
+            self.compiled_denoiser.reset()
+
+    def set_control_sharing(self, mode="full"):
+        assert mode in CONTROL_SHARING_MODES, "unknown control sharing mode {}, choose from {}".format(mode, CONTROL_SHARING_MODES)
+        self.control_sharing = mode
+
+    def set_compile_mode(self, mode="eager", **kwargs):
+        """ opt-in compiled denoising step ("compile" or "cuda_graph"), "eager" turns it off """
+        if mode == "eager":
+            self.compiled_denoiser = None
+        else:
+            self.compiled_denoiser = CompiledDenoiser(self.control_model, self.model.diffusion_model, self.only_mid_control, mode, **kwargs)
+
     @torch.no_grad()
     def get_unconditional_conditioning(self, N):
         return self.get_learned_conditioning([""] * N)
@@ -417,6 +537,15 @@ class ControlLDM(LatentDiffusion):
         return opt
 
     def low_vram_shift(self, is_diffusing):
+        # NOTE the scheduler keeps whatever fits the budget instead of swapping everything
+        if self.offload_scheduler is not None:
+            self.require_modules(["control_model", "model"] if is_diffusing else ["first_stage_model", "cond_stage_model"])
+            return
+
+        # NOTE captured graphs point to the old weight buffers
+        if self.compiled_denoiser is not None:
+            self.compiled_denoiser.reset()
+
         if is_diffusing:
             self.model = self.model.cuda()
             self.control_model = self.control_model.cuda()
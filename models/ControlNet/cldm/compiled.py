@@ -0,0 +1,122 @@
+import torch
+
+from functools import partial
+
+
+COMPILE_MODES = ["eager", "compile", "cuda_graph"]
+
+
+class CUDAGraphStep:
+    """
+        One denoising step captured into a CUDA graph. Inputs are copied into static buffers
+        before every replay, the output buffer is overwritten by the next replay.
+        Graphs captured with the same `pool` share their intermediate memory, they must never replay concurrently.
+    """
+    def __init__(self, step, inputs, warmup_steps=2, pool=None):
+        self.static_inputs = [x.clone() for x in inputs]
+
+        # NOTE warm up on a side stream so that lazy initializations are not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup_steps):
+                step(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph, pool=pool):
+            self.static_output = step(*self.static_inputs)
+
+    def __call__(self, *inputs):
+        for static_input, x in zip(self.static_inputs, inputs):
+            static_input.copy_(x)
+        self.graph.replay()
+
+        return self.static_output.clone()
+
+
+class CompiledDenoiser:
+    """
+        Opt-in compiled execution of the ControlLDM denoising step (ControlNet + ControlledUnetModel).
+
+        The step runs the same graph for every DDIM step and every view as long as the shapes stay fixed,
+        so one entry per input signature (shapes, dtypes, devices) is warmed up on first use and cached:
+            - compile: `torch.compile` of the step with static shapes
+            - cuda_graph: the step captured into a CUDA graph (CUDA only)
+        New signatures beyond `max_entries`, and any signature that fails to build, run eagerly.
+
+        NOTE every CUDA graph keeps the activation memory of one step resident (roughly the eager peak of that
+        latent size, plus its static buffers). Variable latent sizes, e.g. from `crop_to_mask` tiles, fill up
+        to `max_entries` graphs, so all graphs are captured into one shared memory pool: the resident cost is
+        about the largest step instead of the sum. Later sizes then run eagerly, entries are never evicted.
+    """
+    def __init__(self, control_model, diffusion_model, only_mid_control=False, mode="compile", max_entries=4, warmup_steps=2):
+        assert mode in COMPILE_MODES[1:], "unknown compile mode {}, choose from {}".format(mode, COMPILE_MODES)
+
+        self.control_model = control_model
+        self.diffusion_model = diffusion_model
+        self.only_mid_control = only_mid_control
+        self.mode = mode
+        self.max_entries = max_entries
+        self.warmup_steps = warmup_steps
+
+        self.entries = {}
+        self.failed = set()
+        self.graph_pool = None
+        self.stats = {"compiled": 0, "eager": 0, "builds": 0}
+
+    def eager_step(self, x, t, context, hint, control_sharing="full"):
+        if control_sharing == "full":
+            control = self.control_model(x=x, hint=hint, timesteps=t, context=context)
+        else:
+            control = self.control_model.forward_cfg(x=x, hint=hint, timesteps=t, context=context, control_sharing=control_sharing)
+        eps = self.diffusion_model(x=x, timesteps=t, context=context, control=control, only_mid_control=self.only_mid_control)
+
+        return eps
+
+    def get_signature(self, *inputs):
+        return tuple((tuple(x.shape), x.dtype, str(x.device)) for x in inputs)
+
+    def build_entry(self, inputs, control_sharing):
+        step = partial(self.eager_step, control_sharing=control_sharing)
+        if self.mode == "compile":
+            entry = torch.compile(step, dynamic=False)
+            entry(*inputs) # warm up, compiles for this signature
+        else:
+            assert inputs[0].is_cuda, "CUDA graphs require the inputs on a CUDA device"
+            if self.graph_pool is None:
+                self.graph_pool = torch.cuda.graph_pool_handle()
+            # NOTE safe to share, the steps run one after another and every output is cloned after its replay
+            entry = CUDAGraphStep(step, inputs, self.warmup_steps, self.graph_pool)
+
+        return entry
+
+    def reset(self):
+        """ drop all entries, e.g. after the weights moved between devices """
+        self.entries = {}
+        self.failed = set()
+        self.graph_pool = None
+
+    @torch.no_grad()
+    def __call__(self, x, t, context, hint, control_sharing="full"):
+        inputs = (x, t, context, hint)
+        signature = self.get_signature(*inputs) + (control_sharing,)
+
+        entry = self.entries.get(signature)
+        if entry is None and signature not in self.failed and len(self.entries) < self.max_entries:
+            print("=> building the {} denoising step for {}...".format(self.mode, signature[0][0]))
+            try:
+                entry = self.build_entry(inputs, control_sharing)
+            except Exception as e:
+                print("=> failed to build the {} denoising step, running eagerly: {}".format(self.mode, e))
+                self.failed.add(signature)
+            else:
+                self.entries[signature] = entry
+                self.stats["builds"] += 1
+
+        if entry is None:
+            self.stats["eager"] += 1
+            return self.eager_step(*inputs, control_sharing)
+
+        self.stats["compiled"] += 1
+        return entry(*inputs)
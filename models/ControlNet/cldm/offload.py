@@ -0,0 +1,123 @@
+import torch
+
+
+# submodules of ControlLDM that are moved as a whole, in the order they are needed for one view
+OFFLOAD_MODULES = ["first_stage_model", "cond_stage_model", "control_model", "model"]
+
+
+class OffloadScheduler:
+    """
+        Keeps the large ControlLDM submodules (VAE, CLIP, ControlNet, UNet) within a VRAM budget.
+
+        Every submodule gets a pinned CPU copy of its weights once, the weights are frozen so the copy stays valid:
+            - `require(names)` makes sure the submodules are on the GPU, evicting the least recently used
+              other submodules while the budget is exceeded
+            - `prefetch(names)` starts the host-to-device copies on a side stream if they fit without evicting
+              anything, `require` only waits for them
+            - evicting is free, the GPU weights are dropped and the parameters point to the pinned copy again
+        With a large enough budget everything stays resident after the first use and nothing is copied.
+    """
+    def __init__(self, model, device, vram_budget, module_names=OFFLOAD_MODULES, on_evict=None):
+        self.model = model
+        self.device = device
+        self.vram_budget = vram_budget # bytes
+        self.module_names = list(module_names)
+        self.on_evict = on_evict
+
+        self.stream = torch.cuda.Stream(device=device)
+        self.pinned = {}
+        self.sizes = {}
+        for name in self.module_names:
+            tensors = self.get_tensors(name)
+            self.pinned[name] = [tensor.data.cpu().pin_memory() for tensor in tensors]
+            self.sizes[name] = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+            # NOTE weights that are still on the CPU point to the pinned copy, instead of keeping both
+            for tensor, pinned in zip(tensors, self.pinned[name]):
+                if tensor.device.type == "cpu":
+                    tensor.data = pinned
+
+        self.resident = [] # least recently used first
+        self.pending = {} # name -> copy event
+        self.stats = {"loads": 0, "prefetches": 0, "evictions": 0, "bytes": 0}
+
+        # start with whatever is on the GPU, within the budget
+        for name in self.module_names:
+            if self.get_tensors(name)[0].device.type == "cuda":
+                self.resident.append(name)
+        self.evict_until(0)
+
+    def get_tensors(self, name):
+        module = getattr(self.model, name)
+        return list(module.parameters()) + list(module.buffers())
+
+    def resident_bytes(self):
+        return sum(self.sizes[name] for name in self.resident)
+
+    def evict(self, name):
+        self.wait(name)
+        for tensor, pinned in zip(self.get_tensors(name), self.pinned[name]):
+            tensor.data = pinned
+        self.resident.remove(name)
+        self.stats["evictions"] += 1
+
+        if self.on_evict is not None:
+            self.on_evict(name)
+
+    def evict_all(self):
+        for name in list(self.resident):
+            self.evict(name)
+
+    def evict_until(self, needed, keep=()):
+        """ evict least recently used submodules (except `keep`) until `needed` more bytes fit """
+        for name in list(self.resident):
+            if self.resident_bytes() + needed <= self.vram_budget:
+                break
+            if name not in keep:
+                self.evict(name)
+
+    def load(self, name):
+        """ asynchronous host-to-device copy on the side stream """
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            for tensor, pinned in zip(self.get_tensors(name), self.pinned[name]):
+                tensor.data = pinned.to(self.device, non_blocking=True)
+
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        self.pending[name] = event
+        self.resident.append(name)
+        self.stats["bytes"] += self.sizes[name]
+
+    def wait(self, name):
+        event = self.pending.pop(name, None)
+        if event is None:
+            return
+
+        torch.cuda.current_stream(self.device).wait_event(event)
+
+        # NOTE the weights were allocated on the side stream but are used on the current one
+        for tensor in self.get_tensors(name):
+            tensor.data.record_stream(torch.cuda.current_stream(self.device))
+
+    def require(self, names):
+        for name in names:
+            if name in self.resident:
+                self.resident.remove(name)
+                self.resident.append(name)
+            else:
+                self.evict_until(self.sizes[name], keep=names)
+                if self.resident_bytes() + self.sizes[name] > self.vram_budget:
+                    print("=> {} does not fit the VRAM budget, loading it anyway".format(name))
+                self.load(name)
+                self.stats["loads"] += 1
+
+        for name in names:
+            self.wait(name)
+
+    def prefetch(self, names):
+        for name in names:
+            if name not in self.resident and self.resident_bytes() + self.sizes[name] <= self.vram_budget:
+                self.load(name)
+                self.stats["prefetches"] += 1
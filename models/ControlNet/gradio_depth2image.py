@@ -13,35 +13,336 @@ import gradio as gr
 import numpy as np
 import torch
 import random
+import itertools
 
+from collections import OrderedDict
 from PIL import Image
 from torchvision import transforms
 
 from pytorch_lightning import seed_everything
 from annotator.util import resize_image, HWC3
 from cldm.model import create_model, load_state_dict
+from cldm.hack import enable_sliced_attention
 from models.ControlNet.ldm.models.diffusion.ddim import DDIMSampler
+from models.ControlNet.ldm.models.diffusion.dpmpp import DPMSolverPPSampler
 
 
-def init_model():
+# NOTE all samplers share the DDIM schedule, strength and RePaint masking
+SAMPLERS = {
+    "ddim": DDIMSampler,
+    "dpmpp_2m": DPMSolverPPSampler
+}
+
+
+def init_sampler(model, name="ddim"):
+    assert name in SAMPLERS, "unknown sampler {}, choose from {}".format(name, list(SAMPLERS.keys()))
+
+    return SAMPLERS[name](model)
+
+
+def init_model(compile_mode="eager", vram_budget=None):
+    """ vram_budget: GB for the weights, the submodules beyond it are streamed from pinned CPU memory """
     model = create_model(BASE_DIR+'/models/cldm_v15.yaml').cpu()
     state_dict = load_state_dict(BASE_DIR+'/models/control_sd15_depth.pth')
     model.load_state_dict(state_dict, strict=False)
     # model.load_state_dict(state_dict)
-    model = model.cuda()
+    if vram_budget is not None:
+        # NOTE the weights stay on the CPU, only the submodules within the budget are moved to the GPU
+        enable_sliced_attention()
+        model.set_offload(int(vram_budget * 2**30))
+        print("=> {:.2f} GB of VRAM after loading, budget {:.2f} GB".format(torch.cuda.max_memory_allocated() / 2**30, vram_budget))
+    else:
+        model = model.cuda()
+    model.set_compile_mode(compile_mode)
+
     ddim_sampler = DDIMSampler(model)
 
     return model, ddim_sampler
 
 
+class ConditioningCache:
+    """
+        LRU cache of the text conditioning, the prompts barely change across views and meshes.
+        Keyed by the text, the text encoder, the CLIP output layer (clip skip) and the device.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.tokens = itertools.count()
+
+    def get_token(self, cond_stage_model):
+        # NOTE not `id()`, that can be reused by a reloaded model and return stale conditioning
+        if not hasattr(cond_stage_model, "conditioning_token"):
+            cond_stage_model.conditioning_token = next(self.tokens)
+
+        return cond_stage_model.conditioning_token
+
+    def get_key(self, model, text):
+        cond_stage_model = model.cond_stage_model
+        return (
+            text, 
+            self.get_token(cond_stage_model),
+            getattr(cond_stage_model, "layer", None), 
+            getattr(cond_stage_model, "layer_idx", None), 
+            str(model.device)
+        )
+
+    @torch.no_grad()
+    def get(self, model, text, num_samples=1):
+        key = self.get_key(model, text)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self.entries[key] = model.get_learned_conditioning([text])
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        conditioning = self.entries[key]
+
+        return conditioning.expand(num_samples, *conditioning.shape[1:])
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+# NOTE shared across views and meshes of the same process
+CONDITIONING_CACHE = ConditioningCache()
+
+
+def encode_images(model, images):
+    """ uint8 images of shape (N, H, W, 3) -> latents (N, 4, H // 8, W // 8) """
+    x = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2).float().to(model.device)
+    x = (x / 127.5) - 1.0 # NOTE input image must be normalized to [-1, 1]
+
+    return model.get_first_stage_encoding(model.encode_first_stage(x)).detach()
+
+
+class LatentCache:
+    """
+        Per-view cache of the VAE encodings of the input images, the generate and the update pass of a view
+        encode almost the same rendering. Keyed by the caller (e.g. the view), the cached image is compared
+        pixel by pixel:
+            - unchanged: the cached latents are reused
+            - few changed tiles (incremental): only those and their neighbours within the halo are re-encoded,
+              each within a halo of context, and pasted into the cached latents.
+              NOTE exact for an encoder with a receptive field below the halo, an approximation for the VAE (attention)
+            - otherwise: the whole image is re-encoded
+        The keys are only valid within one mesh, the owner (e.g. the pipeline) has to clear it for every mesh.
+    """
+    def __init__(self, max_size=16, tile_size=128, halo=64, max_changed_ratio=0.25, batch_size=8):
+        assert tile_size % 8 == 0 and halo % 8 == 0, "tiles have to align with the latents"
+
+        self.max_size = max_size
+        self.tile_size = tile_size
+        self.halo = halo
+        self.max_changed_ratio = max_changed_ratio
+        self.batch_size = batch_size
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+
+    def get_changed_tiles(self, changed):
+        """
+            (row, col) of the tiles within `halo` of a changed pixel, and the number of tiles
+            NOTE the latents of the neighbouring tiles see the change through the receptive field of the encoder
+        """
+        H, W = changed.shape
+        rows, cols = -(-H // self.tile_size), -(-W // self.tile_size)
+
+        # number of changed pixels in the tile plus halo, from the summed-area table
+        summed = np.zeros((H + 1, W + 1), dtype=np.int64)
+        summed[1:, 1:] = changed.cumsum(axis=0).cumsum(axis=1)
+        ys, xs = np.arange(rows) * self.tile_size, np.arange(cols) * self.tile_size
+        y0, y1 = np.clip(ys - self.halo, 0, H), np.clip(ys + self.tile_size + self.halo, 0, H)
+        x0, x1 = np.clip(xs - self.halo, 0, W), np.clip(xs + self.tile_size + self.halo, 0, W)
+        num_changed = summed[y1][:, x1] - summed[y0][:, x1] - summed[y1][:, x0] + summed[y0][:, x0]
+
+        return np.argwhere(num_changed > 0), rows * cols
+
+    def update_tiles(self, model, image, latents, tiles):
+        H, W = image.shape[:2]
+        crop_h, crop_w = min(self.tile_size + 2 * self.halo, H), min(self.tile_size + 2 * self.halo, W)
+
+        windows = []
+        for row, col in tiles:
+            y, x = row * self.tile_size, col * self.tile_size
+            tile_h, tile_w = min(self.tile_size, H - y), min(self.tile_size, W - x)
+            y0, x0 = min(max(y - self.halo, 0), H - crop_h), min(max(x - self.halo, 0), W - crop_w)
+            windows.append((y, x, tile_h, tile_w, y0, x0))
+
+        for i in range(0, len(windows), self.batch_size):
+            batch = windows[i:i + self.batch_size]
+            crop_latents = encode_images(model, np.stack([image[y0:y0 + crop_h, x0:x0 + crop_w] for _, _, _, _, y0, x0 in batch]))
+            for crop_latent, (y, x, tile_h, tile_w, y0, x0) in zip(crop_latents, batch):
+                latents[0, :, y // 8:(y + tile_h) // 8, x // 8:(x + tile_w) // 8] = \
+                    crop_latent[:, (y - y0) // 8:(y - y0 + tile_h) // 8, (x - x0) // 8:(x - x0 + tile_w) // 8]
+
+        return latents
+
+    @torch.no_grad()
+    def encode(self, model, image, key=None, incremental=True):
+        """ uint8 RGB image of shape (H, W, 3) -> latents (1, 4, H // 8, W // 8), shared with the cache """
+        if key is None:
+            return encode_images(model, image[None])
+
+        assert image.shape[0] % 8 == 0 and image.shape[1] % 8 == 0, "image size has to be a multiple of 8"
+
+        entry = self.entries.get(key)
+        latents = None
+        if entry is not None and entry["image"].shape == image.shape and entry["latents"].device == model.device:
+            changed = np.any(entry["image"] != image, axis=-1)
+            if not changed.any():
+                self.hits += 1
+                latents = entry["latents"]
+            elif incremental:
+                tiles, num_tiles = self.get_changed_tiles(changed)
+                if len(tiles) <= self.max_changed_ratio * num_tiles:
+                    print("=> re-encoding {} of {} tiles".format(len(tiles), num_tiles))
+                    self.partial_hits += 1
+                    latents = self.update_tiles(model, image, entry["latents"].clone(), tiles)
+
+        if latents is None:
+            self.misses += 1
+            latents = encode_images(model, image[None])
+
+        self.entries[key] = {"image": image.copy(), "latents": latents}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return latents
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        num_calls = self.hits + self.partial_hits + self.misses
+        hit_rate = (self.hits + self.partial_hits) / num_calls if num_calls > 0 else 0
+
+        return {"hits": self.hits, "partial_hits": self.partial_hits, "misses": self.misses, "hit_rate": hit_rate, "size": len(self.entries)}
+
+
+def build_unknown_mask(detected_map, unknown_mask, H, W, device, depth_pad=10):
+    """
+        RePaint mask in the latent space (4, H // 8, W // 8), 1 -> generate, 0 -> keep
+        unknown mask has to be an array of shape (H, W) - should has values of (0, 255)
+    """
+    if unknown_mask is not None:
+
+        # # target: unknown region
+        # unknown_mask_image = np.copy(unknown_mask) # should be 0 - 255
+        # unknown_mask = unknown_mask.astype(np.float32)
+        # unknown_mask /= 255 # normalize it to 0 - 1
+
+        # target: unknown region + background
+        # HACK basically generate everything except known region
+        detected_map_image = Image.fromarray(detected_map.astype(np.uint8)).convert("L")
+        detected_map_np = np.array(detected_map_image)
+        background_mask = detected_map_np == depth_pad # bool
+        background_mask = background_mask.astype(np.float32) * 255 # 0 - 255
+        unknown_mask_image = unknown_mask + background_mask
+
+    else:
+
+        detected_map_image = Image.fromarray(detected_map.astype(np.uint8)).convert("L")
+        detected_map_np = np.array(detected_map_image)
+
+        # # target: non-background region
+        # unknown_mask = (detected_map_np != depth_pad).astype(np.uint8)
+        # unknown_mask_image = (unknown_mask * 255.).astype(np.uint8)
+        # # Image.fromarray(unknown_mask_image).save("unknown.png")
+
+        # target: everything
+        unknown_mask = np.ones_like(detected_map_np)
+        unknown_mask_image = (unknown_mask * 255.).astype(np.uint8)
+
+    # HACK
+    # unknown_mask_dilate = np.copy(unknown_mask_image)
+    unknown_mask_dilate = cv2.dilate(unknown_mask_image, kernel=np.ones((5, 5), np.uint8), iterations=2)
+    unknown_mask_dilate = Image.fromarray(unknown_mask_dilate.astype(np.uint8)).convert("L")
+    unknown_mask_dilate = unknown_mask_dilate.resize((H // 8, W // 8), Image.NEAREST)
+    unknown_mask_dilate = transforms.ToTensor()(unknown_mask_dilate).to(device)
+    unknown_mask_dilate = unknown_mask_dilate.repeat(4, 1, 1)
+
+    # HACK make sure the mask only contains 0 and 1
+    # NOTE ToTensor keeps the values in [0, 1], rounding is enough and needs no device sync
+    unknown_mask_dilate = torch.round(unknown_mask_dilate)
+
+    return unknown_mask_dilate
+
+
+def get_mask_crop(unknown_mask, padding=64, min_size=256, align=64):
+    """
+        Window (y0, y1, x0, x1) around the unknown region, padded for context.
+        The size is a multiple of `align` (64 pixels -> 8 latents, as required by the UNet).
+        Returns None if the mask is empty or the window would cover the whole image.
+    """
+    H, W = unknown_mask.shape[:2]
+    ys, xs = np.nonzero(unknown_mask)
+    if ys.shape[0] == 0:
+        return None
+
+    def get_range(low, high, size):
+        low, high = max(low - padding, 0), min(high + 1 + padding, size)
+        length = max(high - low, min_size)
+        length = min(int(np.ceil(length / align)) * align, size // align * align)
+
+        # grow around the center, then shift back into the image
+        low = max(min((low + high - length) // 2, size - length), 0)
+
+        return int(low), int(low + length)
+
+    y0, y1 = get_range(ys.min(), ys.max(), H)
+    x0, x1 = get_range(xs.min(), xs.max(), W)
+    if y1 - y0 >= H and x1 - x0 >= W:
+        return None
+
+    return y0, y1, x0, x1
+
+
 @torch.no_grad()
 def process(model, ddim_sampler, input_image, prompt, a_prompt, n_prompt, num_samples, 
     ddim_steps, scale, seed, eta, 
-    strength=1.0, detected_map=None, unknown_mask=None, save_memory=False, depth_pad=10):
+    strength=1.0, detected_map=None, unknown_mask=None, save_memory=False, depth_pad=10,
+    crop_to_mask=False, crop_padding=64, crop_min_size=256, latent_cache=None, latent_key=None, incremental_latents=True):
 
     """
         unknown mask has to be an array of shape (H, W) - should has values of (0, 255)
+
+        crop_to_mask: only encode, denoise and decode a tile around the unknown region,
+        the generated tile is pasted back into the input image
+
+        latent_cache, latent_key: reuse the VAE encoding of the previous input image with the same key, see `LatentCache`
     """
+
+    crop = get_mask_crop(unknown_mask, crop_padding, crop_min_size) if crop_to_mask and unknown_mask is not None and detected_map is not None else None
+    if crop is not None:
+        y0, y1, x0, x1 = crop
+        print("=> cropping the diffusion to [{}:{}, {}:{}]".format(y0, y1, x0, x1))
+        # NOTE the crops change from call to call, they bypass the latent cache
+        tiles = process(model, ddim_sampler, 
+            np.ascontiguousarray(input_image[y0:y1, x0:x1]), prompt, a_prompt, n_prompt, num_samples,
+            ddim_steps, scale, seed, eta,
+            strength=strength, detected_map=np.ascontiguousarray(detected_map[y0:y1, x0:x1]), 
+            unknown_mask=np.ascontiguousarray(unknown_mask[y0:y1, x0:x1]), save_memory=save_memory, depth_pad=depth_pad
+        )
+
+        results = []
+        for tile in tiles:
+            sample = np.array(Image.fromarray(input_image).convert("RGB"))
+            sample[y0:y1, x0:x1] = tile
+            results.append(sample)
+
+        return results
     
     with torch.no_grad():
         H, W, C = input_image.shape
@@ -62,14 +363,13 @@ def process(model, ddim_sampler, input_image, prompt, a_prompt, n_prompt, num_sa
         x0 = Image.fromarray(input_image).convert("RGB")
         x0 = np.array(x0)
 
-        x0 = torch.from_numpy(x0).permute(2, 0, 1).float().to(model.device)
-        x0 = x0.unsqueeze(0).repeat(num_samples, 1, 1, 1)
-        x0 = (x0 / 127.5) - 1.0 # NOTE input image must be normalized to [-1, 1]
-
         # encode input image
         # NOTE ControlNet doesn't accept the raw input image
-        x0 = model.encode_first_stage(x0)
-        x0 = model.get_first_stage_encoding(x0).detach()
+        if latent_cache is not None:
+            x0 = latent_cache.encode(model, x0, latent_key, incremental_latents)
+        else:
+            x0 = encode_images(model, x0[None])
+        x0 = x0.repeat(num_samples, 1, 1, 1)
 
         ddim_sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=eta, verbose=False, strength=strength)
         ddim_steps = int(ddim_steps * strength) # actually DEPRECATED
@@ -89,8 +389,8 @@ def process(model, ddim_sampler, input_image, prompt, a_prompt, n_prompt, num_sa
         control = torch.stack([control for _ in range(num_samples)], dim=0)
         control = einops.rearrange(control, 'b h w c -> b c h w').clone()
 
-        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)]}
-        un_cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
+        cond = {"c_concat": [control], "c_crossattn": [CONDITIONING_CACHE.get(model, prompt + ', ' + a_prompt, num_samples)]}
+        un_cond = {"c_concat": [control], "c_crossattn": [CONDITIONING_CACHE.get(model, n_prompt, num_samples)]}
         shape = (4, H // 8, W // 8)
 
         # if unknown_mask is not None:
@@ -117,60 +417,7 @@ def process(model, ddim_sampler, input_image, prompt, a_prompt, n_prompt, num_sa
         #     unknown_mask_dilate = None
 
     
-        if unknown_mask is not None:
-
-            # # target: unknown region
-            # unknown_mask_image = np.copy(unknown_mask) # should be 0 - 255
-            # unknown_mask = unknown_mask.astype(np.float32)
-            # unknown_mask /= 255 # normalize it to 0 - 1
-
-            # target: unknown region + background
-            # HACK basically generate everything except known region
-            detected_map_image = Image.fromarray(detected_map.astype(np.uint8)).convert("L")
-            detected_map_np = np.array(detected_map_image)
-            background_mask = detected_map_np == depth_pad # bool
-            background_mask = background_mask.astype(np.float32) * 255 # 0 - 255
-            unknown_mask_image = unknown_mask + background_mask
-
-            # unknown_mask is still the unknown region
-            # will be used later to compose the generated region
-            unknown_mask = unknown_mask.astype(np.float32)
-            unknown_mask /= 255 # normalize it to 0 - 1
-
-            compose_flag = True
-
-        else:
-
-            detected_map_image = Image.fromarray(detected_map.astype(np.uint8)).convert("L")
-            detected_map_np = np.array(detected_map_image)
-
-            # # target: non-background region
-            # unknown_mask = (detected_map_np != depth_pad).astype(np.uint8)
-            # unknown_mask_image = (unknown_mask * 255.).astype(np.uint8)
-            # # Image.fromarray(unknown_mask_image).save("unknown.png")
-
-            # target: everything
-            unknown_mask = np.ones_like(detected_map_np)
-            unknown_mask_image = (unknown_mask * 255.).astype(np.uint8)
-
-            compose_flag = False
-
-
-        # HACK
-        # unknown_mask_dilate = np.copy(unknown_mask_image)
-        unknown_mask_dilate = cv2.dilate(unknown_mask_image, kernel=np.ones((5, 5), np.uint8), iterations=2)
-        unknown_mask_dilate = Image.fromarray(unknown_mask_dilate.astype(np.uint8)).convert("L")
-        unknown_mask_dilate = unknown_mask_dilate.resize((H // 8, W // 8), Image.NEAREST)
-        unknown_mask_dilate = transforms.ToTensor()(unknown_mask_dilate).to(model.device)
-        unknown_mask_dilate = unknown_mask_dilate.repeat(4, 1, 1)
-
-        # HACK make sure the mask only contains 0 and 1
-        try:
-            assert set(torch.unique(unknown_mask_dilate).cpu().numpy().tolist()).issubset(set([0, 1])), set(torch.unique(unknown_mask_dilate).cpu().numpy().tolist())
-        except AssertionError:
-            unknown_mask_dilate = torch.round(unknown_mask_dilate)
-
-            assert set(torch.unique(unknown_mask_dilate).cpu().numpy().tolist()).issubset(set([0, 1])), set(torch.unique(unknown_mask_dilate).cpu().numpy().tolist())
+        unknown_mask_dilate = build_unknown_mask(detected_map, unknown_mask, H, W, model.device, depth_pad)
 
         samples, intermediates = ddim_sampler.sample(
             ddim_steps, num_samples,
@@ -216,6 +463,75 @@ def process(model, ddim_sampler, input_image, prompt, a_prompt, n_prompt, num_sa
     return results
 
 
+@torch.no_grad()
+def process_batch(model, ddim_sampler, input_images, prompts, a_prompt, n_prompt, 
+    ddim_steps, scale, seed, eta, 
+    strength=1.0, detected_maps=None, unknown_masks=None, save_memory=False, depth_pad=10):
+
+    """
+        Same as `process`, but denoise several views in one batch, one sample per view.
+        Each view comes with its own input image, prompt, depth map and unknown mask.
+    """
+
+    num_views = len(input_images)
+    H, W, C = input_images[0].shape
+
+    if seed == -1:
+        seed = random.randint(0, 65535)
+    seed_everything(seed)
+
+    if save_memory:
+        model.low_vram_shift(is_diffusing=True)
+
+    # start from noising the input images
+    x0 = np.stack([np.array(Image.fromarray(input_image).convert("RGB")) for input_image in input_images])
+    x0 = torch.from_numpy(x0).permute(0, 3, 1, 2).float().to(model.device)
+    x0 = (x0 / 127.5) - 1.0 # NOTE input image must be normalized to [-1, 1]
+
+    # encode input image
+    x0 = model.encode_first_stage(x0)
+    x0 = model.get_first_stage_encoding(x0).detach()
+
+    ddim_sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=eta, verbose=False, strength=strength)
+    ddim_steps = int(ddim_steps * strength) # actually DEPRECATED
+
+    # add noises to the maximum
+    ddim_steps_tensor = torch.full((x0.shape[0],), ddim_sampler.ddim_timesteps[-1]).to(model.device)
+    x_T = model.q_sample(x0, ddim_steps_tensor)
+
+    # control
+    control = np.stack([cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR) for detected_map in detected_maps])
+    control = torch.from_numpy(control).float().cuda() / 255.0
+    control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+
+    cond = {"c_concat": [control], "c_crossattn": [torch.cat([CONDITIONING_CACHE.get(model, prompt + ', ' + a_prompt) for prompt in prompts])]}
+    un_cond = {"c_concat": [control], "c_crossattn": [CONDITIONING_CACHE.get(model, n_prompt, num_views)]}
+    shape = (4, H // 8, W // 8)
+
+    if unknown_masks is None:
+        unknown_masks = [None] * num_views
+    unknown_mask_dilate = torch.stack([
+        build_unknown_mask(detected_map, unknown_mask, H, W, model.device, depth_pad)
+        for detected_map, unknown_mask in zip(detected_maps, unknown_masks)
+    ])
+
+    samples, intermediates = ddim_sampler.sample(
+        ddim_steps, num_views,
+        shape, cond, x0=x0, x_T=x_T, mask=unknown_mask_dilate,
+        verbose=False, eta=eta,
+        unconditional_guidance_scale=scale,
+        unconditional_conditioning=un_cond
+    )
+
+    if save_memory:
+        model.low_vram_shift(is_diffusing=False)
+
+    x_samples = model.decode_first_stage(samples)
+    x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
+
+    return [x_samples[i] for i in range(num_views)]
+
+
 if __name__ == "__main__":
     model, ddim_sampler = init_model()
 
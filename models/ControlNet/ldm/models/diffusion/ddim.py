@@ -58,6 +58,9 @@ class DDIMSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        # per-step coefficients are derived from the schedule above
+        self.step_coefficients = {}
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -150,15 +153,20 @@ class DDIMSampler(object):
             timesteps = self.ddim_timesteps[:subset_end]
 
         intermediates = {'x_inter': [img], 'pred_x0': [img]}
-        time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
+        time_range = np.arange(timesteps)[::-1] if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         print(f"Running DDIM Sampling with {total_steps} timesteps (strength: {self.strength})")
 
+        # NOTE everything that stays the same across steps is built once here
+        ts_all = self.get_timestep_tensors(time_range, b, device)
+        c_in = self.get_cfg_conditioning(cond, unconditional_conditioning)
+        repaint = self.get_repaint_coefficients(time_range, x0, mask) if mask is not None else None
+
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            ts, t_in = ts_all[i, :b], ts_all[i]
 
             # if mask is not None:
             #     assert x0 is not None
@@ -175,14 +183,12 @@ class DDIMSampler(object):
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
                                       unconditional_conditioning=unconditional_conditioning,
-                                      dynamic_threshold=dynamic_threshold)
+                                      dynamic_threshold=dynamic_threshold, c_in=c_in, t_in=t_in)
             img, pred_x0 = outs
 
             # RePaint -> mask is the unknown region
             if mask is not None:
-                assert x0 is not None
-                img_orig = self.model.q_sample(x0, ts-1)  # TODO: deterministic forward pass?
-                img = (1. - mask) * img_orig + mask * img
+                img = self.repaint_merge(img, x0, mask, repaint, i)
 
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
@@ -193,38 +199,102 @@ class DDIMSampler(object):
 
         return img, intermediates
 
-    @torch.no_grad()
-    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
-                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,
-                      dynamic_threshold=None):
-        b, *_, device = *x.shape, x.device
-
+    def get_timestep_tensors(self, time_range, batch_size, device):
+        """ (steps, 2 * batch_size) timesteps, `ts_all[i, :batch_size]` for the model and `ts_all[i]` for CFG """
+        ts_all = torch.tensor(np.ascontiguousarray(time_range), device=device, dtype=torch.long)
+
+        return ts_all[:, None].repeat(1, 2 * batch_size)
+
+    def get_cfg_conditioning(self, c, unconditional_conditioning):
+        """ concatenated [unconditional, conditional] inputs, identical for every step """
+        if unconditional_conditioning is None:
+            return None
+
+        if isinstance(c, dict):
+            assert isinstance(unconditional_conditioning, dict)
+            c_in = dict()
+            for k in c:
+                if isinstance(c[k], list):
+                    c_in[k] = [torch.cat([
+                        unconditional_conditioning[k][i],
+                        c[k][i]]) for i in range(len(c[k]))]
+                else:
+                    c_in[k] = torch.cat([
+                            unconditional_conditioning[k],
+                            c[k]])
+        elif isinstance(c, list):
+            c_in = list()
+            assert isinstance(unconditional_conditioning, list)
+            for i in range(len(c)):
+                c_in.append(torch.cat([unconditional_conditioning[i], c[i]]))
+        else:
+            c_in = torch.cat([unconditional_conditioning, c])
+
+        return c_in
+
+    def get_step_coefficients(self, use_original_steps=False):
+        """ DDIM coefficients of every step as (steps, 1, 1, 1) tensors, built once per schedule """
+        key = "original" if use_original_steps else "ddim"
+        if key not in self.step_coefficients:
+            alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
+            alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
+            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
+            sigmas = self.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
+
+            to_torch = lambda x: torch.as_tensor(np.asarray(torch.as_tensor(x).cpu()), dtype=torch.float32).to(self.model.betas.device).view(-1, 1, 1, 1)
+            a_t, a_prev, sigma_t = to_torch(alphas), to_torch(alphas_prev), to_torch(sigmas)
+
+            self.step_coefficients[key] = {
+                "sqrt_alphas": a_t.sqrt(),
+                "sqrt_one_minus_alphas": to_torch(sqrt_one_minus_alphas),
+                "sqrt_alphas_prev": a_prev.sqrt(),
+                "dir_xt": (1. - a_prev - sigma_t**2).sqrt(),
+                "sigmas": sigma_t
+            }
+
+        return self.step_coefficients[key]
+
+    def get_repaint_coefficients(self, time_range, x0, mask):
+        """
+            `q_sample(x0, ts-1)` of every step as (steps, 1, 1, 1) coefficients, plus one noise buffer
+            that is refilled in place. Same special cases as `q_sample` at both ends of the schedule.
+        """
+        assert x0 is not None
+        num_timesteps = self.model.sqrt_alphas_cumprod.shape[0]
+        t = torch.tensor(np.ascontiguousarray(time_range) - 1, device=x0.device, dtype=torch.long)
+
+        sqrt_alphas = self.model.sqrt_alphas_cumprod[t].float()
+        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod[t].float()
+        sqrt_alphas[t == num_timesteps - 1], sqrt_one_minus_alphas[t == num_timesteps - 1] = 0, 1
+        sqrt_alphas[t == 0], sqrt_one_minus_alphas[t == 0] = 1, 0
+
+        return {
+            "sqrt_alphas": sqrt_alphas.view(-1, 1, 1, 1),
+            "sqrt_one_minus_alphas": sqrt_one_minus_alphas.view(-1, 1, 1, 1),
+            "inverse_mask": 1. - mask,
+            "noise": torch.empty_like(x0)
+        }
+
+    def repaint_merge(self, img, x0, mask, repaint, i):
+        """ replace the known region (mask == 0) with the noised input image, in place on `img` """
+        img_orig = repaint["noise"].normal_()
+        img_orig.mul_(repaint["sqrt_one_minus_alphas"][i]).addcmul_(x0, repaint["sqrt_alphas"][i])
+
+        return img.mul_(mask).addcmul_(img_orig, repaint["inverse_mask"])
+
+    def get_model_output(self, x, c, t, unconditional_guidance_scale=1., unconditional_conditioning=None, c_in=None, t_in=None):
+        """ classifier-free guided model output, returns the predicted noise and the raw output """
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             model_output = self.model.apply_model(x, t, c)
         else:
+            if c_in is None:
+                c_in = self.get_cfg_conditioning(c, unconditional_conditioning)
+            if t_in is None:
+                t_in = torch.cat([t] * 2)
             x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            if isinstance(c, dict):
-                assert isinstance(unconditional_conditioning, dict)
-                c_in = dict()
-                for k in c:
-                    if isinstance(c[k], list):
-                        c_in[k] = [torch.cat([
-                            unconditional_conditioning[k][i],
-                            c[k][i]]) for i in range(len(c[k]))]
-                    else:
-                        c_in[k] = torch.cat([
-                                unconditional_conditioning[k],
-                                c[k]])
-            elif isinstance(c, list):
-                c_in = list()
-                assert isinstance(unconditional_conditioning, list)
-                for i in range(len(c)):
-                    c_in.append(torch.cat([unconditional_conditioning[i], c[i]]))
-            else:
-                c_in = torch.cat([unconditional_conditioning, c])
-            model_uncond, model_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+            # NOTE models that can exploit the identical halves (e.g. ControlLDM) are told so
+            model_kwargs = {"cfg_pair": True} if hasattr(self.model, "control_sharing") else {}
+            model_uncond, model_t = self.model.apply_model(x_in, t_in, c_in, **model_kwargs).chunk(2)
             model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
 
         if self.model.parameterization == "v":
@@ -232,23 +302,30 @@ class DDIMSampler(object):
         else:
             e_t = model_output
 
+        return e_t, model_output
+
+    @torch.no_grad()
+    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
+                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                      unconditional_guidance_scale=1., unconditional_conditioning=None,
+                      dynamic_threshold=None, c_in=None, t_in=None):
+        b, *_, device = *x.shape, x.device
+
+        e_t, model_output = self.get_model_output(x, c, t, unconditional_guidance_scale, unconditional_conditioning, c_in, t_in)
+
         if score_corrector is not None:
             assert self.model.parameterization == "eps", 'not implemented'
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-        # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        # select parameters corresponding to the currently considered timestep, broadcast over the batch
+        coefficients = self.get_step_coefficients(use_original_steps)
+        sqrt_at = coefficients["sqrt_alphas"][index]
+        sqrt_a_prev = coefficients["sqrt_alphas_prev"][index]
+        sqrt_one_minus_at = coefficients["sqrt_one_minus_alphas"][index]
 
         # current prediction for x_0
         if self.model.parameterization != "v":
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+            pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_at
         else:
             pred_x0 = self.model.predict_start_from_z_and_v(x, t, model_output)
 
@@ -259,11 +336,14 @@ class DDIMSampler(object):
             raise NotImplementedError()
 
         # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        x_prev = torch.addcmul(sqrt_a_prev * pred_x0, coefficients["dir_xt"][index], e_t)
+
+        # NOTE the noise is drawn even for eta = 0 (sigma = 0) to keep the RNG stream, and so the outputs for a seed
+        noise = coefficients["sigmas"][index] * noise_like(x.shape, device, repeat_noise) * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        x_prev += noise
+
         return x_prev, pred_x0
 
     @torch.no_grad()
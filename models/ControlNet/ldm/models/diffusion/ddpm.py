@@ -356,9 +356,10 @@ class DDPM(pl.LightningModule):
     def q_sample(self, x_start, t, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
 
-        if t == self.sqrt_alphas_cumprod.shape[0] - 1:
+        # NOTE the special cases only apply when the whole batch is at the same end of the schedule
+        if (t == self.sqrt_alphas_cumprod.shape[0] - 1).all():
             return 0 * x_start + 1 * noise
-        elif t == 0:
+        elif (t == 0).all():
             return 1 * x_start + 0 * noise
         else:
             return (extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
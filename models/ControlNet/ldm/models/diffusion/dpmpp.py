@@ -0,0 +1,96 @@
+"""SAMPLING ONLY."""
+
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from .ddim import DDIMSampler
+
+
+class DPMSolverPPSampler(DDIMSampler):
+    """
+        DPM-Solver++(2M) on the DDIM timesteps, a drop-in replacement of `DDIMSampler`.
+
+        The schedule (including the HACK strength truncation) comes from `DDIMSampler.make_schedule`,
+        and the RePaint masking is applied after every step exactly like in `DDIMSampler.ddim_sampling`,
+        so only the update rule changes. The second order multistep update gives a comparable quality
+        with fewer steps, the last step falls back to first order (= deterministic DDIM).
+    """
+
+    @torch.no_grad()
+    def ddim_sampling(self, cond, shape,
+                      x_T=None, ddim_use_original_steps=False,
+                      callback=None, timesteps=None, quantize_denoised=False,
+                      mask=None, x0=None, img_callback=None, log_every_t=100,
+                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, dynamic_threshold=None,
+                      ucg_schedule=None):
+        assert not ddim_use_original_steps and timesteps is None, "DPM-Solver++ only runs on the DDIM timesteps"
+
+        device = self.model.betas.device
+        b = shape[0]
+        if x_T is None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = x_T
+
+        timesteps = self.ddim_timesteps
+        alphas = self.ddim_alphas.double().cpu().numpy()
+        alphas_prev = np.asarray(self.ddim_alphas_prev, dtype=np.float64)
+
+        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        time_range = np.flip(timesteps)
+        total_steps = timesteps.shape[0]
+        print(f"Running DPM-Solver++(2M) Sampling with {total_steps} timesteps (strength: {self.strength})")
+
+        ts_all = self.get_timestep_tensors(time_range, b, device)
+        c_in = self.get_cfg_conditioning(cond, unconditional_conditioning)
+        repaint = self.get_repaint_coefficients(time_range, x0, mask) if mask is not None else None
+
+        iterator = tqdm(time_range, desc='DPM-Solver++ Sampler', total=total_steps)
+
+        # log-SNR of the current and the target noise level
+        get_lambda = lambda a: 0.5 * np.log(a / (1. - a))
+
+        pred_x0_prev, h_prev = None, None
+        for i, step in enumerate(iterator):
+            index = total_steps - i - 1
+            ts, t_in = ts_all[i, :b], ts_all[i]
+
+            if ucg_schedule is not None:
+                assert len(ucg_schedule) == len(time_range)
+                unconditional_guidance_scale = ucg_schedule[i]
+
+            e_t, model_output = self.get_model_output(img, cond, ts, unconditional_guidance_scale, unconditional_conditioning, c_in, t_in)
+
+            a_t, a_prev = alphas[index], alphas_prev[index]
+            sigma_t, sigma_prev = np.sqrt(1. - a_t), np.sqrt(1. - a_prev)
+
+            # current prediction for x_0
+            if self.model.parameterization != "v":
+                pred_x0 = (img - sigma_t * e_t) / np.sqrt(a_t)
+            else:
+                pred_x0 = self.model.predict_start_from_z_and_v(img, ts, model_output)
+
+            h = get_lambda(a_prev) - get_lambda(a_t)
+            if pred_x0_prev is None or index == 0:
+                denoised = pred_x0
+            else:
+                r = h_prev / h
+                denoised = (1. + 1. / (2. * r)) * pred_x0 - (1. / (2. * r)) * pred_x0_prev
+
+            img = (sigma_prev / sigma_t) * img - np.sqrt(a_prev) * np.expm1(-h) * denoised
+            pred_x0_prev, h_prev = pred_x0, h
+
+            # RePaint -> mask is the unknown region
+            if mask is not None:
+                img = self.repaint_merge(img, x0, mask, repaint, i)
+
+            if callback: callback(i)
+            if img_callback: img_callback(pred_x0, i)
+
+            if index % log_every_t == 0 or index == total_steps - 1:
+                intermediates['x_inter'].append(img)
+                intermediates['pred_x0'].append(pred_x0)
+
+        return img, intermediates
@@ -1,10 +1,20 @@
 import pandas as pd
-import subprocess
 import os
+import time
+import traceback
 
+import torch
 from tqdm import tqdm
 import configargparse
 
+from scripts.generate_texture import (
+    DEVICE,
+    init_args,
+    run_pipeline
+)
+from lib.pipeline_helper import TextureSynthesisPipeline
+from models.ControlNet.gradio_depth2image import CONDITIONING_CACHE
+
 def parse_config():
     parser = configargparse.ArgumentParser(
                         prog='Multi-View Diffusion',
@@ -14,6 +24,10 @@ def parse_config():
     parser.add_argument('--prompt', type=str, required=False)
     parser.add_argument('--test', action="store_true", required=False)
     parser.add_argument('--hit', type=int, required=False)
+    parser.add_argument('--compile_mode', type=str, default="eager", choices=["eager", "compile", "cuda_graph"], required=False)
+    parser.add_argument('--vram_budget', type=float, default=None, required=False)
+    parser.add_argument('--keep_inpainting', action="store_true", required=False,
+                        help="keep ControlNet and the inpainting model on the GPU together (~2.6 GB more VRAM) instead of parking them in CPU memory")
     options = parser.parse_args()
 
     return options
@@ -56,39 +70,124 @@ objects_path = "Objaverse_Objects.csv"
 objects_path = "Mini_Objects.csv"
 meshes_path = "objaverse"
 
-def test_run(max_hit):
-    command = (
-        "python scripts/generate_texture.py "
-        f"--input_dir data/backpack/ "
-        f"--output_dir data/backpack/outputs "
-        "--obj_name mesh "
-        "--obj_file mesh.obj "
-        f'--prompt "orange backpack" '
-        "--add_view_to_prompt "
-        "--ddim_steps 50 "
-        "--new_strength 1 "
-        "--update_strength 0.3 "
-        "--view_threshold 0.1 "
-        "--blend 0 "
-        "--dist 1 "
-        "--num_viewpoints 20 "
-        "--viewpoint_mode predefined "
-        "--use_principle "
-        "--update_steps 20 "
-        "--update_mode heuristic "
-        "--seed 42 "
-        "--post_process "
-        '--device "2080" '
-        "--use_objaverse "
-        f"--hits {max_hit} "
-    )
-    
-    # Run the command
-    print(f"Running command: {command}")
-    subprocess.run(command, shell=True)
-
-
-def run_batch(uid_list, description_list, style_prompt=None, max_hits=2):
+class BatchEngine:
+    """
+        Long-lived texture generation engine.
+
+        A single `TextureSynthesisPipeline` keeps ControlNet and the DDIM sampler resident
+        for every mesh, instead of paying interpreter startup and checkpoint loading for
+        each object. For the post-processing ControlNet is parked in CPU memory while the
+        inpainting model is on the GPU and moved back for the next object, unless
+        `--keep_inpainting` keeps both on the GPU (~2.6 GB more VRAM).
+    """
+
+    def __init__(self, compile_mode="eager", vram_budget=None, keep_inpainting=False):
+        start_time = time.time()
+        self.keep_inpainting = keep_inpainting
+        self.pipeline = TextureSynthesisPipeline(DEVICE, compile_mode=compile_mode, vram_budget=vram_budget)
+        self.pipeline.load_models()
+        self.load_time = time.time() - start_time
+        self.start_time = start_time
+
+        self.timings = [] # (name, seconds)
+        self.failures = [] # names
+
+        print("=> models loaded in {:.2f} s".format(self.load_time))
+
+    def run(self, generate_args, name=None):
+        if self.keep_inpainting:
+            generate_args = generate_args + ["--keep_inpainting"]
+        print("Running generate_texture with: {}".format(" ".join(generate_args)))
+        args = init_args(generate_args)
+        name = name or args.input_dir
+
+        start_time = time.time()
+        try:
+            self.pipeline.load_models()
+            run_pipeline(args, self.pipeline)
+        except (Exception, SystemExit):
+            # NOTE one broken mesh should not take down the whole batch
+            traceback.print_exc()
+            self.failures.append(name)
+        else:
+            elapsed = time.time() - start_time
+            self.timings.append((name, elapsed))
+            print("=> {} done in {:.2f} s ({:.2f} objects/hour so far)".format(
+                name, elapsed, self.objects_per_hour()))
+        finally:
+            torch.cuda.empty_cache()
+
+    def objects_per_hour(self):
+        total_time = time.time() - self.start_time
+        return len(self.timings) / total_time * 3600
+
+    def summary(self):
+        print("=> batch summary")
+        for name, elapsed in self.timings:
+            print("{}: {:.2f} s".format(name, elapsed))
+        for name in self.failures:
+            print("{}: FAILED".format(name))
+
+        if len(self.timings) > 0:
+            object_times = [elapsed for _, elapsed in self.timings]
+            print("=> model loading: {:.2f} s".format(self.load_time))
+            print("=> {} objects, {} failed, mean {:.2f} s / object".format(
+                len(self.timings), len(self.failures), sum(object_times) / len(object_times)))
+            print("=> amortized throughput: {:.2f} objects/hour".format(self.objects_per_hour()))
+            for stage, elapsed in self.pipeline.timings.items():
+                print("=> {}: {:.2f} s in total".format(stage, elapsed))
+
+        compiled_denoiser = getattr(self.pipeline.controlnet, "compiled_denoiser", None)
+        if compiled_denoiser is not None:
+            print("=> {} denoising step: {} compiled calls, {} eager calls, {} builds".format(
+                compiled_denoiser.mode, compiled_denoiser.stats["compiled"], compiled_denoiser.stats["eager"], compiled_denoiser.stats["builds"]))
+
+        offload_scheduler = getattr(self.pipeline.controlnet, "offload_scheduler", None)
+        if offload_scheduler is not None:
+            print("=> offloading: {} loads, {} prefetches, {} evictions, {:.2f} GB copied".format(
+                offload_scheduler.stats["loads"], offload_scheduler.stats["prefetches"], offload_scheduler.stats["evictions"], offload_scheduler.stats["bytes"] / 2**30))
+
+        conditioning_stats = CONDITIONING_CACHE.stats()
+        print("=> text conditioning cache: {} hits, {} misses, {} entries".format(
+            conditioning_stats["hits"], conditioning_stats["misses"], conditioning_stats["size"]))
+
+        self.pipeline.print_latent_cache_summary()
+
+
+def build_generate_args(input_dir, obj_name, obj_file, prompt, num_viewpoints, max_hits):
+    return [
+        "--input_dir", input_dir,
+        "--output_dir", f"{input_dir}/outputs",
+        "--obj_name", obj_name,
+        "--obj_file", obj_file,
+        "--prompt", prompt,
+        "--add_view_to_prompt",
+        "--ddim_steps", "50",
+        "--new_strength", "1",
+        "--update_strength", "0.3",
+        "--view_threshold", "0.1",
+        "--blend", "0",
+        "--dist", "1",
+        "--num_viewpoints", str(num_viewpoints),
+        "--viewpoint_mode", "predefined",
+        "--use_principle",
+        "--update_steps", "20",
+        "--update_mode", "heuristic",
+        "--seed", "42",
+        "--post_process",
+        "--device", "2080",
+        "--use_objaverse",
+        "--hits", str(max_hits),
+        "--cache_dir", f"{input_dir}/cache",
+    ]
+
+
+def test_run(engine, max_hit):
+    generate_args = build_generate_args("data/backpack", "mesh", "mesh.obj", "orange backpack", 20, max_hit)
+    engine.run(generate_args, name="backpack")
+
+
+def run_batch(engine, uid_list, description_list, style_prompt=None, max_hits=2):
     for i, uid in tqdm(enumerate(uid_list)):
         config_path = f"{meshes_path}/{uid}/config.yaml"
         mesh_folder_path = f"{meshes_path}/{uid}"
@@ -101,44 +200,20 @@ def run_batch(uid_list, description_list, style_prompt=None, max_hits=2):
         if style_prompt is not None:
             description = f"{style_prompt} {description}"
         
-        # Construct the command with max_hits
-        command = (
-            "python scripts/generate_texture.py "
-            f"--input_dir {mesh_folder_path} "
-            f"--output_dir {mesh_folder_path}/outputs "
-            "--obj_name model "
-            "--obj_file model.obj "
-            f'--prompt "{description}" '
-            "--add_view_to_prompt "
-            "--ddim_steps 50 "
-            "--new_strength 1 "
-            "--update_strength 0.3 "
-            "--view_threshold 0.1 "
-            "--blend 0 "
-            "--dist 1 "
-            "--num_viewpoints 36 "
-            "--viewpoint_mode predefined "
-            "--use_principle "
-            "--update_steps 20 "
-            "--update_mode heuristic "
-            "--seed 42 "
-            "--post_process "
-            '--device "2080" '
-            "--use_objaverse "
-            f"--hits {max_hits} "
-        )
-        
-        # Run the command
-        print(f"Running command: {command}")
-        subprocess.run(command, shell=True)
+        generate_args = build_generate_args(mesh_folder_path, "model", "model.obj", description, 36, max_hits)
+        engine.run(generate_args, name=uid)
 
 def main():
     global style_prompt, style_prompts, max_hits, run_multiple_style_prompts
     opt = parse_config()
     if opt.hit is not None:
         max_hits = [opt.hit]
+
+    engine = BatchEngine(opt.compile_mode, opt.vram_budget, opt.keep_inpainting)
+
     if opt.test:
-        test_run(max_hits[0])
+        test_run(engine, max_hits[0])
+        engine.summary()
         return
     if opt.prompt is not None:
         style_prompt = opt.prompt
@@ -151,9 +226,11 @@ def main():
     if run_multiple_style_prompts:
         for max_hit in max_hits:
             for style_prompt in style_prompts:
-                run_batch(uid_list, descriptions, style_prompt, max_hit)
+                run_batch(engine, uid_list, descriptions, style_prompt, max_hit)
     else:
-        run_batch(uid_list, descriptions, style_prompt, max_hits)
+        run_batch(engine, uid_list, descriptions, style_prompt, max_hits[0])
+
+    engine.summary()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,117 @@
+# common utils
+import os
+import time
+import argparse
+
+import torch
+
+# customized
+import sys
+sys.path.append(".")
+sys.path.append(os.path.join(".", "models", "ControlNet"))
+
+from cldm.cldm import ControlNet, ControlledUnetModel
+from cldm.compiled import CompiledDenoiser
+
+
+"""
+    Eager vs. compiled ControlLDM denoising step (ControlNet + ControlledUnetModel).
+
+    The default config is a tiny version of `models/cldm_v15.yaml` so that the comparison runs on CPU,
+    pass `--full` on a GPU for the real network (768x768 -> 96x96 latents, CFG batch of 2).
+"""
+
+
+def init_args():
+    print("=> initializing input arguments...")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", type=str, nargs="+", default=["compile"], choices=["compile", "cuda_graph"])
+    parser.add_argument("--latent_size", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=2, help="2 -> one view with classifier-free guidance")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--full", action="store_true", help="use the full SD 1.5 sized networks")
+    parser.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def init_networks(full, device):
+    params = dict(
+        image_size=32, # unused
+        in_channels=4,
+        model_channels=320 if full else 32,
+        attention_resolutions=[4, 2, 1],
+        num_res_blocks=2 if full else 1,
+        channel_mult=[1, 2, 4, 4] if full else [1, 2],
+        num_heads=8 if full else 2,
+        use_spatial_transformer=True,
+        transformer_depth=1,
+        context_dim=768 if full else 32,
+        use_checkpoint=False,
+        legacy=False
+    )
+    control_model = ControlNet(hint_channels=3, **params)
+    diffusion_model = ControlledUnetModel(out_channels=4, **params)
+
+    # NOTE zero-initialized layers (zero convolutions, output convolutions) would make every output 0
+    for model in [control_model, diffusion_model]:
+        for param in model.parameters():
+            if not param.any():
+                torch.nn.init.normal_(param, std=0.02)
+
+    return control_model.eval().to(device), diffusion_model.eval().to(device), params["context_dim"]
+
+
+def run_steps(denoiser, x, ts, context, hint):
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for t in ts:
+        eps = denoiser(x, t, context, hint)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+
+    return eps, time.time() - start_time
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+    torch.manual_seed(args.seed)
+
+    control_model, diffusion_model, context_dim = init_networks(args.full, device)
+    print("=> {} networks on {}, {} latents, batch size {}".format(
+        "full" if args.full else "tiny", device, args.latent_size, args.batch_size))
+
+    x = torch.randn(args.batch_size, 4, args.latent_size, args.latent_size, device=device)
+    hint = torch.rand(args.batch_size, 3, args.latent_size * 8, args.latent_size * 8, device=device)
+    context = torch.randn(args.batch_size, 77, context_dim, device=device)
+    ts = [torch.full((args.batch_size,), t, device=device, dtype=torch.long) for t in range(999, 0, -1000 // args.steps)]
+
+    eager_step = CompiledDenoiser(control_model, diffusion_model).eager_step
+    eager_eps, eager_time = run_steps(eager_step, x, ts, context, hint)
+    print("=> eager: {:.3f} s ({:.2f} ms/step)".format(eager_time, eager_time / len(ts) * 1000))
+
+    for mode in args.modes:
+        denoiser = CompiledDenoiser(control_model, diffusion_model, mode=mode)
+
+        start_time = time.time()
+        denoiser(x, ts[0], context, hint) # warm up
+        warmup_time = time.time() - start_time
+
+        eps, compiled_time = run_steps(denoiser, x, ts, context, hint)
+        max_error = (eps - eager_eps).abs().max().item()
+
+        print("=> {}: {:.3f} s ({:.2f} ms/step), warm-up {:.2f} s, speedup {:.2f}x, max abs error {:.2e}, {} eager fallbacks".format(
+            mode, compiled_time, compiled_time / len(ts) * 1000, warmup_time, eager_time / compiled_time, max_error, denoiser.stats["eager"]))
+
+        # a new shape builds a new entry, the cached one is untouched
+        denoiser(x[:1], ts[0][:1], context[:1], hint[:1])
+        print("=> {}: {} cached entries after a shape change".format(mode, len(denoiser.entries)))
+
+
+if __name__ == "__main__":
+    args = init_args()
+    main(args)
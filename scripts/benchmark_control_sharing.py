@@ -0,0 +1,137 @@
+# common utils
+import os
+import glob
+import argparse
+
+import numpy as np
+import torch
+
+from PIL import Image
+
+# customized
+import sys
+sys.path.append(".")
+sys.path.append(os.path.join(".", "models", "ControlNet"))
+
+from cldm.cldm import CONTROL_SHARING_MODES
+from cldm.compiled import CompiledDenoiser
+from scripts.benchmark_compiled_step import init_networks, run_steps
+
+
+"""
+    Speed / quality trade-off of sharing the ControlNet residuals across the CFG pair.
+
+    - step: one denoising step of the tiny networks on CPU, error of the guided noise against "full"
+    - backpack: the whole pipeline on data/backpack (GPU + checkpoints), generation and refinement time
+        and PSNR of the generated views against "full"
+"""
+
+
+def init_args():
+    print("=> initializing input arguments...")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="step", choices=["step", "backpack"])
+    parser.add_argument("--sharing_modes", type=str, nargs="+", default=CONTROL_SHARING_MODES, choices=CONTROL_SHARING_MODES)
+    parser.add_argument("--seed", type=int, default=42)
+
+    # step
+    parser.add_argument("--latent_size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--guidance_scale", type=float, default=10)
+    parser.add_argument("--full", action="store_true", help="use the full SD 1.5 sized networks")
+
+    # backpack
+    parser.add_argument("--output_dir", type=str, default="./outputs/control_sharing")
+    parser.add_argument("--ddim_steps", type=int, default=20)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def guided_step(denoiser, guidance_scale, control_sharing):
+    def step(x, t, context, hint):
+        model_uncond, model_t = denoiser.eager_step(x, t, context, hint, control_sharing).chunk(2)
+        return model_uncond + guidance_scale * (model_t - model_uncond)
+
+    return step
+
+
+def compute_psnr(image, reference):
+    mse = np.mean((image.astype(np.float64) - reference.astype(np.float64)) ** 2)
+    return 10 * np.log10(255 ** 2 / mse) if mse > 0 else float("inf")
+
+
+@torch.no_grad()
+def run_step(args):
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+    torch.manual_seed(args.seed)
+
+    control_model, diffusion_model, context_dim = init_networks(args.full, device)
+    denoiser = CompiledDenoiser(control_model, diffusion_model)
+
+    # [unconditional, conditional] with the same latents, hint and timesteps
+    x = torch.randn(1, 4, args.latent_size, args.latent_size, device=device).repeat(2, 1, 1, 1)
+    hint = torch.rand(1, 3, args.latent_size * 8, args.latent_size * 8, device=device).repeat(2, 1, 1, 1)
+    context = torch.randn(2, 77, context_dim, device=device)
+    ts = [torch.full((2,), t, device=device, dtype=torch.long) for t in range(999, 0, -1000 // args.steps)]
+
+    reference_eps, reference_time = None, None
+    for control_sharing in args.sharing_modes:
+        eps, step_time = run_steps(guided_step(denoiser, args.guidance_scale, control_sharing), x, ts, context, hint)
+        if reference_eps is None:
+            reference_eps, reference_time = eps, step_time
+
+        relative_error = ((eps - reference_eps).norm() / reference_eps.norm()).item()
+        print("=> {}: {:.2f} ms/step, speedup {:.2f}x, relative error of the guided noise {:.2e}".format(
+            control_sharing, step_time / len(ts) * 1000, reference_time / step_time, relative_error))
+
+
+def run_backpack(args):
+    from scripts.generate_texture import DEVICE, init_args as init_generate_args, run_pipeline
+    from lib.pipeline_helper import TextureSynthesisPipeline
+
+    pipeline = TextureSynthesisPipeline(DEVICE)
+    pipeline.load_models()
+
+    results = []
+    for control_sharing in args.sharing_modes:
+        generate_args = init_generate_args([
+            "--input_dir", "data/backpack",
+            "--output_dir", os.path.join(args.output_dir, control_sharing),
+            "--obj_name", "mesh",
+            "--obj_file", "mesh.obj",
+            "--prompt", "orange backpack",
+            "--ddim_steps", str(args.ddim_steps),
+            "--seed", str(args.seed),
+            "--control_sharing", control_sharing
+        ])
+
+        timings = dict(pipeline.timings)
+        output_dir = run_pipeline(generate_args, pipeline)
+        elapsed = {stage: pipeline.timings[stage] - timings.get(stage, 0) for stage in ["generate", "refine"]}
+
+        results.append((control_sharing, output_dir, elapsed))
+
+    _, reference_dir, reference_elapsed = results[0]
+    reference_paths = sorted(glob.glob(os.path.join(reference_dir, "generate", "inpainted", "*_*[0-9].png")))
+    for control_sharing, output_dir, elapsed in results:
+        psnr_list = []
+        for reference_path in reference_paths:
+            path = os.path.join(output_dir, "generate", "inpainted", os.path.basename(reference_path))
+            if os.path.exists(path):
+                psnr_list.append(compute_psnr(np.array(Image.open(path).convert("RGB")), np.array(Image.open(reference_path).convert("RGB"))))
+
+        print("=> {}: generate {:.2f} s, refine {:.2f} s, speedup {:.2f}x, PSNR against {} {:.2f} dB over {} views".format(
+            control_sharing, elapsed["generate"], elapsed["refine"],
+            sum(reference_elapsed.values()) / sum(elapsed.values()),
+            results[0][0], np.mean(psnr_list) if psnr_list else float("nan"), len(psnr_list)))
+
+
+if __name__ == "__main__":
+    args = init_args()
+
+    if args.mode == "step":
+        run_step(args)
+    else:
+        run_backpack(args)
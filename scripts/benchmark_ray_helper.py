@@ -0,0 +1,156 @@
+# common utils
+import time
+import argparse
+
+import numpy as np
+import trimesh
+
+from collections import defaultdict
+
+from pytorch3d.renderer import look_at_view_transform
+
+# customized
+import sys
+sys.path.append(".")
+
+from lib.ray_helper import bucket_hits_by_order, cast_occlusion_layers, get_world_to_camera
+
+
+def init_args():
+    print("=> initializing input arguments...")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="bucketing", choices=["bucketing", "scaling"],
+        help="bucketing: vectorized vs. loop hit bucketing, scaling: multi-camera ray casting vs. number of workers")
+    parser.add_argument("--image_size", type=int, default=1536)
+    parser.add_argument("--num_faces", type=int, default=100000)
+    parser.add_argument("--coverage", type=float, default=0.5, help="fraction of rays that hit the mesh")
+    parser.add_argument("--max_hits", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+
+    # scaling
+    parser.add_argument("--mesh", type=str, default="data/backpack/mesh.obj")
+    parser.add_argument("--num_views", type=int, nargs="+", default=[10, 36],
+        help="number of cameras, 10 principle views and 36 refinement views by default")
+    parser.add_argument("--max_workers", type=int, default=8)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def bucket_hits_by_order_loop(ray_indexes, mesh_face_indexes, max_hits):
+    """ reference implementation, the pure-python loop previously used in `RaycastingImaging.get_image` """
+    ray_face_indexes = defaultdict(list)
+    for ray_index, ray_face_index in zip(ray_indexes, mesh_face_indexes):
+        ray_face_indexes[ray_index].append(ray_face_index)
+
+    mesh_face_indices = [[] for _ in range(max_hits)]
+    for i in range(max_hits):
+        for ray_index, ray_face_index in ray_face_indexes.items():
+            if i < len(ray_face_index):
+                mesh_face_indices[i].append(ray_face_index[i])
+
+    return [np.unique(indexes) for indexes in mesh_face_indices]
+
+
+def synthesize_hits(num_rays, num_faces, coverage, max_hits, rng):
+    """ fake multi-hit ray casting output, ordered like the embree intersector (by ray pass) """
+    hit_rays = rng.choice(num_rays, int(num_rays * coverage), replace=False)
+    num_ray_hits = rng.integers(1, max_hits * 2, size=hit_rays.shape[0])
+
+    ray_indexes, mesh_face_indexes, hit_distances = [], [], []
+    for i in range(num_ray_hits.max()):
+        rays = hit_rays[num_ray_hits > i]
+        ray_indexes.append(rays)
+        mesh_face_indexes.append(rng.integers(0, num_faces, size=rays.shape[0]))
+        hit_distances.append(np.full(rays.shape[0], float(i)) + rng.random(rays.shape[0]) * 0.5)
+
+    return np.concatenate(ray_indexes), np.concatenate(mesh_face_indexes), np.concatenate(hit_distances)
+
+
+def benchmark(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        outputs = fn()
+        timings.append(time.time() - start_time)
+
+    return outputs, min(timings)
+
+
+def load_normalized_mesh(path):
+    """ same normalization as `init_mesh`: centered at origin, longest side of the bbox is 1 """
+    mesh = trimesh.load_mesh(path, force="mesh")
+    vertices = np.asarray(mesh.vertices, dtype=np.float32)
+    bbox = np.stack([vertices.min(0), vertices.max(0)])
+    vertices = (vertices - bbox.mean(0)) / (bbox[1] - bbox[0]).max()
+
+    return vertices, np.asarray(mesh.faces, dtype=np.int64)
+
+
+def init_w2c_list(num_views):
+    """ cameras evenly spread around the object, alternating between two elevations """
+    w2c_list = []
+    for i in range(num_views):
+        R, T = look_at_view_transform(dist=1, elev=(i % 2) * 30, azim=i * 360 / num_views)
+        w2c_list.append(get_world_to_camera(R.numpy(), T.numpy()))
+
+    return w2c_list
+
+
+def run_bucketing(args):
+    rng = np.random.default_rng(args.seed)
+
+    num_rays = args.image_size * args.image_size
+    ray_indexes, mesh_face_indexes, hit_distances = synthesize_hits(num_rays, args.num_faces, args.coverage, args.max_hits, rng)
+    print("=> {} rays, {} hits".format(num_rays, ray_indexes.shape[0]))
+
+    loop_outputs, loop_time = benchmark(
+        lambda: bucket_hits_by_order_loop(ray_indexes, mesh_face_indexes, args.max_hits), args.repeat)
+    vectorized_outputs, vectorized_time = benchmark(
+        lambda: bucket_hits_by_order(ray_indexes, mesh_face_indexes, hit_distances, args.max_hits), args.repeat)
+
+    for i in range(args.max_hits):
+        assert np.array_equal(loop_outputs[i], vectorized_outputs[i]), "mismatch at hit {}".format(i)
+
+    print("=> loop:       {:.3f} s".format(loop_time))
+    print("=> vectorized: {:.3f} s".format(vectorized_time))
+    print("=> speedup:    {:.1f}x".format(loop_time / vectorized_time))
+
+
+def run_scaling(args):
+    vertices, faces = load_normalized_mesh(args.mesh)
+    print("=> {}: {} vertices, {} faces".format(args.mesh, vertices.shape[0], faces.shape[0]))
+
+    num_workers_list = [1]
+    while num_workers_list[-1] * 2 <= args.max_workers:
+        num_workers_list.append(num_workers_list[-1] * 2)
+    if num_workers_list[-1] != args.max_workers:
+        num_workers_list.append(args.max_workers)
+
+    for num_views in args.num_views:
+        w2c_list = init_w2c_list(num_views)
+
+        reference_outputs, reference_time = None, None
+        for num_workers in num_workers_list:
+            outputs, cast_time = benchmark(
+                lambda: cast_occlusion_layers(vertices, faces, w2c_list, args.max_hits, args.image_size, num_workers), args.repeat)
+
+            if reference_outputs is None:
+                reference_outputs, reference_time = outputs, cast_time
+            for k in range(num_views):
+                for i in range(args.max_hits):
+                    assert np.array_equal(reference_outputs[k][i], outputs[k][i]), "mismatch at camera {} hit {}".format(k, i)
+
+            print("=> {} views, {} workers: {:.3f} s ({:.2f} s/view), speedup {:.1f}x".format(
+                num_views, num_workers, cast_time, cast_time / num_views, reference_time / cast_time))
+
+
+if __name__ == "__main__":
+    args = init_args()
+
+    if args.mode == "bucketing":
+        run_bucketing(args)
+    else:
+        run_scaling(args)
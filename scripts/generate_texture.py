@@ -2,53 +2,23 @@
 import os
 import argparse
 import time
-import numpy as np
 
-# pytorch3d
-from pytorch3d.renderer import TexturesUV
 import torch
-from torchvision import transforms
-from PIL import Image
 
 
 # customized
 import sys
 sys.path.append(".")
 
-from lib.ray_helper import (
-    XRayMesh
+from lib.io_helper import save_args
+from lib.pipeline_helper import (
+    TextureSynthesisPipeline,
+    RenderConfig,
+    MeshConfig,
+    DiffusionConfig,
+    RefineConfig
 )
 
-from lib.mesh_helper import (
-    init_mesh,
-    apply_offsets_to_mesh,
-    adjust_uv_map
-)
-from lib.render_helper import render
-from lib.io_helper import (
-    save_backproject_obj,
-    save_args,
-    save_viewpoints
-)
-from lib.vis_helper import (
-    visualize_outputs, 
-    visualize_principle_viewpoints, 
-    visualize_refinement_viewpoints
-)
-from lib.diffusion_helper import (
-    get_controlnet_depth,
-    get_inpainting,
-    apply_controlnet_depth,
-    apply_inpainting_postprocess
-)
-from lib.projection_helper import (
-    backproject_from_image,
-    render_one_view_and_build_masks,
-    select_viewpoint,
-    build_similarity_texture_cache_for_all_views
-)
-from lib.camera_helper import init_viewpoints
-
 # Setup
 if torch.cuda.is_available():
     DEVICE = torch.device("cuda:0")
@@ -88,7 +58,7 @@ else:
 
 """
 
-def init_args():
+def init_args(argv=None):
     print("=> initializing input arguments...")
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_dir", type=str, required=True)
@@ -101,6 +71,12 @@ def init_args():
     parser.add_argument("--new_strength", type=float, default=1)
     parser.add_argument("--update_strength", type=float, default=0.5)
     parser.add_argument("--ddim_steps", type=int, default=20)
+    parser.add_argument("--sampler", type=str, default="ddim", choices=["ddim", "dpmpp_2m"],
+        help="dpmpp_2m (DPM-Solver++ 2M) reaches the quality of ddim with fewer steps, e.g. 10-15")
+    parser.add_argument("--latent_cache", type=str, default="off", choices=["off", "exact", "incremental"],
+        help="reuse the VAE encoding between the generate and the update pass of a view, incremental re-encodes the changed tiles only (an approximation, the VAE encoder is not local)")
+    parser.add_argument("--control_sharing", type=str, default="full", choices=["full", "shared", "cond_only"],
+        help="run ControlNet on the conditional branch only and reuse (shared) or drop (cond_only) its residuals for the unconditional one")
     parser.add_argument("--guidance_scale", type=float, default=10)
     parser.add_argument("--output_scale", type=float, default=1)
     parser.add_argument("--view_threshold", type=float, default=0.1)
@@ -111,6 +87,10 @@ def init_args():
     parser.add_argument("--blend", type=float, default=0.5)
     parser.add_argument("--eta", type=float, default=0.0)
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch_views", type=int, default=1,
+        help="max number of principle views with disjoint visible faces to denoise in one batch")
+    parser.add_argument("--skip_threshold", type=float, default=0,
+        help="skip the diffusion for views whose new pixels cover less than this fraction of the object")
 
     parser.add_argument("--use_patch", action="store_true", help="apply repaint during refinement to patch up the missing regions")
     parser.add_argument("--use_multiple_objects", action="store_true", help="operate on multiple objects")
@@ -121,8 +101,10 @@ def init_args():
 
     parser.add_argument("--add_view_to_prompt", action="store_true", help="add view information to the prompt")
     parser.add_argument("--post_process", action="store_true", help="post processing the texture")
+    parser.add_argument("--keep_inpainting", action="store_true", help="keep ControlNet and the inpainting model resident together for post-processing (~2.6 GB more VRAM), instead of parking the idle one in CPU memory")
 
     parser.add_argument("--smooth_mask", action="store_true", help="smooth the diffusion mask")
+    parser.add_argument("--crop_to_mask", action="store_true", help="only diffuse a tile around the masked region")
 
     parser.add_argument("--force", action="store_true", help="forcefully generate more image")
 
@@ -130,6 +112,17 @@ def init_args():
     parser.add_argument("--no_repaint", action="store_true", help="do NOT apply repaint")
     parser.add_argument("--no_update", action="store_true", help="do NOT apply update")
 
+    parser.add_argument("--cache_dir", type=str, default=None,
+        help="directory to cache geometry results (e.g. X-ray occlusion layers) across runs")
+    parser.add_argument("--correspondences", type=str, default="off", choices=["off", "device", "memmap"],
+        help="keep the pixel -> texel maps of the back-projected views on the device (last views, up to 1 GB of VRAM) or memory-mapped (all views)")
+
+    parser.add_argument("--compile_mode", type=str, default="eager", choices=["eager", "compile", "cuda_graph"],
+        help="run the ControlNet denoising step with torch.compile or CUDA graphs, built once per input shape (CUDA graphs keep about one step of activations in VRAM)")
+
+    parser.add_argument("--vram_budget", type=float, default=None,
+        help="GB of VRAM for the ControlNet weights, the rest is streamed from pinned CPU memory (for smaller cards)")
+
     # device parameters
     parser.add_argument("--device", type=str, choices=["a6000", "2080"], default="a6000")
 
@@ -145,8 +138,12 @@ def init_args():
     # xray parameters
     parser.add_argument("--hits", type=int, default=2,
         help="the number of hit planes to use for ray casting and inpainting")
+    parser.add_argument("--xray_size", type=int, default=1536,
+        help="resolution of the ray grid for X-ray ray casting, trade accuracy for speed")
+    parser.add_argument("--xray_workers", type=int, default=1,
+        help="number of cameras to cast in parallel for X-ray ray casting")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.device == "a6000":
         setattr(args, "render_simple_factor", 12)
@@ -162,9 +159,61 @@ def init_args():
     return args
 
 
-if __name__ == "__main__":
-    args = init_args()
-    
+def init_configs(args):
+    render_config = RenderConfig(
+        image_size=args.image_size,
+        uv_size=args.uv_size,
+        render_simple_factor=args.render_simple_factor,
+        fragment_k=args.fragment_k
+    )
+    mesh_config = MeshConfig(
+        input_path=os.path.join(args.input_dir, args.obj_file),
+        use_multiple_objects=args.use_multiple_objects,
+        use_unnormalized=args.use_unnormalized,
+        viewpoint_mode=args.viewpoint_mode,
+        num_viewpoints=args.num_viewpoints,
+        dist=args.dist,
+        elev=args.elev,
+        use_shapenet=args.use_shapenet,
+        use_objaverse=args.use_objaverse,
+        hits=args.hits,
+        xray_size=args.xray_size,
+        xray_workers=args.xray_workers,
+        cache_dir=args.cache_dir,
+        correspondences=args.correspondences
+    )
+    diffusion_config = DiffusionConfig(
+        prompt=args.prompt,
+        a_prompt=args.a_prompt,
+        n_prompt=args.n_prompt,
+        new_strength=args.new_strength,
+        update_strength=args.update_strength,
+        ddim_steps=args.ddim_steps,
+        guidance_scale=args.guidance_scale,
+        eta=args.eta,
+        seed=args.seed,
+        blend=args.blend,
+        view_threshold=args.view_threshold,
+        add_view_to_prompt=args.add_view_to_prompt,
+        smooth_mask=args.smooth_mask,
+        no_repaint=args.no_repaint,
+        no_update=args.no_update,
+        batch_views=args.batch_views,
+        skip_threshold=args.skip_threshold,
+        crop_to_mask=args.crop_to_mask,
+        sampler=args.sampler,
+        control_sharing=args.control_sharing,
+        latent_cache=args.latent_cache
+    )
+    refine_config = RefineConfig(
+        update_steps=args.update_steps,
+        update_mode=args.update_mode
+    )
+
+    return render_config, mesh_config, diffusion_config, refine_config
+
+
+def init_output_dir(args):
     datetime_now_str = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
 
     # save
@@ -186,511 +235,47 @@ if __name__ == "__main__":
     os.makedirs(output_dir, exist_ok=True)
     print("=> OUTPUT_DIR:", output_dir)
 
-    # init resources
-    # init mesh
-    mesh, _, mesh_faces, aux, principle_directions, mesh_center, mesh_scale = init_mesh(
-        os.path.join(args.input_dir, args.obj_file),
-        os.path.join(output_dir, args.obj_file), 
-        DEVICE
-    )
+    return output_dir
 
-    # gradient texture
-    init_texture = Image.open("./samples/textures/dummy.png").convert("RGB").resize((args.uv_size, args.uv_size))
 
-    # HACK adjust UVs for multiple materials
-    if args.use_multiple_objects:
-        new_verts_uvs, init_texture = adjust_uv_map(mesh_faces, aux, init_texture, args.uv_size)
-    else:
-        new_verts_uvs = aux.verts_uvs
-    texture_init_maps = transforms.ToTensor()(init_texture)[None, ...].permute(0, 2, 3, 1).to(DEVICE)
-
-    # update the mesh
-    # num_mesh = len(cameras) * len(hits)
-    mesh.textures = TexturesUV(
-        maps=texture_init_maps,
-        faces_uvs=mesh_faces.textures_idx[None, ...],
-        verts_uvs=new_verts_uvs[None, ...]
-    )
+def run_pipeline(args, pipeline=None):
+    """
+        Run generation + refinement (+ post-processing) for one mesh.
 
-    # back-projected faces
-    exist_texture = torch.from_numpy(np.zeros([args.uv_size, args.uv_size]).astype(np.float32)).to(DEVICE)
-
-    # initialize viewpoints
-    # including: principle viewpoints for generation + refinement viewpoints for updating
-    (
-        dist_list, 
-        elev_list, 
-        azim_list, 
-        sector_list,
-        view_punishments
-    ) = init_viewpoints(args.viewpoint_mode, args.num_viewpoints, args.dist, args.elev, principle_directions, 
-                            use_principle=True, 
-                            use_shapenet=args.use_shapenet,
-                            use_objaverse=args.use_objaverse,
-                            hits=args.hits
-                        )
+        A loaded `TextureSynthesisPipeline` can be passed in from the outside so that
+        a long-lived process (e.g. the batch runner) only pays the model loading once.
+    """
+    output_dir = init_output_dir(args)
 
     # save args
     save_args(args, output_dir)
 
-    # initialize depth2image model
-    controlnet, ddim_sampler = get_controlnet_depth()
+    render_config, mesh_config, diffusion_config, refine_config = init_configs(args)
 
+    # initialize depth2image model
+    if pipeline is None:
+        pipeline = TextureSynthesisPipeline(DEVICE, compile_mode=args.compile_mode, vram_budget=args.vram_budget)
+    pipeline.load_models()
 
-    # ------------------- OPERATION ZONE BELOW ------------------------
+    state = pipeline.prepare_mesh(mesh_config, render_config, output_dir)
 
     # 1. generate texture with RePaint 
-    # NOTE no update / refinement
-
-    generate_dir = os.path.join(output_dir, "generate")
-    os.makedirs(generate_dir, exist_ok=True)
-
-    update_dir = os.path.join(output_dir, "update")
-    os.makedirs(update_dir, exist_ok=True)
-
-    init_image_dir = os.path.join(generate_dir, "rendering")
-    os.makedirs(init_image_dir, exist_ok=True)
-
-    normal_map_dir = os.path.join(generate_dir, "normal")
-    os.makedirs(normal_map_dir, exist_ok=True)
-
-    mask_image_dir = os.path.join(generate_dir, "mask")
-    os.makedirs(mask_image_dir, exist_ok=True)
-
-    depth_map_dir = os.path.join(generate_dir, "depth")
-    os.makedirs(depth_map_dir, exist_ok=True)
+    pipeline.generate(state, diffusion_config)
 
-    similarity_map_dir = os.path.join(generate_dir, "similarity")
-    os.makedirs(similarity_map_dir, exist_ok=True)
-
-    inpainted_image_dir = os.path.join(generate_dir, "inpainted")
-    os.makedirs(inpainted_image_dir, exist_ok=True)
-
-    mesh_dir = os.path.join(generate_dir, "mesh")
-    os.makedirs(mesh_dir, exist_ok=True)
-
-    interm_dir = os.path.join(generate_dir, "intermediate")
-    os.makedirs(interm_dir, exist_ok=True)
+    # 2. update texture with RePaint 
+    pipeline.refine(state, diffusion_config, refine_config)
 
-    # prepare viewpoints and cache
-    NUM_PRINCIPLE = 10 if args.use_shapenet or args.use_objaverse else 6
-    pre_dist_list = dist_list[:NUM_PRINCIPLE]
-    pre_elev_list = elev_list[:NUM_PRINCIPLE]
-    pre_azim_list = azim_list[:NUM_PRINCIPLE]
-    pre_sector_list = sector_list[:NUM_PRINCIPLE]
-    pre_view_punishments = view_punishments[:NUM_PRINCIPLE*args.hits]
-    
-    camera_poses = [pre_elev_list, pre_azim_list, pre_dist_list]
-    xray_mesh = XRayMesh(mesh, camera_poses, device=DEVICE, max_hits=args.hits, texture_size=args.uv_size, new_verts_uvs=new_verts_uvs, faces=mesh_faces, texture_init_maps=texture_init_maps)
-    xray_meshes = xray_mesh.occ_mesh
-
-    pre_similarity_texture_cache = build_similarity_texture_cache_for_all_views(xray_meshes, mesh_faces, new_verts_uvs,
-        pre_dist_list, pre_elev_list, pre_azim_list,
-        args.image_size, args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-        DEVICE, hits=args.hits, xray_mesh=xray_mesh
-    )
+    # post-process
+    if args.post_process and args.update_steps > 0:
+        pipeline.post_process(state, keep_models=args.keep_inpainting)
 
-    # start generation
-    print("=> start generating texture...")
-    start_time = time.time()
-    for hit in range(args.hits):
-        print("=> processing hit {}...".format(hit))
-        for view_idx in range(NUM_PRINCIPLE):
-            print("=> processing view {}...".format(view_idx))
-
-            # sequentially pop the viewpoints
-            dist, elev, azim, sector = pre_dist_list[view_idx], pre_elev_list[view_idx], pre_azim_list[view_idx], pre_sector_list[view_idx] 
-            prompt = " the {} view of {}".format(sector, args.prompt) if args.add_view_to_prompt else args.prompt
-            print("=> generating image for prompt: {}...".format(prompt))
-            
-            xray_mesh_selected = xray_meshes[view_idx * args.hits + hit]
-            faces = xray_mesh_selected.faces_packed()
-            textures_idx = xray_mesh.visible_texture_map_list[view_idx * args.hits + hit]
-            vertices_idx = xray_mesh.visible_faces_list[view_idx * args.hits + hit]
-
-            # 1.1. render and build masks
-            (
-                view_score,
-                renderer, cameras, fragments,
-                init_image, normal_map, depth_map, 
-                init_images_tensor, normal_maps_tensor, depth_maps_tensor, similarity_tensor, 
-                keep_mask_image, update_mask_image, generate_mask_image, 
-                keep_mask_tensor, update_mask_tensor, generate_mask_tensor, all_mask_tensor, quad_mask_tensor,
-            ) = render_one_view_and_build_masks(dist, elev, azim, 
-                view_idx*args.hits+(hit), view_idx, view_punishments, # => actual view idx and the sequence idx 
-                pre_similarity_texture_cache, exist_texture,
-                xray_mesh_selected, faces, new_verts_uvs,
-                args.image_size, args.fragment_k,
-                init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
-                DEVICE, save_intermediate=True, smooth_mask=args.smooth_mask, view_threshold=args.view_threshold,
-                textures_idx=textures_idx,
-                hit=hit
-            )
-
-            # 1.2. generate missing region
-            # NOTE first view still gets the mask for consistent ablations
-            if args.no_repaint and (view_idx != 0 and hit != 0):
-                actual_generate_mask_image = Image.fromarray((np.ones_like(np.array(generate_mask_image)) * 255.).astype(np.uint8))
-            else:
-                actual_generate_mask_image = generate_mask_image
-
-            print("=> generate for view {}".format(view_idx))
-            generate_image, generate_image_before, generate_image_after = apply_controlnet_depth(controlnet, ddim_sampler, 
-                init_image.convert("RGBA"), prompt, args.new_strength, args.ddim_steps,
-                actual_generate_mask_image, keep_mask_image, depth_maps_tensor.permute(1, 2, 0).repeat(1, 1, 3).cpu().numpy(), 
-                args.a_prompt, args.n_prompt, args.guidance_scale, args.seed, args.eta, 1, DEVICE, args.blend)
-
-            generate_image.save(os.path.join(inpainted_image_dir, "{}_{}.png".format(view_idx, hit)))
-            generate_image_before.save(os.path.join(inpainted_image_dir, "{}_{}_before.png".format(view_idx, hit)))
-            generate_image_after.save(os.path.join(inpainted_image_dir, "{}_{}_after.png".format(view_idx, hit)))
-
-            # 1.2.2 back-project and create texture
-            # NOTE projection mask = generate mask
-            init_texture, project_mask_image, exist_texture = backproject_from_image(
-                xray_mesh_selected, faces, new_verts_uvs, cameras, 
-                generate_image, generate_mask_image, generate_mask_image, init_texture, exist_texture, 
-                args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-                DEVICE, textures_idx
-            )
-
-            project_mask_image.save(os.path.join(mask_image_dir, "{}_project.png".format(view_idx)))
-
-            # update the mesh
-            transformed_texture = transforms.ToTensor()(init_texture)[None, ...].permute(0, 2, 3, 1).to(DEVICE)
-            expanded_texture_init_maps = transformed_texture.repeat(NUM_PRINCIPLE * args.hits, 1, 1, 1)
-            xray_mesh.textures = TexturesUV(
-                maps=expanded_texture_init_maps,
-                faces_uvs=xray_mesh.visible_texture_map_list,
-                verts_uvs=[new_verts_uvs] * NUM_PRINCIPLE * args.hits
-            )
-            mesh.textures = TexturesUV(
-                maps=transformed_texture,
-                faces_uvs=mesh_faces.textures_idx[None, ...],
-                verts_uvs=new_verts_uvs[None, ...]
-            )
-
-            # 1.2.3. re: render 
-            # NOTE only the rendered image is needed - masks should be re-used
-            (
-                view_score,
-                renderer, cameras, fragments,
-                init_image, *_,
-            ) = render_one_view_and_build_masks(dist, elev, azim, 
-                view_idx*args.hits+hit, view_idx, view_punishments, # => actual view idx and the sequence idx 
-                pre_similarity_texture_cache, exist_texture,
-                xray_mesh_selected, faces, new_verts_uvs,
-                args.image_size, args.fragment_k,
-                init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
-                DEVICE, save_intermediate=False, smooth_mask=args.smooth_mask, view_threshold=args.view_threshold,
-                textures_idx=textures_idx,
-                hit=hit
-            )
-
-            # 1.3. update blurry region
-            # only when: 1) use update flag; 2) there are contents to update; 3) there are enough contexts.
-            if not args.no_update and update_mask_tensor.sum() > 0 and update_mask_tensor.sum() / (all_mask_tensor.sum()) > 0.05:
-                print("=> update {} pixels for view {}".format(update_mask_tensor.sum().int(), view_idx))
-                diffused_image, diffused_image_before, diffused_image_after = apply_controlnet_depth(controlnet, ddim_sampler, 
-                    init_image.convert("RGBA"), prompt, args.update_strength, args.ddim_steps,
-                    update_mask_image, keep_mask_image, depth_maps_tensor.permute(1, 2, 0).repeat(1, 1, 3).cpu().numpy(), 
-                    args.a_prompt, args.n_prompt, args.guidance_scale, args.seed, args.eta, 1, DEVICE, args.blend)
-
-                diffused_image.save(os.path.join(inpainted_image_dir, "{}_{}_update.png".format(view_idx, hit)))
-                diffused_image_before.save(os.path.join(inpainted_image_dir, "{}_{}_update_before.png".format(view_idx, hit)))
-                diffused_image_after.save(os.path.join(inpainted_image_dir, "{}_{}_update_after.png".format(view_idx, hit)))
-            
-                # 1.3.2. back-project and create texture
-                # NOTE projection mask = generate mask
-                init_texture, project_mask_image, exist_texture = backproject_from_image(
-                    xray_mesh_selected, faces, new_verts_uvs, cameras, 
-                    diffused_image, update_mask_image, update_mask_image, init_texture, exist_texture, 
-                    args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-                    DEVICE, textures_idx
-                )
-                
-                # update the mesh
-                transformed_texture = transforms.ToTensor()(init_texture)[None, ...].permute(0, 2, 3, 1).to(DEVICE)
-                expanded_texture_init_maps = transformed_texture.repeat(NUM_PRINCIPLE * args.hits, 1, 1, 1)
-                xray_mesh.textures = TexturesUV(
-                    maps=expanded_texture_init_maps,
-                    faces_uvs=xray_mesh.visible_texture_map_list,
-                    verts_uvs=[new_verts_uvs] * NUM_PRINCIPLE * args.hits
-                )
-                mesh.textures = TexturesUV(
-                    maps=transformed_texture,
-                    faces_uvs=mesh_faces.textures_idx[None, ...],
-                    verts_uvs=new_verts_uvs[None, ...]
-                )
-
-
-            # 1.4. save generated assets
-            # save backprojected OBJ file
-            # save_backproject_obj(
-            #     mesh_dir, "{}_{}.obj".format(view_idx, hit),
-            #     mesh_scale * mesh.verts_packed() + mesh_center if args.use_unnormalized else mesh.verts_packed(),
-            #     vertices_idx, new_verts_uvs, textures_idx, init_texture, 
-            #     DEVICE
-            # )
-            save_backproject_obj(
-                mesh_dir, "{}_{}.obj".format(view_idx, hit),
-                mesh_scale * mesh.verts_packed() + mesh_center if args.use_unnormalized else mesh.verts_packed(),
-                mesh_faces.verts_idx, new_verts_uvs, mesh_faces.textures_idx, init_texture, 
-                DEVICE
-            )
-
-            # save the intermediate view
-            inter_images_tensor, *_ = render(xray_mesh_selected, renderer)
-            inter_image = inter_images_tensor[0].cpu()
-            inter_image = inter_image.permute(2, 0, 1)
-            inter_image = transforms.ToPILImage()(inter_image).convert("RGB")
-            inter_image.save(os.path.join(interm_dir, "{}_{}.png".format(view_idx, hit)))
-
-            # save texture mask
-            exist_texture_image = exist_texture * 255. 
-            exist_texture_image = Image.fromarray(exist_texture_image.cpu().numpy().astype(np.uint8)).convert("L")
-            exist_texture_image.save(os.path.join(mesh_dir, "{}_{}_texture_mask.png".format(view_idx, hit)))
-
-    print("=> total generate time: {} s".format(time.time() - start_time))
-
-    # visualize viewpoints
-    visualize_principle_viewpoints(output_dir, pre_dist_list, pre_elev_list, pre_azim_list)
+    pipeline.print_skip_summary(state)
+    if args.latent_cache != "off":
+        pipeline.print_latent_cache_summary()
 
-    # 2. update texture with RePaint 
+    return output_dir
 
-    if args.update_steps > 0:
-
-        update_dir = os.path.join(output_dir, "update")
-        os.makedirs(update_dir, exist_ok=True)
-
-        init_image_dir = os.path.join(update_dir, "rendering")
-        os.makedirs(init_image_dir, exist_ok=True)
-
-        normal_map_dir = os.path.join(update_dir, "normal")
-        os.makedirs(normal_map_dir, exist_ok=True)
-
-        mask_image_dir = os.path.join(update_dir, "mask")
-        os.makedirs(mask_image_dir, exist_ok=True)
-
-        depth_map_dir = os.path.join(update_dir, "depth")
-        os.makedirs(depth_map_dir, exist_ok=True)
-
-        similarity_map_dir = os.path.join(update_dir, "similarity")
-        os.makedirs(similarity_map_dir, exist_ok=True)
-
-        inpainted_image_dir = os.path.join(update_dir, "inpainted")
-        os.makedirs(inpainted_image_dir, exist_ok=True)
-
-        mesh_dir = os.path.join(update_dir, "mesh")
-        os.makedirs(mesh_dir, exist_ok=True)
-
-        interm_dir = os.path.join(update_dir, "intermediate")
-        os.makedirs(interm_dir, exist_ok=True)
-
-        dist_list = dist_list[NUM_PRINCIPLE:]
-        elev_list = elev_list[NUM_PRINCIPLE:]
-        azim_list = azim_list[NUM_PRINCIPLE:]
-        sector_list = sector_list[NUM_PRINCIPLE:]
-        view_punishments = view_punishments[NUM_PRINCIPLE:]
-        
-        mesh.textures = TexturesUV(
-            maps=transformed_texture,
-            faces_uvs=mesh_faces.textures_idx[None, ...],
-            verts_uvs=new_verts_uvs[None, ...]
-        )
-        
-        camera_poses = [elev_list, azim_list, dist_list]
-        xray_mesh = XRayMesh(mesh, camera_poses, device=DEVICE, max_hits=args.hits, texture_size=args.uv_size, new_verts_uvs=new_verts_uvs, faces=mesh_faces, texture_init_maps=transformed_texture)
-        xray_meshes = xray_mesh.occ_mesh
-
-        # similarity_texture_cache = build_similarity_texture_cache_for_all_views(mesh, mesh_faces, new_verts_uvs,
-        #     dist_list, elev_list, azim_list,
-        #     args.image_size, args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-        #     DEVICE, # hits=args.hits, xray_mesh=mesh
-        # )
-        similarity_texture_cache = build_similarity_texture_cache_for_all_views(xray_meshes, mesh_faces, new_verts_uvs,
-            dist_list, elev_list, azim_list,
-            args.image_size, args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-            DEVICE, hits=args.hits, xray_mesh=xray_mesh
-        )
-        selected_view_ids = []
-
-        print("=> start updating...")
-        start_time = time.time()
-        for view_idx in range(args.update_steps):
-            print("=> processing view {}...".format(view_idx))
-            # 2.1. render and build masks
-
-            # heuristically select the viewpoints
-            dist, elev, azim, sector, selected_view_ids, view_punishments, selected_hit = select_viewpoint(
-                selected_view_ids, view_punishments,
-                args.update_mode, dist_list, elev_list, azim_list, sector_list, view_idx,
-                similarity_texture_cache, exist_texture,
-                mesh, mesh_faces, new_verts_uvs,
-                args.image_size, args.fragment_k,
-                init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
-                DEVICE, False
-            )
-
-            xray_mesh_selected = xray_meshes[selected_view_ids[-1] * args.hits + selected_hit]
-            textures_idx = xray_mesh.visible_texture_map_list[view_idx * args.hits + hit]
-            (
-                view_score,
-                renderer, cameras, fragments,
-                init_image, normal_map, depth_map, 
-                init_images_tensor, normal_maps_tensor, depth_maps_tensor, similarity_tensor, 
-                old_mask_image, update_mask_image, generate_mask_image, 
-                old_mask_tensor, update_mask_tensor, generate_mask_tensor, all_mask_tensor, quad_mask_tensor,
-            ) = render_one_view_and_build_masks(dist, elev, azim, 
-                selected_view_ids[-1]*args.hits+selected_hit, view_idx, view_punishments, # => actual view idx and the sequence idx 
-                similarity_texture_cache, exist_texture,
-                xray_mesh_selected, mesh_faces, new_verts_uvs,
-                args.image_size, args.fragment_k,
-                init_image_dir, mask_image_dir, normal_map_dir, depth_map_dir, similarity_map_dir,
-                DEVICE, save_intermediate=True, smooth_mask=args.smooth_mask, view_threshold=args.view_threshold,
-                textures_idx=textures_idx, hit=selected_hit
-            )
-
-            # # -------------------- OPTION ZONE ------------------------
-            # # still generate for missing regions during refinement
-            # # NOTE this could take significantly more time to complete.
-            # if args.use_patch:
-            #     # 2.2.1 generate missing region
-            #     prompt = " the {} view of {}".format(sector, args.prompt) if args.add_view_to_prompt else args.prompt
-            #     print("=> generating image for prompt: {}...".format(prompt))
-
-            #     if args.no_repaint:
-            #         generate_mask_image = Image.fromarray((np.ones_like(np.array(generate_mask_image)) * 255.).astype(np.uint8))
-
-            #     print("=> generate {} pixels for view {}".format(generate_mask_tensor.sum().int(), view_idx))
-            #     generate_image, generate_image_before, generate_image_after = apply_controlnet_depth(controlnet, ddim_sampler, 
-            #         init_image.convert("RGBA"), prompt, args.new_strength, args.ddim_steps,
-            #         generate_mask_image, keep_mask_image, depth_maps_tensor.permute(1, 2, 0).repeat(1, 1, 3).cpu().numpy(), 
-            #         args.a_prompt, args.n_prompt, args.guidance_scale, args.seed, args.eta, 1, DEVICE, args.blend)
-
-            #     generate_image.save(os.path.join(inpainted_image_dir, "{}_new.png".format(view_idx)))
-            #     generate_image_before.save(os.path.join(inpainted_image_dir, "{}_new_before.png".format(view_idx)))
-            #     generate_image_after.save(os.path.join(inpainted_image_dir, "{}_new_after.png".format(view_idx)))
-
-            #     # 2.2.2. back-project and create texture
-            #     # NOTE projection mask = generate mask
-            #     init_texture, project_mask_image, exist_texture = backproject_from_image(
-            #         mesh, faces, new_verts_uvs, cameras, 
-            #         generate_image, generate_mask_image, generate_mask_image, init_texture, exist_texture, 
-            #         args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-            #         DEVICE
-            #     )
-
-            #     project_mask_image.save(os.path.join(mask_image_dir, "{}_new_project.png".format(view_idx)))
-
-            #     # update the mesh
-            #     mesh.textures = TexturesUV(
-            #         maps=transforms.ToTensor()(init_texture)[None, ...].permute(0, 2, 3, 1).to(DEVICE),
-            #         faces_uvs=faces.textures_idx[None, ...],
-            #         verts_uvs=new_verts_uvs[None, ...]
-            #     )
-
-            #     # 2.2.4. save generated assets
-            #     # save backprojected OBJ file
-            #     save_backproject_obj(
-            #         mesh_dir, "{}_new.obj".format(view_idx),
-            #         mesh.verts_packed(), faces.verts_idx, new_verts_uvs, faces.textures_idx, init_texture, 
-            #         DEVICE
-            #     )
-
-            # # -------------------- OPTION ZONE ------------------------
-
-
-            # 2.2. update existing region
-            prompt = " the {} view of {}".format(sector, args.prompt) if args.add_view_to_prompt else args.prompt
-            print("=> updating image for prompt: {}...".format(prompt))
-
-            if not args.no_update and update_mask_tensor.sum() > 0 and update_mask_tensor.sum() / (all_mask_tensor.sum()) > 0.05:
-                print("=> update {} pixels for view {}".format(update_mask_tensor.sum().int(), view_idx))
-                update_image, update_image_before, update_image_after = apply_controlnet_depth(controlnet, ddim_sampler, 
-                    init_image.convert("RGBA"), prompt, args.update_strength, args.ddim_steps,
-                    update_mask_image, old_mask_image, depth_maps_tensor.permute(1, 2, 0).repeat(1, 1, 3).cpu().numpy(), 
-                    args.a_prompt, args.n_prompt, args.guidance_scale, args.seed, args.eta, 1, DEVICE, args.blend)
-
-                update_image.save(os.path.join(inpainted_image_dir, "{}.png".format(view_idx)))
-                update_image_before.save(os.path.join(inpainted_image_dir, "{}_before.png".format(view_idx)))
-                update_image_after.save(os.path.join(inpainted_image_dir, "{}_after.png".format(view_idx)))
-            else:
-                print("=> nothing to update for view {}".format(view_idx))
-                update_image = init_image
-
-                old_mask_tensor += update_mask_tensor
-                update_mask_tensor[update_mask_tensor == 1] = 0 # HACK nothing to update
-
-                old_mask_image = transforms.ToPILImage()(old_mask_tensor)
-                update_mask_image = transforms.ToPILImage()(update_mask_tensor)
-
-
-            # 2.3. back-project and create texture
-            # NOTE projection mask = update mask
-            init_texture, project_mask_image, exist_texture = backproject_from_image(
-                xray_mesh_selected, mesh_faces, new_verts_uvs, cameras, 
-                update_image, update_mask_image, update_mask_image, init_texture, exist_texture, 
-                args.image_size * args.render_simple_factor, args.uv_size, args.fragment_k,
-                DEVICE, textures_idx
-            )
-
-            project_mask_image.save(os.path.join(mask_image_dir, "{}_{}_project.png".format(view_idx, selected_hit)))
-
-            # update the mesh
-            transformed_texture = transforms.ToTensor()(init_texture)[None, ...].permute(0, 2, 3, 1).to(DEVICE)
-            expanded_texture_init_maps = transformed_texture.repeat(NUM_PRINCIPLE * args.hits, 1, 1, 1)
-            mesh.textures = TexturesUV(
-                maps=transformed_texture,
-                faces_uvs=mesh_faces.textures_idx[None, ...],
-                verts_uvs=new_verts_uvs[None, ...]
-            )
-            xray_mesh.textures = TexturesUV(
-                maps=expanded_texture_init_maps,
-                faces_uvs=xray_mesh.visible_texture_map_list,
-                verts_uvs=[new_verts_uvs] * len(dist_list) * args.hits
-            )
-
-            # 2.4. save generated assets
-            # save backprojected OBJ file            
-            save_backproject_obj(
-                mesh_dir, "{}_{}.obj".format(view_idx, selected_hit),
-                mesh_scale * mesh.verts_packed() + mesh_center if args.use_unnormalized else mesh.verts_packed(),
-                mesh_faces.verts_idx, new_verts_uvs, mesh_faces.textures_idx, init_texture, 
-                DEVICE
-            )
-
-            # save the intermediate view
-            inter_images_tensor, *_ = render(mesh, renderer)
-            inter_image = inter_images_tensor[0].cpu()
-            inter_image = inter_image.permute(2, 0, 1)
-            inter_image = transforms.ToPILImage()(inter_image).convert("RGB")
-            inter_image.save(os.path.join(interm_dir, "{}_{}.png".format(view_idx, selected_hit)))
-
-            # save texture mask
-            exist_texture_image = exist_texture * 255. 
-            exist_texture_image = Image.fromarray(exist_texture_image.cpu().numpy().astype(np.uint8)).convert("L")
-            exist_texture_image.save(os.path.join(mesh_dir, "{}_{}_texture_mask.png".format(view_idx, selected_hit)))
-
-        print("=> total update time: {} s".format(time.time() - start_time))
-
-        # post-process
-        if args.post_process:
-            del controlnet
-            del ddim_sampler
-
-            inpainting = get_inpainting(DEVICE)
-            post_texture = apply_inpainting_postprocess(inpainting, 
-                init_texture, 1-exist_texture[None, :, :, None], "", args.uv_size, args.uv_size, DEVICE)
-
-            save_backproject_obj(
-                mesh_dir, "{}_post.obj".format(view_idx),
-                mesh_scale * mesh.verts_packed() + mesh_center if args.use_unnormalized else mesh.verts_packed(),
-                mesh_faces.verts_idx, new_verts_uvs, mesh_faces.textures_idx, post_texture, 
-                DEVICE
-            )
-    
-        # save viewpoints
-        save_viewpoints(args, output_dir, dist_list, elev_list, azim_list, selected_view_ids)
 
-        # visualize viewpoints
-        visualize_refinement_viewpoints(output_dir, selected_view_ids, dist_list, elev_list, azim_list)
\ No newline at end of file
+if __name__ == "__main__":
+    args = init_args()
+    run_pipeline(args)
@@ -0,0 +1,87 @@
+import os
+import sys
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("omegaconf")
+pytest.importorskip("einops")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "models", "ControlNet"))
+
+from ldm.models.diffusion.ddpm import DDPM
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.dpmpp import DPMSolverPPSampler
+
+
+NUM_TIMESTEPS = 1000
+
+
+class FakeDiffusion:
+    """ the schedule buffers of `LatentDiffusion` and a linear noise prediction """
+    def __init__(self):
+        self.num_timesteps = NUM_TIMESTEPS
+        self.device = torch.device("cpu")
+        self.parameterization = "eps"
+
+        # NOTE float32 buffers, like `register_schedule`
+        self.betas = torch.linspace(1e-4, 2e-2, NUM_TIMESTEPS)
+        self.alphas_cumprod = torch.cumprod(1. - self.betas, 0)
+        self.alphas_cumprod_prev = torch.cat([torch.ones(1), self.alphas_cumprod[:-1]])
+        self.sqrt_alphas_cumprod = self.alphas_cumprod.sqrt()
+        self.sqrt_one_minus_alphas_cumprod = (1. - self.alphas_cumprod).sqrt()
+
+    def apply_model(self, x, t, c):
+        return 0.1 * x + c.mean(1).view(-1, 1, 1, 1)
+
+    def q_sample(self, x_start, t, noise=None):
+        return DDPM.q_sample(self, x_start, t, noise)
+
+
+def init_sampler(sampler_class):
+    sampler = sampler_class(FakeDiffusion())
+    # NOTE the samplers move their buffers to CUDA
+    sampler.register_buffer = types.MethodType(lambda self, name, attr: setattr(self, name, attr), sampler)
+
+    return sampler
+
+
+def test_q_sample_per_view_timesteps():
+    model = FakeDiffusion()
+    x_start, noise = torch.randn(2, 4, 8, 8), torch.randn(2, 4, 8, 8)
+
+    # one timestep per view, as in the batched RePaint pass
+    t = torch.tensor([NUM_TIMESTEPS - 1, 500])
+    noised = DDPM.q_sample(model, x_start, t, noise)
+    for i in range(2):
+        expected = model.sqrt_alphas_cumprod[t[i]] * x_start[i] + model.sqrt_one_minus_alphas_cumprod[t[i]] * noise[i]
+        assert torch.allclose(noised[i], expected, atol=1e-6)
+
+    # the special cases still apply to a batch at the same end of the schedule
+    assert torch.equal(DDPM.q_sample(model, x_start, torch.full((2,), NUM_TIMESTEPS - 1), noise), noise)
+    assert torch.equal(DDPM.q_sample(model, x_start, torch.zeros(2, dtype=torch.long), noise), x_start)
+
+
+@pytest.mark.parametrize("sampler_class", [DDIMSampler, DPMSolverPPSampler])
+def test_repaint_sampling_batch_of_views(sampler_class):
+    torch.manual_seed(0)
+    batch_size = 3
+
+    sampler = init_sampler(sampler_class)
+    sampler.make_schedule(ddim_num_steps=10, ddim_eta=0., verbose=False, strength=1.0)
+
+    x0 = torch.randn(batch_size, 4, 8, 8)
+    mask = torch.zeros(batch_size, 1, 8, 8)
+    mask[..., :4] = 1 # left half unknown
+
+    samples, _ = sampler.sample(10, batch_size, (4, 8, 8), torch.randn(batch_size, 16),
+        mask=mask, x0=x0, verbose=False,
+        unconditional_guidance_scale=7.5, unconditional_conditioning=torch.randn(batch_size, 16))
+
+    assert samples.shape == (batch_size, 4, 8, 8)
+    assert torch.isfinite(samples).all()
+    # the last step noises the known region with t=0, i.e. not at all
+    assert torch.allclose(samples[..., 4:], x0[..., 4:])
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("gradio")
+pytest.importorskip("cv2")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from models.ControlNet.gradio_depth2image import LatentCache, encode_images
+
+
+class FakeAutoencoder:
+    """ a small convolutional encoder with a receptive field below the halo of the cache, downsampling by 8 """
+    def __init__(self):
+        torch.manual_seed(0)
+        self.device = torch.device("cpu")
+        self.encoder = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 3, stride=2, padding=1),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(8, 8, 3, stride=2, padding=1),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(8, 4, 3, stride=2, padding=1),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(4, 4, 3, padding=1)
+        )
+
+    def encode_first_stage(self, x):
+        return self.encoder(x)
+
+    def get_first_stage_encoding(self, z):
+        return z
+
+
+@pytest.mark.parametrize("tile", [(0, 0), (2, 3), (5, 5)])
+def test_incremental_latents_match_full_encode(tile):
+    model = FakeAutoencoder()
+    cache = LatentCache(tile_size=128, halo=64)
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (768, 768, 3), dtype=np.uint8)
+    cache.encode(model, image, key="view")
+
+    # edit one tile, the rest of the image is unchanged
+    row, col = tile
+    edited = image.copy()
+    edited[row * 128:(row + 1) * 128, col * 128:(col + 1) * 128] = rng.integers(0, 256, (128, 128, 3), dtype=np.uint8)
+
+    latents = cache.encode(model, edited, key="view", incremental=True)
+    with torch.no_grad():
+        expected = encode_images(model, edited[None])
+
+    assert cache.stats()["partial_hits"] == 1
+    assert torch.allclose(latents, expected, atol=1e-5)
+
+
+def test_unchanged_image_hits():
+    model = FakeAutoencoder()
+    cache = LatentCache()
+
+    image = np.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    first = cache.encode(model, image, key="view")
+    second = cache.encode(model, image.copy(), key="view")
+
+    assert second is first
+    assert cache.stats()["hits"] == 1 and cache.stats()["hit_rate"] == 0.5
+
+    cache.clear()
+    cache.encode(model, image, key="view")
+    assert cache.stats()["misses"] == 2
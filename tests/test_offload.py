@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+import torch
+
+pytest.importorskip("gradio")
+pytest.importorskip("cv2")
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from models.ControlNet.gradio_depth2image import BASE_DIR, init_model
+
+
+VRAM_BUDGET = 2 # GB
+SLACK = 256 * 2**20 # schedule buffers and allocator rounding
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a GPU")
+@pytest.mark.skipif(not os.path.exists(BASE_DIR + "/models/control_sd15_depth.pth"), reason="needs the ControlNet checkpoint")
+def test_init_model_within_vram_budget():
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+
+    model, _ = init_model(vram_budget=VRAM_BUDGET)
+
+    # NOTE the full fp32 model is ~5.7 GB, it must never be on the GPU as a whole
+    assert torch.cuda.max_memory_allocated() <= VRAM_BUDGET * 2**30 + SLACK
+    assert model.offload_scheduler.resident_bytes() <= VRAM_BUDGET * 2**30
+    assert model.device.type == "cuda"
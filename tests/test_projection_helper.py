@@ -0,0 +1,361 @@
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+pytest.importorskip("pytorch3d")
+pytest.importorskip("cv2")
+pytest.importorskip("torchvision")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import lib.projection_helper as projection_helper
+from lib.projection_helper import (
+    CorrespondenceCache,
+    SimilarityTextureCache,
+    ViewScoringEngine,
+    backproject_from_image,
+    build_diffusion_mask_from_fragments,
+    get_all_4_locations,
+    compose_quad_mask_tensors,
+    compute_view_heat
+)
+
+
+NUM_VIEWS = 6
+IMAGE_SIZE = 16
+UV_SIZE = 8
+VIEW_THRESHOLD = 0.1
+
+
+class FakeMeshes:
+    """ one mesh shared by all views, only the per-view rasterization is faked """
+    def __len__(self):
+        return 1
+
+    def verts_list(self):
+        return [None]
+
+    def faces_list(self):
+        return [None]
+
+
+class FakeFaces:
+    textures_idx = torch.zeros(0, 3, dtype=torch.long)
+
+
+def init_views(seed=0):
+    """ per-view texel under each pixel (-1 on the background) and similarity (0 on the background) """
+    generator = torch.Generator().manual_seed(seed)
+    pixel_texels = torch.randint(0, UV_SIZE * UV_SIZE, (NUM_VIEWS, IMAGE_SIZE, IMAGE_SIZE), generator=generator)
+    background = torch.rand(NUM_VIEWS, IMAGE_SIZE, IMAGE_SIZE, generator=generator) < 0.3
+    pixel_texels[background] = -1
+    similarity = torch.rand(NUM_VIEWS, IMAGE_SIZE, IMAGE_SIZE, generator=generator)
+    similarity[background] = 0
+
+    return pixel_texels, similarity
+
+
+@pytest.fixture
+def fake_rasterization(monkeypatch):
+    """ the cameras are the view ids, the fragments are the view ids of the batch """
+    pixel_texels, similarity = init_views()
+
+    monkeypatch.setattr(projection_helper, "Meshes", lambda verts, faces: None)
+    monkeypatch.setattr(projection_helper, "init_camera", lambda dist, elev, azim, image_size, device: torch.tensor(dist))
+    monkeypatch.setattr(projection_helper, "render_similarity_maps",
+        lambda meshes, cameras, image_size, faces_per_pixel, return_fragments=False: (similarity[cameras].unsqueeze(1), cameras))
+    monkeypatch.setattr(projection_helper, "get_pixel_texels",
+        lambda fragments, verts_uvs, textures_idx, uv_size: pixel_texels[fragments])
+
+    return pixel_texels, similarity
+
+
+def init_engine():
+    view_ids = list(range(NUM_VIEWS))
+
+    return ViewScoringEngine(FakeMeshes(), FakeFaces(), None,
+        view_ids, view_ids, view_ids,
+        IMAGE_SIZE, UV_SIZE, 1,
+        torch.device("cpu"),
+        view_threshold=VIEW_THRESHOLD
+    )
+
+
+def init_similarity_texture_cache(seed=1):
+    similarity_texture_cache = SimilarityTextureCache(NUM_VIEWS, UV_SIZE, torch.device("cpu"))
+    similarity_texture_cache.index = torch.randint(0, NUM_VIEWS, (UV_SIZE, UV_SIZE),
+        generator=torch.Generator().manual_seed(seed)).to(torch.uint8)
+
+    return similarity_texture_cache
+
+
+def compute_reference_heat(similarity, exist_texture, similarity_texture_cache, view_punishments):
+    """ view heat of every view from its diffusion masks, like `render_one_view_and_build_masks` """
+    view_heat = []
+    for view_idx in range(NUM_VIEWS):
+        masks = build_diffusion_mask_from_fragments(torch.tensor([view_idx]), similarity[view_idx][None, :, :, None],
+            exist_texture, similarity_texture_cache, view_idx, None, None, view_threshold=VIEW_THRESHOLD)
+        *_, quad_mask_tensor = compose_quad_mask_tensors(*masks[:3])
+        view_heat.append(compute_view_heat(similarity[view_idx], quad_mask_tensor) * view_punishments[view_idx])
+
+    return torch.stack(view_heat)
+
+
+def test_incremental_scores_match_recompute(fake_rasterization):
+    _, similarity = fake_rasterization
+    generator = torch.Generator().manual_seed(2)
+
+    engine = init_engine()
+    similarity_texture_cache = init_similarity_texture_cache()
+    exist_texture = torch.zeros(UV_SIZE, UV_SIZE)
+    view_punishments = [1.] * NUM_VIEWS
+    engine.score(exist_texture, similarity_texture_cache, view_punishments)
+
+    for _ in range(5):
+        # back-project some texels, a few of them again
+        texels = torch.randint(0, UV_SIZE * UV_SIZE, (12,), generator=generator)
+        exist_texture.view(-1)[texels] = 1
+        engine.update_texels(texels, exist_texture)
+
+        assert torch.equal(engine.counts, engine.count_quad_classes(exist_texture, similarity_texture_cache))
+
+        view_heat = engine.score(exist_texture, similarity_texture_cache, view_punishments)[:, 0]
+        reference_heat = compute_reference_heat(similarity, exist_texture, similarity_texture_cache, view_punishments)
+        assert torch.allclose(view_heat, reference_heat)
+
+
+def test_selected_view_order_unchanged(fake_rasterization):
+    pixel_texels, similarity = fake_rasterization
+
+    def select_views(score_fn, update_fn, num_steps=NUM_VIEWS):
+        exist_texture = torch.zeros(UV_SIZE, UV_SIZE)
+        view_punishments = [1.] * NUM_VIEWS
+        selected_view_ids = []
+        for _ in range(num_steps):
+            view_idx = int(score_fn(exist_texture, view_punishments).argmax())
+            selected_view_ids.append(view_idx)
+            view_punishments[view_idx] *= 0.01
+
+            # back-project the valid pixels of the selected view
+            valid = similarity[view_idx] >= VIEW_THRESHOLD
+            texels = pixel_texels[view_idx][valid]
+            exist_texture.view(-1)[texels] = 1
+            update_fn(texels, exist_texture)
+
+        return selected_view_ids
+
+    similarity_texture_cache = init_similarity_texture_cache()
+    engine = init_engine()
+
+    selected_view_ids = select_views(
+        lambda exist_texture, view_punishments: engine.score(exist_texture, similarity_texture_cache, view_punishments)[:, 0],
+        engine.update_texels
+    )
+    reference_view_ids = select_views(
+        lambda exist_texture, view_punishments: compute_reference_heat(similarity, exist_texture, similarity_texture_cache, view_punishments),
+        lambda texels, exist_texture: None
+    )
+
+    assert selected_view_ids == reference_view_ids
+
+
+def init_similarity_textures(num_views, seed=3):
+    """ dense fp32 similarity textures, some texels are never seen """
+    generator = torch.Generator().manual_seed(seed)
+    similarity_textures = torch.rand(num_views, UV_SIZE, UV_SIZE, generator=generator)
+    similarity_textures[torch.rand(num_views, UV_SIZE, UV_SIZE, generator=generator) < 0.5] = 0
+    similarity_textures[:, 0, :] = 0
+
+    return similarity_textures
+
+
+@pytest.mark.parametrize("num_views", [NUM_VIEWS, 300])
+def test_similarity_texture_cache_quantization(num_views):
+    similarity_textures = init_similarity_textures(num_views)
+
+    similarity_texture_cache = SimilarityTextureCache(num_views, UV_SIZE, torch.device("cpu"))
+    for start in range(0, num_views, 4):
+        similarity_texture_cache.update(start, similarity_textures[start:start + 4])
+    similarity_texture_cache.compact()
+
+    assert similarity_texture_cache.index.dtype == (torch.uint8 if num_views <= 256 else torch.int16)
+    assert similarity_texture_cache.value.dtype == torch.float16
+
+    # NOTE the index is exact, only the best similarity is rounded to float16
+    assert torch.equal(similarity_texture_cache.index.long(), similarity_textures.argmax(0))
+    value_error = (similarity_texture_cache.value.float() - similarity_textures.max(0).values).abs().max()
+    assert value_error <= 2 ** -11
+
+    for view_idx in range(num_views):
+        assert torch.equal(similarity_texture_cache.view_mask(view_idx), similarity_textures.argmax(0) == view_idx)
+
+
+def test_diffusion_masks_from_cache_match_dense(fake_rasterization):
+    """ the masks of every view are the same with the quantized cache and the dense argmax """
+    _, similarity = fake_rasterization
+    similarity_textures = init_similarity_textures(NUM_VIEWS)
+
+    similarity_texture_cache = SimilarityTextureCache(NUM_VIEWS, UV_SIZE, torch.device("cpu"))
+    similarity_texture_cache.update(0, similarity_textures)
+    similarity_texture_cache.compact()
+
+    dense_cache = SimilarityTextureCache(NUM_VIEWS, UV_SIZE, torch.device("cpu"))
+    dense_cache.index = similarity_textures.argmax(0)
+
+    exist_texture = (torch.rand(UV_SIZE, UV_SIZE, generator=torch.Generator().manual_seed(4)) < 0.5).float()
+    num_update_pixels = 0
+    for view_idx in range(NUM_VIEWS):
+        masks = build_diffusion_mask_from_fragments(torch.tensor([view_idx]), similarity[view_idx][None, :, :, None],
+            exist_texture, similarity_texture_cache, view_idx, None, None, view_threshold=VIEW_THRESHOLD)
+        dense_masks = build_diffusion_mask_from_fragments(torch.tensor([view_idx]), similarity[view_idx][None, :, :, None],
+            exist_texture, dense_cache, view_idx, None, None, view_threshold=VIEW_THRESHOLD)
+
+        for mask_tensor, dense_mask_tensor in zip(masks, dense_masks):
+            assert torch.equal(mask_tensor, dense_mask_tensor)
+        num_update_pixels += masks[1].sum()
+
+    assert num_update_pixels > 0
+
+
+Fragments = namedtuple("Fragments", ["pix_to_face", "bary_coords"])
+
+BACKPROJECT_SIZE = 32 # 2x the rendering, like `render_simple_factor`
+NUM_FACES = 20
+
+
+def init_fragments(seed=5):
+    """ one face layer at the back-projection resolution, with background """
+    generator = torch.Generator().manual_seed(seed)
+    pix_to_face = torch.randint(0, NUM_FACES, (1, BACKPROJECT_SIZE, BACKPROJECT_SIZE, 1), generator=generator)
+    pix_to_face[torch.rand(pix_to_face.shape, generator=generator) < 0.3] = -1
+    bary_coords = torch.rand(1, BACKPROJECT_SIZE, BACKPROJECT_SIZE, 1, 3, generator=generator)
+    bary_coords /= bary_coords.sum(-1, keepdim=True)
+
+    verts_uvs = torch.rand(3 * NUM_FACES, 2, generator=generator)
+    textures_idx = torch.randperm(3 * NUM_FACES, generator=generator).reshape(NUM_FACES, 3)
+
+    return Fragments(pix_to_face, bary_coords), verts_uvs, textures_idx
+
+
+@pytest.fixture
+def fake_rasterizer(monkeypatch):
+    fragments, verts_uvs, textures_idx = init_fragments()
+
+    class FakeRasterizer:
+        def __init__(self, cameras, raster_settings):
+            pass
+
+        def __call__(self, mesh):
+            return fragments
+
+    monkeypatch.setattr(projection_helper, "RasterizationSettings", lambda image_size, faces_per_pixel: None)
+    monkeypatch.setattr(projection_helper, "MeshRasterizer", FakeRasterizer)
+
+    return fragments, verts_uvs, textures_idx
+
+
+def backproject_from_fragments(fragments, verts_uvs, textures_idx, reference_image, project_mask_image, init_texture, exist_texture):
+    """ the back-projection on the fragments, as it was done before the correspondences (covered pixels only) """
+    pixel_uvs = projection_helper.interpolate_face_attributes(
+        fragments.pix_to_face, fragments.bary_coords, verts_uvs[textures_idx]
+    )[0, :, :, 0] # H, W, 2
+
+    project_mask_image_scaled = project_mask_image.resize((BACKPROJECT_SIZE, BACKPROJECT_SIZE), Image.Resampling.NEAREST)
+    selected = torch.from_numpy(np.array(project_mask_image_scaled) > 0) & (fragments.pix_to_face[0, :, :, 0] >= 0)
+    pixel_uvs = pixel_uvs[selected]
+
+    texture_locations_y, texture_locations_x = get_all_4_locations(
+        (1 - pixel_uvs[:, 1]) * (UV_SIZE - 1),
+        pixel_uvs[:, 0] * (UV_SIZE - 1)
+    )
+    texture_values = torch.from_numpy(np.array(reference_image.resize((BACKPROJECT_SIZE, BACKPROJECT_SIZE))))[selected].repeat(4, 1)
+
+    texture_tensor = torch.from_numpy(np.array(init_texture))
+    texture_tensor[texture_locations_y, texture_locations_x] = texture_values
+    exist_texture[texture_locations_y, texture_locations_x] = 1
+
+    return texture_tensor.numpy(), exist_texture
+
+
+def test_backproject_with_correspondences(fake_rasterizer):
+    fragments, verts_uvs, textures_idx = fake_rasterizer
+    generator = torch.Generator().manual_seed(6)
+
+    reference_image = Image.fromarray(torch.randint(0, 256, (IMAGE_SIZE, IMAGE_SIZE, 3), generator=generator).byte().numpy())
+    init_texture = Image.fromarray(torch.randint(0, 256, (UV_SIZE, UV_SIZE, 3), generator=generator).byte().numpy())
+    new_mask_tensor = (torch.rand(1, IMAGE_SIZE, IMAGE_SIZE, generator=generator) < 0.3).float()
+    update_mask_tensor = (torch.rand(1, IMAGE_SIZE, IMAGE_SIZE, generator=generator) < 0.3).float()
+
+    def backproject(correspondence):
+        texture, project_mask_image, exist_texture = backproject_from_image(None, None, verts_uvs, None,
+            reference_image, new_mask_tensor, update_mask_tensor, init_texture, torch.zeros(UV_SIZE, UV_SIZE),
+            BACKPROJECT_SIZE, UV_SIZE, 1, torch.device("cpu"), textures_idx=textures_idx, correspondence=correspondence)
+
+        return np.array(texture), project_mask_image, exist_texture
+
+    texture, project_mask_image, exist_texture = backproject(None)
+    reference_texture, reference_exist_texture = backproject_from_fragments(fragments, verts_uvs, textures_idx,
+        reference_image, project_mask_image, init_texture, torch.zeros(UV_SIZE, UV_SIZE))
+
+    assert np.array_equal(texture, reference_texture)
+    assert torch.equal(exist_texture, reference_exist_texture)
+    assert exist_texture.sum() > 0
+
+    for storage in ["device", "memmap"]:
+        correspondences = CorrespondenceCache(torch.device("cpu"), storage)
+        for _ in range(2): # miss, then hit
+            cached_texture, _, cached_exist_texture = backproject(
+                correspondences.get("view", None, textures_idx, verts_uvs, None, BACKPROJECT_SIZE, UV_SIZE, 1))
+
+            assert np.array_equal(cached_texture, texture)
+            assert torch.equal(cached_exist_texture, exist_texture)
+
+        assert correspondences.stats == {"hits": 1, "misses": 1}
+        correspondences.close()
+
+
+def init_correspondence(num_pixels):
+    pixels = torch.arange(num_pixels, dtype=torch.int32)
+
+    return pixels, torch.stack([pixels] * 4)
+
+
+def test_correspondence_cache_byte_bound(monkeypatch):
+    # 20 bytes per pixel, 2000 bytes per view
+    monkeypatch.setattr(projection_helper, "build_view_correspondence", lambda *args: init_correspondence(100))
+    correspondences = CorrespondenceCache(torch.device("cpu"), "device", max_bytes=4500)
+
+    for key in ["a", "b", "c"]:
+        correspondences.get(key, None, None, None, None, BACKPROJECT_SIZE, UV_SIZE, 1)
+    assert list(correspondences.entries) == ["b", "c"]
+    assert correspondences.num_bytes == 4000
+
+    # NOTE a view larger than the budget is used once and not kept
+    monkeypatch.setattr(projection_helper, "build_view_correspondence", lambda *args: init_correspondence(1000))
+    pixels, texels = correspondences.get("d", None, None, None, None, BACKPROJECT_SIZE, UV_SIZE, 1)
+    assert pixels.shape == (1000,) and texels.shape == (4, 1000)
+    assert len(correspondences.entries) == 0 and correspondences.num_bytes == 0
+
+
+def test_correspondence_cache_memmap(monkeypatch):
+    monkeypatch.setattr(projection_helper, "build_view_correspondence", lambda *args: init_correspondence(100))
+    correspondences = CorrespondenceCache(torch.device("cpu"), "memmap", max_bytes=0)
+    memmap_dir = correspondences.memmap_dir.name
+
+    # NOTE every view is kept on disk, the byte bound only applies to the device storage
+    for key in ["a", "b", "c"]:
+        correspondences.get(key, None, None, None, None, BACKPROJECT_SIZE, UV_SIZE, 1)
+    assert list(correspondences.entries) == ["a", "b", "c"]
+    assert len(os.listdir(memmap_dir)) == 6
+
+    pixels, texels = correspondences.entries["b"]
+    assert isinstance(pixels, np.memmap)
+    assert np.array_equal(pixels, np.arange(100)) and np.array_equal(texels, np.stack([np.arange(100)] * 4))
+
+    correspondences.close()
+    assert not os.path.exists(memmap_dir)